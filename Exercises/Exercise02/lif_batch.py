@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+'''
+Batch simulation of leaky integrate-and-fire neurons for Exercise 2.
+
+Instead of stepping one neuron at a time through a Python loop, all input
+currents (and noise realizations) are integrated simultaneously as NumPy
+arrays. The model and the forward Euler scheme are the same as in
+find_firing_rate_numerically in the exercise:
+
+    v[n + 1] = v[n] + h / tau_m * (-v[n] + R * I[n])
+
+with v reset to v_reset whenever it reaches theta. Example usage:
+
+    from lif_batch import find_FI_numerically
+    Is = np.linspace(200, 700, 200)
+    F_clean = find_FI_numerically(Is)
+    F_noisy = find_FI_numerically(Is, noisy=True)
+
+Run this file to compare the batch engine with the single neuron loop and
+the analytical f-I curve.
+'''
+import time
+import numpy as np
+
+
+def simulate_lif_batch(I0, T=1000, h=0.1, R=40e-3, tau_m=10., theta=15.,
+                       v_init=0., v_reset=0., noise_std=0.,
+                       return_spike_times=True, seed=None):
+    '''
+    Simulate a batch of LIF neurons with constant (optionally noisy) input.
+
+    Parameters
+    ----------
+    I0 : array_like, input current of each neuron [pA]. Any shape; neurons
+        with the same current but different noise realizations are given as
+        repeated entries.
+    T : float, simulation duration [ms]
+    h : float, time step [ms]
+    R : float, membrane resistance [GOhm]
+    tau_m : float, membrane time constant [ms]
+    theta : float, firing threshold [mV]
+    v_init : float, initial membrane potential [mV]
+    v_reset : float, reset potential [mV]
+    noise_std : float, relative standard deviation of the input noise; the
+        input at each time step is I0 * (1 + N(0, noise_std))
+    return_spike_times : bool, also return the spike times of each neuron
+    seed : int or None, seed of the noise generator
+
+    Returns
+    -------
+    counts : ndarray, number of spikes of each neuron, same shape as I0
+    spike_times : list of ndarray, spike times [ms] of each neuron in the
+        order of I0.ravel() (only if return_spike_times is True)
+    '''
+    I0 = np.asarray(I0, dtype=float)
+    shape = I0.shape
+    I0 = I0.ravel()
+    num_tsteps = int(T / h + 1)
+    rng = np.random.default_rng(seed)
+
+    v = np.full(I0.shape, v_init, dtype=float)
+    counts = np.zeros(I0.shape, dtype=int)
+    spike_steps = []
+    spike_neurons = []
+
+    for n in range(num_tsteps - 1):
+        if noise_std > 0:
+            I = I0 * (1. + rng.normal(0, noise_std, size=I0.shape))
+        else:
+            I = I0
+        v = v + h / tau_m * (-v + R * I)
+        spiking = v >= theta
+        if spiking.any():
+            v[spiking] = v_reset
+            counts += spiking
+            if return_spike_times:
+                idx = np.flatnonzero(spiking)
+                spike_neurons.append(idx)
+                spike_steps.append(np.full(idx.size, n + 1))
+
+    if not return_spike_times:
+        return counts.reshape(shape)
+
+    if spike_neurons:
+        spike_neurons = np.concatenate(spike_neurons)
+        spike_steps = np.concatenate(spike_steps)
+    else:
+        spike_neurons = np.zeros(0, dtype=int)
+        spike_steps = np.zeros(0, dtype=int)
+    # spikes are collected in time order, a stable sort by neuron keeps it
+    order = np.argsort(spike_neurons, kind='stable')
+    t = np.linspace(0, T, num_tsteps)
+    spike_times = np.split(t[spike_steps[order]],
+                           np.cumsum(counts)[:-1])
+    return counts.reshape(shape), spike_times
+
+
+def find_FI_numerically(Is, noisy=False, T=1000, num_realizations=1,
+                        seed=None, **kwargs):
+    '''
+    Firing rates [spikes / s] for the input currents Is, averaged over
+    num_realizations noise realizations if noisy is True. Additional keyword
+    arguments are passed on to simulate_lif_batch.
+    '''
+    Is = np.asarray(Is, dtype=float)
+    if noisy:
+        I0 = np.repeat(Is[:, None], num_realizations, axis=1)
+        noise_std = 0.4
+    else:
+        I0 = Is[:, None]
+        noise_std = 0.
+    counts = simulate_lif_batch(I0, T=T, noise_std=noise_std,
+                                return_spike_times=False, seed=seed, **kwargs)
+    return counts.mean(axis=1) / (T / 1000.)
+
+
+def find_FI_analytically(I, R=40e-3, tau_m=10., theta=15.):
+    '''
+    Analytical firing rate [spikes / s] of the LIF neuron for the input
+    currents I (zero below the threshold current theta / R)
+    '''
+    I = np.asarray(I, dtype=float)
+    F = np.zeros(I.shape)
+    above = R * I > theta
+    F[above] = 1000 / (tau_m * np.log(1 / (1 - theta / (R * I[above]))))
+    return F
+
+
+def _find_firing_rate_loop(I0, noisy=False, T=1000, h=0.1, R=40e-3,
+                           tau_m=10., theta=15.):
+    '''
+    single neuron reference implementation from the exercise
+    '''
+    num_tsteps = int(T / h + 1)
+    v = np.zeros(num_tsteps)
+    spike_idxs = []
+    if noisy:
+        I = I0 * (np.ones(num_tsteps) + np.random.normal(0, 0.4,
+                                                         size=num_tsteps))
+    else:
+        I = I0 * np.ones(num_tsteps)
+    for n in range(num_tsteps - 1):
+        v[n + 1] = v[n] + h / tau_m * (-v[n] + R * I[n])
+        if v[n + 1] >= theta:
+            v[n + 1] = 0
+            spike_idxs.append(n + 1)
+    return len(spike_idxs) / (T / 1000.)
+
+
+if __name__ == '__main__':
+    Is = np.linspace(200, 700, 200)
+
+    t0 = time.time()
+    F_clean = find_FI_numerically(Is)
+    F_noisy = find_FI_numerically(Is, noisy=True, seed=1234)
+    t_batch = time.time() - t0
+
+    t0 = time.time()
+    F_loop = np.array([_find_firing_rate_loop(I) for I in Is])
+    F_loop_noisy = np.array([_find_firing_rate_loop(I, noisy=True)
+                             for I in Is])
+    t_loop = time.time() - t0
+
+    F_analytic = find_FI_analytically(Is)
+    print('batch: {:.3f} s, loop: {:.3f} s, speedup {:.0f}x'.format(
+        t_batch, t_loop, t_loop / t_batch))
+    print('max |batch - loop| (clean): {} spikes / s'.format(
+        np.abs(F_clean - F_loop).max()))
+    print('max |batch - analytic| (clean): {:.2f} spikes / s'.format(
+        np.abs(F_clean - F_analytic).max()))
+    print('mean |batch - loop| (noisy): {:.2f} spikes / s'.format(
+        np.abs(F_noisy - F_loop_noisy).mean()))
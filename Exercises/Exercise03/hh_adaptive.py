@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+'''
+Adaptive-step integration of the Exercise 3 Hodgkin-Huxley model.
+
+The same parameter dictionary as in the exercise (set_parameters /
+derived_parameters) is used, but the model is integrated with an adaptive
+step size solver from scipy.integrate. The solver takes large steps while
+the neuron is quiescent and small steps during spikes. The simulation is
+split at the stimulus on and off times, so the discontinuities in the input
+current are hit exactly, and spike times are found as events (upward
+crossings of the spike threshold) located to solver accuracy rather than to
+the nearest time step. Example usage:
+
+    p = set_parameters()
+    result = simulate_adaptive(p)
+    plt.plot(result['t'], result['Vm'])
+    print(result['spike_times'])
+
+For this single 50 ms run, LSODA takes fewer steps than the dt = 0.025
+Euler loop of the exercise, but each step has more Python overhead. It is
+therefore not faster in wall time: about as fast at rtol = 1e-4, and about
+1.5x slower at the default rtol = 1e-6. What it gains is accuracy. Against
+a converged reference (DOP853 at rtol = 1e-12), the spike time error of the
+Euler loop is 4e-2 ms, and that of LSODA 4e-3 ms at rtol = 1e-4 and 8e-5 ms
+at rtol = 1e-6. The Euler error is first order in dt, so an Euler loop as
+accurate as LSODA at rtol = 1e-6 needs dt = 5e-5 ms, about 35 s or
+300-400x the run time of LSODA.
+
+Run this file for an accuracy comparison against the converged reference
+and a timing benchmark.
+'''
+import time
+import numpy as np
+from scipy.integrate import solve_ivp
+from hh_batch import (alpha_m, beta_m, alpha_h, beta_h, alpha_n, beta_n,
+                      simulate_batch, set_parameters, _simulate_loop)
+
+
+def _rhs(t, y, I, p):
+    '''
+    time derivatives of (Vm, m, h, n) for a constant input current I
+    '''
+    Vm, m, h, n = y
+    g_Na = p['gbar_Na'] * m**3 * h
+    g_K = p['gbar_K'] * n**4
+    dVm = (I - g_Na * (Vm - p['E_Na']) - g_K * (Vm - p['E_K'])
+           - p['gbar_l'] * (Vm - p['E_l'])) / p['Cm']
+    dm = alpha_m(Vm) * (1 - m) - beta_m(Vm) * m
+    dh = alpha_h(Vm) * (1 - h) - beta_h(Vm) * h
+    dn = alpha_n(Vm) * (1 - n) - beta_n(Vm) * n
+    return [dVm, dm, dh, dn]
+
+
+def simulate_adaptive(p, method='LSODA', rtol=1e-6, atol=1e-8, threshold=0.,
+                      t_eval=None):
+    '''
+    Simulate the HH neuron of the exercise with an adaptive step solver.
+
+    Parameters
+    ----------
+    p : dict, parameter dictionary from set_parameters()
+    method : str, integration method of scipy.integrate.solve_ivp
+    rtol, atol : float, relative and absolute tolerances of the solver
+    threshold : float, spike detection threshold (mV)
+    t_eval : ndarray or None, times at which to return the solution
+        (None: the time steps taken by the solver)
+
+    Returns
+    -------
+    result : dict with
+        't' : ndarray, output times (ms)
+        'Vm' : ndarray, membrane potential at the output times (mV)
+        'I' : ndarray, input current at the output times (uA/cm2)
+        'spike_times' : ndarray, times of upward threshold crossings (ms)
+        'nsteps' : int, number of solver steps
+        'nfev' : int, number of right hand side evaluations
+    '''
+    Vm = p['V_rest']
+    y0 = [Vm,
+          alpha_m(Vm) / (alpha_m(Vm) + beta_m(Vm)),
+          alpha_h(Vm) / (alpha_h(Vm) + beta_h(Vm)),
+          alpha_n(Vm) / (alpha_n(Vm) + beta_n(Vm))]
+
+    def spike(t, y, I, p):
+        return y[0] - threshold
+    spike.direction = 1
+
+    ## piecewise constant input: integrate each interval separately
+    breaks = [min(t, p['T']) for t in
+              [0., p['t_stim_on'], p['t_stim_off'], p['T']]]
+    currents = [0., p['I_amp'], 0.]
+
+    ts, Vs, Is, spike_times = [], [], [], []
+    nsteps, nfev = 0, 0
+    for (t0, t1), I in zip(zip(breaks[:-1], breaks[1:]), currents):
+        if t1 <= t0:
+            continue
+        sol = solve_ivp(_rhs, (t0, t1), y0, method=method, rtol=rtol,
+                        atol=atol, events=spike, args=(I, p),
+                        dense_output=True)
+        if t_eval is None:
+            ## solver steps, without repeating the interval start point
+            t = sol.t if not ts else sol.t[1:]
+        else:
+            t = t_eval[(t_eval >= t0) & ((t_eval < t1) | (t1 == p['T']))]
+        ts.append(t)
+        Vs.append(sol.sol(t)[0])
+        Is.append(np.full(t.size, I))
+        spike_times.append(sol.t_events[0])
+        nsteps += sol.t.size - 1
+        nfev += sol.nfev
+        y0 = sol.y[:, -1]
+
+    return {'t': np.concatenate(ts),
+            'Vm': np.concatenate(Vs),
+            'I': np.concatenate(Is),
+            'spike_times': np.concatenate(spike_times),
+            'nsteps': nsteps,
+            'nfev': nfev}
+
+
+def _spike_times_euler(p, dt, threshold=0.):
+    '''
+    spike times of the forward Euler simulation, linearly interpolated
+    between the time steps around each upward crossing of threshold (mV)
+    '''
+    result = simulate_batch(p, dt=dt)
+    t, Vm = result['time'], result['Vm']
+    i = np.flatnonzero((Vm[:-1] < threshold) & (Vm[1:] >= threshold))
+    return t[i] + dt * (threshold - Vm[i]) / (Vm[i + 1] - Vm[i])
+
+
+if __name__ == '__main__':
+    p = set_parameters()
+    threshold = 0.
+
+    ## converged reference: an explicit high order solver at a tight
+    ## tolerance, checked against Richardson extrapolated forward Euler
+    reference = simulate_adaptive(p, method='DOP853', rtol=1e-12,
+                                  atol=1e-14, threshold=threshold,
+                                  t_eval=p['time'])
+    ref = reference['spike_times']
+    richardson = 2 * _spike_times_euler(p, 0.0005, threshold) \
+        - _spike_times_euler(p, 0.001, threshold)
+    print('reference (DOP853, rtol=1e-12) vs Richardson extrapolated Euler '
+          '(dt=0.001/0.0005): {:.1e} ms'.format(
+              np.abs(richardson - ref).max()))
+
+    ## the exercise's loop at its dt and at smaller dt
+    for dt in [p['dt'], 0.005, 0.001]:
+        p_dt = dict(p, dt=dt, time=np.arange(0, p['T'] + dt, dt))
+        t0 = time.time()
+        _simulate_loop(p_dt)
+        t_loop = time.time() - t0
+        euler = _spike_times_euler(p, dt=dt, threshold=threshold)
+        print('forward Euler loop (exercise), dt={}: {:.3f} s, {} steps, '
+              'spike times error vs reference: {:.2e} ms'.format(
+                  dt, t_loop, p_dt['time'].size - 1,
+                  np.abs(euler - ref).max()))
+    err_euler = np.abs(euler - ref).max()
+    t_step = t_loop / (p_dt['time'].size - 1)
+
+    for rtol in [1e-4, 1e-6, 1e-8]:
+        t0 = time.time()
+        result = simulate_adaptive(p, rtol=rtol, atol=rtol * 1e-2,
+                                   threshold=threshold)
+        t_adaptive = time.time() - t0
+        err = np.abs(result['spike_times'] - ref).max() \
+            if result['spike_times'].size == ref.size else np.inf
+        ## the Euler error is first order in dt
+        dt_equal = 0.001 * err / err_euler
+        print('adaptive LSODA, rtol={:.0e}: {:.3f} s, {} steps, '
+              'spike times error vs reference: {:.2e} ms; Euler loop of the '
+              'same error: dt={:.1e} ms, {:.1f} s (extrapolated)'.format(
+                  rtol, t_adaptive, result['nsteps'], err, dt_equal,
+                  t_step * p['T'] / dt_equal))
+
+    ## voltage trace on the exercise time grid
+    result = simulate_adaptive(p, t_eval=p['time'])
+    Vm_euler = simulate_batch(p)['Vm']
+    print('max |Vm - reference| on the exercise grid: adaptive {:.2f} mV, '
+          'Euler dt=0.025 {:.2f} mV'.format(
+              np.abs(result['Vm'] - reference['Vm']).max(),
+              np.abs(Vm_euler - reference['Vm']).max()))
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+'''
+Population-batched Hodgkin-Huxley engine for Exercise 3.
+
+The model and the parameter dictionary are those of the exercise
+(set_parameters / derived_parameters), but a whole batch of neurons is
+advanced per time step as NumPy arrays. Each neuron in the batch can have
+its own input amplitude I_amp, gbar_Na, gbar_K and temperature. The rate
+functions are evaluated in closed form on arrays instead of through the
+lambdas in p, and the stimulus is built without a per-sample loop.
+
+Two integration schemes are available:
+
+    'euler'     forward Euler, identical to update() in the exercise
+    'expeuler'  exponential Euler: the gates and the membrane potential are
+                advanced exactly for frozen rates and conductances, which is
+                stable for much larger time steps than forward Euler
+
+Temperature enters through the usual Q10 factor 3**((celsius - 6.3) / 10)
+on all rates; the default celsius=6.3 gives the rates of the exercise.
+Example usage:
+
+    p = set_parameters()
+    I_amps = np.linspace(0, 20, 1000)
+    rates = fi_curve(p, I_amps)
+
+Run this file for a comparison with the single neuron simulation and a
+timing benchmark.
+'''
+import time
+import numpy as np
+
+
+def alpha_n(v):
+    x = v + 55.
+    safe = np.where(x == 0, 1., x)
+    return np.where(x == 0, 0.1, 0.01 * safe / (1. - np.exp(-safe / 10.)))
+
+
+def beta_n(v):
+    return 0.125 * np.exp(-(v + 65.) / 80.)
+
+
+def alpha_m(v):
+    x = v + 40.
+    safe = np.where(x == 0, 1., x)
+    return np.where(x == 0, 1., 0.1 * safe / (1. - np.exp(-safe / 10.)))
+
+
+def beta_m(v):
+    return 4. * np.exp(-(v + 65.) / 18.)
+
+
+def alpha_h(v):
+    return 0.07 * np.exp(-(v + 65.) / 20.)
+
+
+def beta_h(v):
+    return 1. / (1. + np.exp(-(v + 35.) / 10.))
+
+
+def stimulus(p, I_amp=None):
+    '''
+    Array of input currents (uA/cm2) for the time array p['time'], built
+    without a loop. If I_amp is an array of amplitudes, the result has shape
+    (len(I_amp), len(p['time'])).
+    '''
+    if I_amp is None:
+        I_amp = p['I_amp']
+    on = (p['t_stim_on'] <= p['time']) & (p['time'] <= p['t_stim_off'])
+    return np.multiply.outer(I_amp, on.astype(float))
+
+
+def simulate_batch(p, I_amp=None, gbar_Na=None, gbar_K=None, celsius=6.3,
+                   method='euler', dt=None, record=True, threshold=0.):
+    '''
+    Simulate a batch of HH neurons.
+
+    Parameters
+    ----------
+    p : dict, parameter dictionary from set_parameters()
+    I_amp, gbar_Na, gbar_K, celsius : float or array_like, values for each
+        neuron (None: value from p). Arrays are broadcast against each other
+        and define the shape of the batch.
+    method : str, 'euler' or 'expeuler'
+    dt : float or None, time step (None: p['dt'])
+    record : bool, return the membrane potential of all neurons
+    threshold : float, spike detection threshold (mV)
+
+    Returns
+    -------
+    result : dict with
+        'time' : ndarray, time array (ms)
+        'Vm' : ndarray, membrane potentials of shape batch shape + (len(time),)
+            (only if record is True)
+        'spike_count' : ndarray, number of upward threshold crossings
+        'spike_times' : list of ndarray, spike times of each neuron in the
+            order of the flattened batch
+    '''
+    if method not in ('euler', 'expeuler'):
+        raise ValueError("method must be 'euler' or 'expeuler'")
+    dt = p['dt'] if dt is None else dt
+    I_amp, gNa, gK, celsius = np.broadcast_arrays(
+        np.asarray(p['I_amp'] if I_amp is None else I_amp, dtype=float),
+        np.asarray(p['gbar_Na'] if gbar_Na is None else gbar_Na, dtype=float),
+        np.asarray(p['gbar_K'] if gbar_K is None else gbar_K, dtype=float),
+        np.asarray(celsius, dtype=float))
+    shape = I_amp.shape
+    I_amp, gNa, gK = I_amp.ravel(), gNa.ravel(), gK.ravel()
+    phi = 3.**((celsius.ravel() - 6.3) / 10.)
+
+    time_arr = np.arange(0, p['T'] + dt, dt)
+    on = (p['t_stim_on'] <= time_arr) & (time_arr <= p['t_stim_off'])
+    gl, Cm = p['gbar_l'], p['Cm']
+    E_Na, E_K, E_l = p['E_Na'], p['E_K'], p['E_l']
+
+    ## initial conditions at rest
+    Vm = np.full(I_amp.shape, p['V_rest'], dtype=float)
+    m = alpha_m(Vm) / (alpha_m(Vm) + beta_m(Vm))
+    h = alpha_h(Vm) / (alpha_h(Vm) + beta_h(Vm))
+    n = alpha_n(Vm) / (alpha_n(Vm) + beta_n(Vm))
+
+    if record:
+        V_rec = np.empty((I_amp.size, time_arr.size))
+        V_rec[:, 0] = Vm
+    spike_count = np.zeros(I_amp.shape, dtype=int)
+    spike_steps = []
+    spike_neurons = []
+
+    for i in range(1, time_arr.size):
+        I = I_amp if on[i - 1] else 0.
+        g_Na = gNa * m**3 * h
+        g_K = gK * n**4
+        am, bm = phi * alpha_m(Vm), phi * beta_m(Vm)
+        ah, bh = phi * alpha_h(Vm), phi * beta_h(Vm)
+        an, bn = phi * alpha_n(Vm), phi * beta_n(Vm)
+        if method == 'euler':
+            m = m + (am * (1 - m) - bm * m) * dt
+            h = h + (ah * (1 - h) - bh * h) * dt
+            n = n + (an * (1 - n) - bn * n) * dt
+            V_new = Vm + (I - g_Na * (Vm - E_Na) - g_K * (Vm - E_K)
+                          - gl * (Vm - E_l)) / Cm * dt
+        else:
+            m = am / (am + bm) + (m - am / (am + bm)) * np.exp(-(am + bm) * dt)
+            h = ah / (ah + bh) + (h - ah / (ah + bh)) * np.exp(-(ah + bh) * dt)
+            n = an / (an + bn) + (n - an / (an + bn)) * np.exp(-(an + bn) * dt)
+            g_tot = g_Na + g_K + gl
+            V_inf = (I + g_Na * E_Na + g_K * E_K + gl * E_l) / g_tot
+            V_new = V_inf + (Vm - V_inf) * np.exp(-g_tot / Cm * dt)
+        crossing = (Vm < threshold) & (V_new >= threshold)
+        if crossing.any():
+            spike_count += crossing
+            idx = np.flatnonzero(crossing)
+            spike_neurons.append(idx)
+            spike_steps.append(np.full(idx.size, i))
+        Vm = V_new
+        if record:
+            V_rec[:, i] = Vm
+
+    if spike_neurons:
+        spike_neurons = np.concatenate(spike_neurons)
+        spike_steps = np.concatenate(spike_steps)
+    else:
+        spike_neurons = np.zeros(0, dtype=int)
+        spike_steps = np.zeros(0, dtype=int)
+    order = np.argsort(spike_neurons, kind='stable')
+    spike_times = np.split(time_arr[spike_steps[order]],
+                           np.cumsum(spike_count)[:-1])
+
+    result = {'time': time_arr,
+              'spike_count': spike_count.reshape(shape),
+              'spike_times': spike_times}
+    if record:
+        result['Vm'] = V_rec.reshape(shape + (time_arr.size,))
+    return result
+
+
+def fi_curve(p, I_amps, **kwargs):
+    '''
+    Firing rate (spikes / s) during the stimulus for each amplitude in
+    I_amps. Additional keyword arguments are passed on to simulate_batch
+    and may hold arrays broadcastable against I_amps.
+    '''
+    kwargs['record'] = False
+    result = simulate_batch(p, I_amp=I_amps, **kwargs)
+    duration = (p['t_stim_off'] - p['t_stim_on']) / 1000.
+    return result['spike_count'] / duration
+
+
+def find_threshold(p, I_min=0., I_max=20., tol=0.01, **kwargs):
+    '''
+    Smallest input amplitude (uA/cm2) giving at least one spike, found by
+    bisection for all conditions in parallel. gbar_Na, gbar_K and celsius
+    may be given as arrays in kwargs; the result has their broadcast shape.
+    Conditions that do not spike at I_max are returned as NaN.
+    '''
+    kwargs['record'] = False
+    shape = np.broadcast(*[np.asarray(kwargs.get(key, 0.))
+                           for key in ('gbar_Na', 'gbar_K', 'celsius')]).shape
+    lo = np.full(shape, I_min, dtype=float)
+    hi = np.full(shape, I_max, dtype=float)
+    spikes_hi = simulate_batch(p, I_amp=hi, **kwargs)['spike_count'] > 0
+    while np.max(hi - lo) > tol:
+        mid = 0.5 * (lo + hi)
+        spikes = simulate_batch(p, I_amp=mid, **kwargs)['spike_count'] > 0
+        hi = np.where(spikes, mid, hi)
+        lo = np.where(spikes, lo, mid)
+    return np.where(spikes_hi, hi, np.nan)
+
+
+def set_parameters():
+    '''
+    parameters of the exercise (simulation, stimulus and neuron)
+    '''
+    p = {}
+    p['T'] = 50.
+    p['dt'] = 0.025
+    p['I_amp'] = 10.
+    p['t_stim_on'] = 5.
+    p['t_stim_off'] = 30
+    p['V_rest'] = -65.
+    p['Cm'] = 1.
+    p['gbar_Na'] = 120.
+    p['gbar_K'] = 36.
+    p['gbar_l'] = 0.3
+    p['E_Na'] = 50.
+    p['E_K'] = -77.
+    p['E_l'] = -54.387
+    p['time'] = np.arange(0, p['T'] + p['dt'], p['dt'])
+    return p
+
+
+def _simulate_loop(p):
+    '''
+    single neuron reference implementation from the exercise
+    '''
+    Vm = np.zeros(len(p['time']))
+    Vm[0] = p['V_rest']
+    v = p['V_rest']
+    m = alpha_m(v) / (alpha_m(v) + beta_m(v))
+    h = alpha_h(v) / (alpha_h(v) + beta_h(v))
+    n = alpha_n(v) / (alpha_n(v) + beta_n(v))
+    I = np.zeros(len(p['time']))
+    for i, t in enumerate(p['time']):
+        if p['t_stim_on'] <= t <= p['t_stim_off']:
+            I[i] = p['I_amp']
+    for i in range(1, len(p['time'])):
+        v = Vm[i - 1]
+        g_Na = p['gbar_Na'] * m**3 * h
+        g_K = p['gbar_K'] * n**4
+        m += (alpha_m(v) * (1 - m) - beta_m(v) * m) * p['dt']
+        h += (alpha_h(v) * (1 - h) - beta_h(v) * h) * p['dt']
+        n += (alpha_n(v) * (1 - n) - beta_n(v) * n) * p['dt']
+        Vm[i] = v + (I[i - 1] - g_Na * (v - p['E_Na']) - g_K * (v - p['E_K'])
+                     - p['gbar_l'] * (v - p['E_l'])) / p['Cm'] * p['dt']
+    return Vm
+
+
+if __name__ == '__main__':
+    p = set_parameters()
+
+    Vm_ref = _simulate_loop(p)
+    Vm = simulate_batch(p)['Vm']
+    print('max |batch - loop| for one neuron: {:.2e} mV'.format(
+        np.abs(Vm - Vm_ref).max()))
+
+    ## f-I curves for 1000 currents x 4 temperatures
+    I_amps = np.linspace(0, 50, 1000)
+    celsius = np.array([6.3, 10., 15., 20.])[:, None]
+    t0 = time.time()
+    rates = fi_curve(p, I_amps, celsius=celsius)
+    t_euler = time.time() - t0
+    t0 = time.time()
+    rates_exp = fi_curve(p, I_amps, celsius=celsius, method='expeuler',
+                         dt=0.1)
+    t_exp = time.time() - t0
+    print('f-I curves for {} conditions: euler dt=0.025 {:.2f} s, '
+          'expeuler dt=0.1 {:.2f} s'.format(rates.size, t_euler, t_exp))
+
+    ## accuracy against forward Euler with a fine time step
+    I_amps = np.linspace(0, 50, 200)
+    ref = fi_curve(p, I_amps, celsius=celsius, dt=0.002)
+    for method, dt in [('euler', 0.025), ('expeuler', 0.025),
+                       ('expeuler', 0.1)]:
+        rates = fi_curve(p, I_amps, celsius=celsius, method=method, dt=dt)
+        err = np.abs(rates - ref).max(axis=1) * (p['t_stim_off']
+                                                 - p['t_stim_on']) / 1000.
+        print('{} dt={}: max spike count error {}'.format(
+            method, dt, ', '.join('{:g} at {:g} C'.format(e, c) for e, c
+                                  in zip(err, celsius.ravel()))))
+
+    ## threshold current over a grid of conductances
+    gbar_Na = np.linspace(60, 180, 30)[:, None]
+    gbar_K = np.linspace(18, 54, 30)[None, :]
+    t0 = time.time()
+    I_th = find_threshold(p, gbar_Na=gbar_Na, gbar_K=gbar_K,
+                          method='expeuler', dt=0.05)
+    print('threshold search for {} conductance pairs: {:.2f} s, '
+          'I_th = {:.2f} uA/cm2 at default conductances'.format(
+              I_th.size, time.time() - t0,
+              float(find_threshold(p, method='expeuler', dt=0.05))))
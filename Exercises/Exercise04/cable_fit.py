@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+'''
+Fast fitting of the passive ball-and-stick model of Exercise 4 to the
+"experimental" soma recording in exp_t.npy / exp_v.npy.
+
+The somatic response to a current step injected in the soma is computed
+semi-analytically: the input impedance of an isopotential soma attached to
+a finite cable with a sealed end is known in closed form in the Laplace
+domain,
+
+    Z(s) = 1 / (A_soma y(s) + tanh(gamma(s) L) gamma(s) / r_a),
+    y(s) = 1 / Rm + s Cm,  gamma(s) = sqrt(pi d y(s) r_a),
+    r_a = 4 Ra / (pi d^2),
+
+and the step response Z(s) / s is transformed back to the time domain by
+numerical inverse Laplace transform (fixed Talbot method). This is
+vectorized over time points and over any number of candidate parameter
+sets, so thousands of candidates are evaluated in one call. For models
+without a closed form solution, NeuronBallAndStick runs the same model in
+NEURON, building the sections once and only changing parameters between
+runs. Example usage:
+
+    t = np.load('exp_t.npy')
+    v = np.load('exp_v.npy')
+    best, rmse = fit(t, v, fixed={'Ra': 100.})
+
+Run this file to fit the exercise data and compare with NEURON.
+'''
+import time
+import numpy as np
+from scipy.optimize import least_squares
+from scipy.interpolate import CubicSpline
+
+# parameters that can be fitted, with default bounds
+PARAM_NAMES = ['Rm', 'Cm', 'Ra', 'L', 'diam']
+DEFAULT_BOUNDS = {'Rm': (1e3, 1e5),     # membrane resistance (Ohm cm2)
+                  'Cm': (0.3, 3.),      # membrane capacitance (uF/cm2)
+                  'Ra': (30., 300.),    # axial resistivity (Ohm cm)
+                  'L': (100., 3000.),   # dendrite length (um)
+                  'diam': (0.5, 5.)}    # dendrite diameter (um)
+# a somatic recording does not constrain Ra and diam separately, Ra is
+# fixed to the value of the exercise unless given otherwise
+DEFAULT_FIXED = {'Ra': 100.}
+# fixed soma and stimulus parameters of the exercise
+SOMA = {'soma_L': 15., 'soma_diam': 15.}
+STIM = {'amp': 0.005, 'delay': 10., 'e_pas': -65.}
+
+
+def ball_and_stick_impedance(s, Rm, Cm, Ra, L, diam, soma_L=15.,
+                             soma_diam=15.):
+    '''
+    Input impedance (MOhm) at the soma of the ball-and-stick model for
+    complex frequencies s (1/ms). All parameters may be arrays that
+    broadcast against s.
+    '''
+    y = 1. / Rm + s * Cm * 1e-3             # membrane admittance (S/cm2)
+    A_soma = np.pi * soma_diam * soma_L * 1e-8  # cm2
+    d = diam * 1e-4                         # cm
+    r_a = 4. * Ra / (np.pi * d**2)          # Ohm/cm
+    gamma = np.sqrt(np.pi * d * y * r_a)    # 1/cm
+    Y = A_soma * y + np.tanh(gamma * L * 1e-4) * gamma / r_a
+    return 1e-6 / Y
+
+
+def _talbot_step(tau, M, params, soma):
+    '''
+    inverse Laplace transform of Z(s) / s at the times tau > 0 (fixed Talbot
+    method), vectorized over candidate parameters
+    '''
+    tau = tau[:, None]
+    k = np.arange(1, M)
+    theta = k * np.pi / M
+    cot = 1. / np.tan(theta)
+    r = 2. * M / (5. * tau)
+    s = r * theta * (cot + 1j)
+    sigma = theta + (theta * cot - 1.) * cot
+
+    F0 = ball_and_stick_impedance(r, *params, **soma) / r
+    Fk = ball_and_stick_impedance(s, *params, **soma) / s
+    total = 0.5 * (F0 * np.exp(r * tau))[..., 0] \
+        + np.sum(np.real(np.exp(tau * s) * Fk * (1. + 1j * sigma)), axis=-1)
+    return r[:, 0] / M * total
+
+
+def step_response(t, Rm, Cm, Ra, L, diam, amp=0.005, delay=10., e_pas=-65.,
+                  M=24, n_eval=100, **soma):
+    '''
+    Somatic membrane potential (mV) for a current step of amplitude amp (nA)
+    switched on at delay (ms), at the times t. Parameters may be arrays of
+    candidate values of equal shape; the result then has shape
+    parameter shape + t.shape.
+
+    The inverse Laplace transform is evaluated at n_eval logarithmically
+    spaced times after the onset and interpolated (cubic spline in log time)
+    onto t, which keeps the cost per candidate independent of len(t). Set
+    n_eval=None to evaluate directly at all times in t.
+    '''
+    params = [np.asarray(x, dtype=float)[..., None, None]
+              for x in (Rm, Cm, Ra, L, diam)]
+    t = np.asarray(t, dtype=float)
+    tau = t - delay
+    on = tau > 0
+    shape = np.broadcast(*params).shape[:-2] + t.shape
+    v = np.zeros(shape)
+    if not on.any():
+        return e_pas + v
+    tau_on = tau[on]
+    if n_eval is None or tau_on.size <= n_eval:
+        v[..., on] = _talbot_step(tau_on, M, params, soma)
+    else:
+        ## tau_on.min() may be tiny, start the grid slightly below it
+        log_tau = np.linspace(np.log(tau_on.min()) - 1e-3,
+                              np.log(tau_on.max()) + 1e-3, n_eval)
+        v_eval = _talbot_step(np.exp(log_tau), M, params, soma)
+        v[..., on] = CubicSpline(log_tau, v_eval, axis=-1)(np.log(tau_on))
+    return e_pas + amp * v
+
+
+class NeuronBallAndStick(object):
+    '''
+    Ball-and-stick model in NEURON that is built once and reused for every
+    parameter set: the sections, current clamp and recording vectors are
+    created in the constructor, and simulate() only updates parameters.
+    The traces have the model's own time step dt and duration tstop; pass
+    t to simulate() to interpolate them onto other recording times.
+    '''
+    def __init__(self, amp=0.005, delay=10., e_pas=-65., dt=2**-3,
+                 tstop=200., soma_L=15., soma_diam=15.):
+        import neuron
+        self.h = h = neuron.h
+        h.load_file('stdrun.hoc')
+        self.soma = h.Section(name='soma')
+        self.soma.L = soma_L
+        self.soma.diam = soma_diam
+        self.soma.nseg = 1
+        self.dend = h.Section(name='dend')
+        self.dend.connect(self.soma, 1, 0)
+        for sec in (self.soma, self.dend):
+            sec.insert('pas')
+            sec.e_pas = e_pas
+        self.stim = h.IClamp(self.soma(0.5))
+        self.stim.delay = delay
+        self.stim.amp = amp
+        self.stim.dur = 1e9
+        self.v = h.Vector()
+        self.v.record(self.soma(0.5)._ref_v)
+        self.t = h.Vector()
+        self.t.record(h._ref_t)
+        self.e_pas = e_pas
+        self.dt = dt
+        self.tstop = tstop
+
+    def simulate(self, Rm, Cm, Ra, L, diam, t=None):
+        '''
+        return the somatic membrane potential for one parameter set, at the
+        times t (None: at the time steps of the model)
+        '''
+        if t is not None and (np.min(t) < 0 or np.max(t) > self.tstop):
+            raise ValueError('t must lie within [0, tstop={}]'.format(
+                self.tstop))
+        h = self.h
+        self.dend.L = L
+        self.dend.diam = diam
+        self.dend.nseg = max(1, int(L / 10))
+        for sec in (self.soma, self.dend):
+            sec.Ra = Ra
+            sec.cm = Cm
+            for seg in sec:
+                seg.g_pas = 1. / Rm
+        h.dt = self.dt
+        h.finitialize(self.e_pas)
+        h.continuerun(self.tstop)
+        if t is None:
+            return np.array(self.v)
+        return np.interp(t, np.array(self.t), np.array(self.v))
+
+    def simulate_batch(self, Rm, Cm, Ra, L, diam, t=None):
+        '''
+        return the somatic membrane potential for arrays of parameter sets
+        '''
+        params = np.broadcast_arrays(Rm, Cm, Ra, L, diam)
+        return np.array([self.simulate(*p, t=t) for p in
+                         zip(*[np.ravel(x) for x in params])])
+
+
+def _to_params(x, names, fixed):
+    '''
+    map log-parameter vector (last axis) to a dict of parameter arrays
+    '''
+    params = dict(fixed)
+    for i, name in enumerate(names):
+        params[name] = np.exp(x[..., i])
+    return params
+
+
+def fit(t, v, bounds=None, fixed=None, n_candidates=2000, seed=1234,
+        stim=STIM, soma=SOMA, neuron_model=None):
+    '''
+    Fit the passive ball-and-stick parameters to the somatic voltage trace v
+    recorded at times t.
+
+    A batch of n_candidates random parameter sets (uniform in log-space
+    within bounds) is evaluated in one vectorized call, and the best
+    candidate is refined by least squares, all using the semi-analytical
+    step response. Note that a somatic recording constrains Ra and diam
+    only through the cable admittance and length constant, so one of them
+    is fixed (by default Ra, see DEFAULT_FIXED). If neuron_model (a NeuronBallAndStick object) is given,
+    candidates are instead simulated with that reused NEURON model; use
+    fewer candidates then.
+
+    Parameters
+    ----------
+    t, v : ndarray, time (ms) and somatic membrane potential (mV)
+    bounds : dict or None, (lower, upper) bounds of the fitted parameters
+        (None: DEFAULT_BOUNDS)
+    fixed : dict or None, parameters with fixed values that are not fitted
+        (None: DEFAULT_FIXED; pass {} to fit all parameters)
+    n_candidates : int, number of candidates in the initial batch
+    seed : int, seed of the candidate generator
+    stim, soma : dict, stimulus and soma parameters
+    neuron_model : NeuronBallAndStick or None, NEURON model used instead of
+        the semi-analytical solution
+
+    Returns
+    -------
+    best : dict, best-fit parameters
+    rmse : float, root mean square error of the fit (mV)
+    '''
+    bounds = dict(DEFAULT_BOUNDS if bounds is None else bounds)
+    fixed = dict(DEFAULT_FIXED if fixed is None else fixed)
+    names = [name for name in PARAM_NAMES if name not in fixed]
+    lower = np.log([bounds[name][0] for name in names])
+    upper = np.log([bounds[name][1] for name in names])
+
+    def model(x):
+        params = _to_params(x, names, fixed)
+        if neuron_model is not None:
+            v_nrn = neuron_model.simulate_batch(*[params[name] for name
+                                                  in PARAM_NAMES], t=t)
+            return v_nrn.reshape(x.shape[:-1] + v_nrn.shape[-1:])
+        return step_response(t, **params, **stim, **soma)
+
+    ## batched evaluation of random candidates, in chunks to bound memory
+    rng = np.random.default_rng(seed)
+    x = lower + (upper - lower) * rng.random((n_candidates, len(names)))
+    sse = np.concatenate([np.sum((model(chunk) - v)**2, axis=-1)
+                          for chunk in np.array_split(x, max(1, x.shape[0]
+                                                             // 200))])
+    x0 = x[np.nanargmin(sse)]
+
+    ## local refinement
+    result = least_squares(lambda x: model(x) - v, x0, bounds=(lower, upper),
+                           x_scale=1., diff_step=1e-4)
+    best = {name: float(np.exp(result.x[i])) for i, name in enumerate(names)}
+    best.update(fixed)
+    rmse = float(np.sqrt(np.mean(result.fun**2)))
+    return best, rmse
+
+
+if __name__ == '__main__':
+    t = np.load('exp_t.npy')
+    v = np.load('exp_v.npy')
+
+    t0 = time.time()
+    best, rmse = fit(t, v, fixed={'Ra': 100.})
+    print('analytical fit in {:.2f} s, rmse {:.4f} mV'.format(
+        time.time() - t0, rmse))
+    print(', '.join('{}={:.4g}'.format(name, best[name])
+                    for name in PARAM_NAMES))
+
+    ## compare with NEURON for the best-fit parameters
+    model = NeuronBallAndStick()
+    t0 = time.time()
+    v_nrn = model.simulate(t=t, **{name: best[name]
+                                   for name in PARAM_NAMES})
+    t_nrn = time.time() - t0
+    v_ana = step_response(t, **{name: best[name] for name in PARAM_NAMES})
+    print('rmse NEURON vs data {:.4f} mV, analytical vs NEURON {:.4f} mV'
+          .format(np.sqrt(np.mean((v_nrn - v)**2)),
+                  np.sqrt(np.mean((v_nrn - v_ana)**2))))
+
+    n = 1000
+    t0 = time.time()
+    step_response(t, *[np.full(n, best[name]) for name in PARAM_NAMES])
+    print('time per candidate: analytical {:.2e} s, NEURON {:.2e} s'.format(
+        (time.time() - t0) / n, t_nrn))
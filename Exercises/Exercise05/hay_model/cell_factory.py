@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+'''
+Reusable Hay model for synapse position sweeps.
+
+return_cell() in Exercise 5 deletes all sections, re-reads cell1.hoc and
+re-applies the biophysics for every synapse position. HayCellFactory loads
+and configures the model once per conductance type, and for each sweep
+point only creates the synapse (an ExpSyn with a NetCon at the new
+position, with the new weight and spike times) for the simulation. The
+synapse is a plain NEURON object that LFPy does not manage, so only the
+public LFPy.Cell API is used (tested with LFPy 2.3). The NEURON
+mechanisms in hay_model/mod are compiled (once) and loaded with
+neuron_tools.load_mechanisms. Example usage:
+
+    factory = HayCellFactory()
+    for dist in np.linspace(0, 1200, 5):
+        cell = factory.simulate(synaptic_y_pos=dist, conductance_type='active')
+        plt.plot(cell.tvec, cell.vmem[0])
+
+The returned objects hold copies of the recorded data (tvec, somav, vmem,
+imem, synapse current) and the geometry (x, y, z, synidx), so they can be
+used with the plotting functions of the exercise.
+'''
+import os
+import sys
+import time
+import warnings
+import numpy as np
+import neuron
+import LFPy
+if __name__ == '__main__':
+    # run as a script: the repository root, for neuron_tools
+    sys.path.insert(0, os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir,
+        os.pardir))
+from hay_model.hay_biophysics import active_declarations, load_mechanisms
+from neuron_tools.morphology_cache import CachedCell
+h = neuron.h
+
+model_path = os.path.dirname(os.path.abspath(__file__))
+
+if not LFPy.__version__.startswith('2.'):
+    warnings.warn('cell_factory is tested with LFPy 2.3, found LFPy {}'
+                  .format(LFPy.__version__))
+
+
+class SimulationResult(object):
+    '''
+    Recorded data and geometry of one simulation of the Hay cell
+    '''
+    def __init__(self, cell, synidx, isyn):
+        self.tvec = np.array(cell.tvec)
+        self.somav = np.array(cell.somav)
+        self.vmem = np.array(cell.vmem)
+        self.imem = np.array(cell.imem)
+        self.x = cell.x.copy()
+        self.y = cell.y.copy()
+        self.z = cell.z.copy()
+        self.totnsegs = cell.totnsegs
+        self.synidx = [synidx]
+        self.isyn = np.array(isyn)
+
+
+class HayCellFactory(object):
+    '''
+    Holds one loaded and biophysically configured Hay model and runs
+    single-synapse simulations on it.
+    '''
+    def __init__(self, v_init=-65, dt=2**-3, tstart=-200, tstop=200,
+                 lambda_f=100):
+        self.cell_parameters = {
+            'morphology': os.path.join(model_path, 'cell1.hoc'),
+            'v_init': v_init,
+            'passive': False,
+            'nsegs_method': 'lambda_f',
+            'lambda_f': lambda_f,
+            'dt': dt,
+            'tstart': tstart,
+            'tstop': tstop,
+            'custom_code': [os.path.join(model_path, 'custom_codes.hoc')],
+            'custom_fun': [active_declarations],
+        }
+        load_mechanisms(os.path.join(model_path, 'mod'))
+        self.cell = None
+        self.conductance_type = None
+
+    def get_cell(self, conductance_type='active'):
+        '''
+        Return the cell (a CachedCell) with the given conductance type,
+        loading the model only if it is not loaded already with that
+        conductance type.
+        '''
+        if self.cell is None or conductance_type != self.conductance_type:
+            self.cell = None
+            h('forall delete_section()')
+            self.cell = CachedCell(
+                custom_fun_args=[{'conductance_type': conductance_type}],
+                **self.cell_parameters)
+            self.conductance_type = conductance_type
+        return self.cell
+
+    def _simulate_synapse(self, cell, idx, weight, input_spike_train):
+        '''
+        Simulate cell with an ExpSyn on segment idx, driven by a NetCon with
+        the spike times queued at initialization (as LFPy does for its
+        synapses). The synapse only exists during the simulation: a NetCon
+        whose target lost its section (e.g. after another return_cell()
+        deleted all sections) crashes the next h.finitialize().
+        '''
+        seg = [seg for sec in cell.allseclist for seg in sec][idx]
+        syn = h.ExpSyn(seg)
+        syn.e = 0.
+        syn.tau = 10.
+        netcon = h.NetCon(None, syn)
+        netcon.weight[0] = weight
+        isyn = h.Vector()
+        isyn.record(syn._ref_i, cell.dt)
+
+        def queue_spikes():
+            for t in input_spike_train:
+                netcon.event(float(t))
+        handler = h.FInitializeHandler(queue_spikes)
+        try:
+            cell.simulate(rec_imem=True, rec_vmem=True)
+        finally:
+            del handler
+            netcon = None
+        return np.array(isyn)
+
+    def simulate(self, synaptic_y_pos=900, conductance_type='active',
+                 weight=0.001, input_spike_train=np.array([10.])):
+        '''
+        Simulate the response to a single synapse, with the same arguments
+        as return_cell() in the exercise.
+
+        Parameters
+        ----------
+        synaptic_y_pos : float, position along the apical dendrite where the
+            synapse is inserted
+        conductance_type : str, 'active' or 'passive'
+        weight : float, strength of synaptic input
+        input_spike_train : ndarray, synaptic spike times
+
+        Returns
+        -------
+        result : SimulationResult object
+        '''
+        cell = self.get_cell(conductance_type)
+        idx = cell.get_closest_idx(x=0., y=synaptic_y_pos, z=0.)
+        isyn = self._simulate_synapse(cell, idx, weight, input_spike_train)
+        return SimulationResult(cell, idx, isyn)
+
+
+_factory = None
+
+
+def return_cell(synaptic_y_pos=900, conductance_type='active', weight=0.001,
+                input_spike_train=np.array([10.])):
+    '''
+    Drop-in replacement for return_cell() in the exercise that reuses one
+    loaded Hay model for all calls.
+    '''
+    global _factory
+    if _factory is None:
+        _factory = HayCellFactory()
+    return _factory.simulate(synaptic_y_pos, conductance_type, weight,
+                             input_spike_train)
+
+
+def _return_cell_notebook(synaptic_y_pos=900, conductance_type='active',
+                          weight=0.001, input_spike_train=np.array([10.])):
+    '''
+    return_cell() of the exercise notebook, which rebuilds the model with
+    hay_active_declarations for every call
+    '''
+    from hay_model.hay_active_declarations import \
+        active_declarations as notebook_declarations
+    h('forall delete_section()')
+    load_mechanisms(os.path.join(model_path, 'mod'))
+    cell_parameters = {
+        'morphology': os.path.join(model_path, 'cell1.hoc'),
+        'v_init': -65,
+        'passive': False,
+        'nsegs_method': 'lambda_f',
+        'lambda_f': 100,
+        'dt': 2**-3,
+        'tstart': -200,
+        'tstop': 200,
+        'custom_code': [os.path.join(model_path, 'custom_codes.hoc')],
+        'custom_fun': [notebook_declarations],
+        'custom_fun_args': [{'conductance_type': conductance_type}],
+    }
+    cell = LFPy.Cell(**cell_parameters)
+    synapse_parameters = {
+        'idx': cell.get_closest_idx(x=0., y=synaptic_y_pos, z=0.),
+        'e': 0.,
+        'syntype': 'ExpSyn',
+        'tau': 10.,
+        'weight': weight,
+        'record_current': True,
+    }
+    synapse = LFPy.Synapse(cell, **synapse_parameters)
+    synapse.set_spike_times(input_spike_train)
+    cell.simulate(rec_imem=True, rec_vmem=True)
+    result = SimulationResult(cell, synapse.idx, synapse.i)
+    cell.strip_hoc_objects()
+    return result
+
+
+if __name__ == '__main__':
+    # run from the Exercise05 folder as: python -m hay_model.cell_factory
+    distances = np.linspace(0, 1200, 5)
+    for conductance_type in ['passive', 'active']:
+        t0 = time.time()
+        rebuilt = [_return_cell_notebook(dist, conductance_type)
+                   for dist in distances]
+        t_rebuild = (time.time() - t0) / len(distances)
+
+        factory = HayCellFactory()
+        factory.get_cell(conductance_type)
+        t0 = time.time()
+        reused = [factory.simulate(dist, conductance_type)
+                  for dist in distances]
+        t_reuse = (time.time() - t0) / len(distances)
+
+        err = max(np.abs(a.vmem - b.vmem).max()
+                  for a, b in zip(rebuilt, reused))
+        err_syn = max(np.abs(a.isyn - b.isyn).max()
+                      for a, b in zip(rebuilt, reused))
+        print('{}: {:.3f} s per point with the notebook return_cell, {:.3f} '
+              's per point reusing the model, max |dV| = {:.2e} mV, max '
+              '|dIsyn| = {:.2e} nA'.format(conductance_type, t_rebuild,
+                                           t_reuse, err, err_syn))
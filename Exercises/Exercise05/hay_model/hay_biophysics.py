@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+'''
+Table-driven, vectorized biophysics of the Hay model.
+
+Gives the same cells as hay_active_declarations, but instead of matching
+section names with string operations for every section, calling
+nrn.ismembrane four times per segment and running the HOC procedure
+distribute_channels (which formats and executes one HOC statement per
+segment), the section types and path distances of all segments are taken
+from the MorphologyIndex of neuron_tools. Channel densities are then
+computed as NumPy arrays from the parameter tables below, uniform values
+are written once per section and only the distance dependent densities are
+written per segment. The index is cached per morphology file and nseg, so
+configuring many cells with the same morphology (e.g. for population
+simulations) only costs the writes. Drop-in usage with LFPy:
+
+    from hay_model.hay_biophysics import active_declarations
+    cell_parameters['custom_fun'] = [active_declarations]
+    cell_parameters['custom_fun_args'] = [{'conductance_type': 'active'}]
+
+Run this file from the Exercise05 folder (python -m hay_model.hay_biophysics)
+to compare with hay_active_declarations.
+'''
+import os
+import sys
+import time
+import numpy as np
+import neuron
+if __name__ == '__main__':
+    # run as a script: the repository root, for neuron_tools
+    sys.path.insert(0, os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir,
+        os.pardir))
+from neuron_tools import load_mechanisms, MorphologyIndex
+from neuron_tools.morphology import section_type
+nrn = neuron.h
+
+SECTION_TYPES = ['soma', 'apic', 'dend', 'axon']
+
+# mechanisms and section-wide parameter values of each section type. The
+# values are the final ones of biophys_active in hay_active_declarations,
+# where the last loop over the sections sets the apical Ih density to a
+# uniform value and the apical g_pas to 0.0000467, and dend keeps the
+# default g_pas of the pas mechanism.
+ACTIVE = {
+    'soma': {
+        'mechanisms': ['pas', 'Ca_LVAst', 'Ca_HVA', 'SKv3_1', 'SK_E2',
+                       'K_Tst', 'K_Pst', 'Nap_Et2', 'NaTa_t', 'CaDynamics_E2',
+                       'Ih'],
+        'cm': 1.0, 'Ra': 100., 'e_pas': -90., 'ek': -85, 'ena': 50,
+        'gIhbar_Ih': 0.0002, 'g_pas': 0.0000338,
+        'decay_CaDynamics_E2': 460.0, 'gamma_CaDynamics_E2': 0.000501,
+        'gCa_LVAstbar_Ca_LVAst': 0.00343, 'gCa_HVAbar_Ca_HVA': 0.000992,
+        'gSKv3_1bar_SKv3_1': 0.693, 'gSK_E2bar_SK_E2': 0.0441,
+        'gK_Tstbar_K_Tst': 0.0812, 'gK_Pstbar_K_Pst': 0.00223,
+        'gNap_Et2bar_Nap_Et2': 0.00172, 'gNaTa_tbar_NaTa_t': 2.04,
+    },
+    'apic': {
+        'mechanisms': ['pas', 'Ih', 'SK_E2', 'Ca_LVAst', 'Ca_HVA', 'SKv3_1',
+                       'NaTa_t', 'Im', 'CaDynamics_E2'],
+        'cm': 2, 'Ra': 100., 'e_pas': -90., 'ek': -85, 'ena': 50,
+        'decay_CaDynamics_E2': 122, 'gamma_CaDynamics_E2': 0.000509,
+        'gSK_E2bar_SK_E2': 0.0012, 'gSKv3_1bar_SKv3_1': 0.000261,
+        'gNaTa_tbar_NaTa_t': 0.0213, 'gImbar_Im': 0.0000675,
+        'gIhbar_Ih': 0.0002, 'g_pas': 0.0000467,
+    },
+    'dend': {
+        'mechanisms': ['pas'],
+        'cm': 1.0, 'Ra': 100., 'e_pas': -90.,
+    },
+    'axon': {
+        'mechanisms': ['pas'],
+        'cm': 1.0, 'Ra': 100., 'e_pas': -90., 'g_pas': 0.0000325,
+    },
+}
+
+PASSIVE = {
+    'soma': {'mechanisms': ['pas'], 'cm': 1.0, 'Ra': 100.,
+             'g_pas': 0.0000338},
+    'apic': {'mechanisms': ['pas'], 'cm': 2, 'Ra': 100.,
+             'g_pas': 0.0000589},
+    'dend': {'mechanisms': ['pas'], 'cm': 2, 'Ra': 100.,
+             'g_pas': 0.0000467},
+    'axon': {'mechanisms': ['pas'], 'cm': 1.0, 'Ra': 100.,
+             'g_pas': 0.0000325},
+}
+
+PASSIVE_UNIFORM = {sec_type: {'mechanisms': ['pas'], 'cm': 1.0, 'Ra': 100.,
+                              'g_pas': 0.00003}
+                   for sec_type in SECTION_TYPES}
+
+# distance dependent densities, with the arguments of distribute_channels:
+# (section type, parameter, distribution type, p1, p2, p3, p4, base)
+ACTIVE_DISTRIBUTIONS = [
+    ('apic', 'gCa_LVAstbar_Ca_LVAst', 3, 1.0, 0.010, 685.0, 885.0, 0.0187),
+    ('apic', 'gCa_HVAbar_Ca_HVA', 3, 1.0, 0.10, 685.00, 885.0, 0.000555),
+]
+
+# ion currents used to make the resting potential uniform
+UNIFORM_CURRENTS = [('na_ion', 'ina'), ('k_ion', 'ik'), ('ca_ion', 'ica'),
+                    ('Ih', 'ihcn_Ih')]
+
+
+def calculate_distribution(kind, dist, p1, p2, p3, p4, base):
+    '''
+    vectorized calculate_distribution of custom_codes.hoc: kind 0 linear,
+    1 sigmoid, 2 exponential, 3 step for absolute distance (um)
+    '''
+    dist = np.asarray(dist, dtype=float)
+    if kind == 0:
+        value = p1 + dist * p2
+    elif kind == 1:
+        value = p1 + p2 / (1 + np.exp((dist - p3) / p4))
+    elif kind == 2:
+        value = p1 + p4 * np.exp(p2 * (dist - p3))
+    elif kind == 3:
+        value = np.where((dist > p3) & (dist < p4), p1, p2)
+    else:
+        raise ValueError('unknown distribution type {}'.format(kind))
+    return value * base
+
+
+def _distribution_distance(index):
+    '''
+    path distance of every segment as used by distribute_channels, which
+    evaluates the last segment of each section at the section end
+    '''
+    distance = index.distance.copy()
+    last = np.r_[index.section_idx[1:] != index.section_idx[:-1], True]
+    distance[last] = index.section_end_distance[index.section_idx[last]]
+    return distance
+
+
+def segment_index(cell):
+    '''
+    MorphologyIndex of cell.allseclist with the origin distribute_channels
+    ends up using, the 0 end of the first apical section (its
+    getLongestBranch call resets the origin). For cells loaded from a
+    morphology file the index is cached on the file and the nseg of each
+    section.
+    '''
+    sections = list(cell.allseclist)
+    origin = sections[0](0)
+    for sec in sections:
+        if section_type(sec.name()) == 'apic':
+            origin = sec(0)
+            break
+    key = None
+    if isinstance(getattr(cell, 'morphology', None), str):
+        key = (os.path.abspath(cell.morphology),
+               os.path.getmtime(cell.morphology),
+               tuple(sec.nseg for sec in sections))
+    return MorphologyIndex.from_sections(sections, origin=origin, key=key)
+
+
+def set_segment_values(segments, name, values):
+    '''
+    write one value per segment of the range variable name
+    '''
+    for seg, value in zip(segments, values):
+        setattr(seg, name, value)
+
+
+def apply_biophysics(cell, index, parameters, distributions=()):
+    '''
+    Insert mechanisms and set parameters per section type, then write the
+    distance dependent densities.
+
+    Parameters
+    ----------
+    cell : object with an allseclist, e.g. an LFPy.Cell
+    index : MorphologyIndex of cell.allseclist, see segment_index
+    parameters : dict, mechanisms and section-wide parameter values of each
+        section type, e.g. ACTIVE
+    distributions : list of tuple, distance dependent densities with the
+        arguments of distribute_channels, e.g. ACTIVE_DISTRIBUTIONS
+    '''
+    sections = list(cell.allseclist)
+    for sec, sec_type in zip(sections, index.section_types):
+        if sec_type not in parameters:
+            continue
+        params = parameters[sec_type]
+        for mechanism in params['mechanisms']:
+            sec.insert(mechanism)
+        for name, value in params.items():
+            if name != 'mechanisms':
+                setattr(sec, name, value)
+
+    if distributions:
+        segments = index.segments(sections)
+        distance = _distribution_distance(index)
+        for sec_type, name, kind, p1, p2, p3, p4, base in distributions:
+            idx = np.flatnonzero(index.mask(sec_type))
+            values = calculate_distribution(kind, distance[idx], p1, p2, p3,
+                                            p4, base)
+            set_segment_values([segments[i] for i in idx], name, values)
+
+
+def make_cell_uniform(cell, index, Vrest=-65):
+    '''
+    Set e_pas so that every segment is at rest at Vrest, as
+    make_cell_uniform in hay_active_declarations
+    '''
+    sections = list(cell.allseclist)
+    segments = index.segments(sections)
+    i_total = np.zeros(index.nsegs)
+    ## mechanisms are inserted per section type, so one section of each
+    ## type is checked (sections of other types individually)
+    keys = [sec_type if sec_type in SECTION_TYPES else sec
+            for sec, sec_type in zip(sections, index.section_types)]
+    first = {}
+    for sec, key in zip(sections, keys):
+        first.setdefault(key, sec)
+    has_current = []
+    for ion, current in UNIFORM_CURRENTS:
+        has = {key: nrn.ismembrane(ion, sec=sec) for key, sec in first.items()}
+        has = np.array([has[key] for key in keys], dtype=bool)
+        has_current.append(has[index.section_idx])
+    if any(has.any() for has in has_current):
+        nrn.t = 0
+        nrn.finitialize(Vrest)
+        nrn.fcurrent()
+        for (ion, current), has in zip(UNIFORM_CURRENTS, has_current):
+            idx = np.flatnonzero(has)
+            i_total[idx] += [getattr(segments[i], current) for i in idx]
+    g_pas = np.array([seg.g_pas for seg in segments])
+    set_segment_values(segments, 'e_pas', Vrest + i_total / g_pas)
+
+
+def biophys_active(cell, index=None):
+    index = segment_index(cell) if index is None else index
+    apply_biophysics(cell, index, ACTIVE, ACTIVE_DISTRIBUTIONS)
+    make_cell_uniform(cell, index)
+    print("active ion-channels inserted.")
+
+
+def biophys_passive(cell, index=None):
+    index = segment_index(cell) if index is None else index
+    apply_biophysics(cell, index, PASSIVE)
+    make_cell_uniform(cell, index)
+    print("Passive dynamics inserted.")
+
+
+def biophys_passive_uniform(cell, index=None):
+    index = segment_index(cell) if index is None else index
+    apply_biophysics(cell, index, PASSIVE_UNIFORM)
+    make_cell_uniform(cell, index)
+    print("Uniform passive dynamics inserted.")
+
+
+BIOPHYSICS = {'active': biophys_active,
+              'passive': biophys_passive,
+              'passive_uniform': biophys_passive_uniform}
+
+
+def active_declarations(cell, **kwargs):
+    ''' set active conductances for Hay model 2011 '''
+    nrn.delete_axon()
+    nrn.geom_nseg()
+    nrn.define_shape()
+    BIOPHYSICS[kwargs['conductance_type']](cell)
+
+
+def _range_values(cell):
+    '''
+    all range variables of all segments, for comparing two cells
+    '''
+    values = {}
+    for sec in cell.allseclist:
+        for i, seg in enumerate(sec):
+            for mech in seg:
+                for name in dir(mech):
+                    if name.startswith('_') or name == 'name':
+                        continue
+                    value = getattr(mech, name)
+                    if isinstance(value, float):
+                        values[(sec.name(), i, mech.name(), name)] = value
+            values[(sec.name(), i, 'cm')] = seg.cm
+            values[(sec.name(), i, 'diam')] = seg.diam
+        values[(sec.name(), 'Ra')] = sec.Ra
+    return values
+
+
+if __name__ == '__main__':
+    import LFPy
+    from hay_model import hay_active_declarations
+    model_path = os.path.dirname(os.path.abspath(__file__))
+    load_mechanisms(os.path.join(model_path, 'mod'))
+
+    def configure(declarations, conductance_type):
+        nrn('forall delete_section()')
+        times = []
+
+        def custom_fun(cell, **kwargs):
+            t0 = time.time()
+            declarations(cell, **kwargs)
+            times.append(time.time() - t0)
+        cell = LFPy.Cell(morphology=os.path.join(model_path, 'cell1.hoc'),
+                         v_init=-65, passive=False, nsegs_method='lambda_f',
+                         lambda_f=100, dt=2**-3, tstart=-200, tstop=200,
+                         custom_code=[os.path.join(model_path,
+                                                   'custom_codes.hoc')],
+                         custom_fun=[custom_fun],
+                         custom_fun_args=[{'conductance_type':
+                                           conductance_type}])
+        return cell, times[0]
+
+    for conductance_type in ['active', 'passive']:
+        n = 10
+        ref, t_ref = zip(*[configure(
+            hay_active_declarations.active_declarations, conductance_type)
+            for _ in range(n)])
+        ref = _range_values(ref[-1])
+        new, t_new = zip(*[configure(active_declarations, conductance_type)
+                           for _ in range(n)])
+        new = _range_values(new[-1])
+        diff = max(abs(ref[key] - new[key]) for key in ref)
+        print('{}: {:.1f} ms per cell with hay_active_declarations, {:.1f} '
+              'ms vectorized, {} values, same keys: {}, max difference '
+              '{:.1e}'.format(conductance_type, 1e3 * np.mean(t_ref),
+                              1e3 * np.mean(t_new[1:]), len(ref),
+                              ref.keys() == new.keys(), diff))
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+'''
+Impulse response (Green's function) kernels of the passive Hay model.
+
+With conductance_type='passive' the membrane potential anywhere in the cell
+is a linear function of the input currents, so the response to a synapse at
+any position can be predicted by convolving the synaptic current with the
+impulse response from the synapse segment to the recording site, instead of
+running a new NEURON simulation for every synaptic_y_pos.
+
+By reciprocity of passive cables, the response at the recording site to a
+current pulse injected in segment j equals the response in segment j to the
+same pulse injected at the recording site. The kernels from every segment to
+a recording site are therefore obtained from a single simulation, with a
+one time step current pulse at the recording site and the membrane
+potential recorded in all segments. Kernels are stored on disk, keyed by the
+model files and parameters, so they are computed only once. Example usage:
+
+    kernels = get_kernels()
+    for dist in np.linspace(0, 1200, 5):
+        cell = kernels.simulate(synaptic_y_pos=dist)
+        plt.plot(cell.tvec, cell.somav)
+
+By default the synapse is treated as a current source, with the ExpSyn
+conductance multiplied by the driving force at rest. This is accurate when
+the synaptic depolarization is small compared to the distance between the
+resting potential and the synaptic reversal potential; the exact response
+to a given current (e.g. the recorded synapse current of a full simulation)
+is obtained with response().
+
+Run this file from the Exercise05 folder (python -m hay_model.passive_kernels)
+to validate the kernels against full simulations.
+'''
+import os
+import sys
+import time
+import hashlib
+import numpy as np
+from scipy.signal import fftconvolve
+import neuron
+if __name__ == '__main__':
+    # run as a script: the repository root, for neuron_tools
+    sys.path.insert(0, os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir,
+        os.pardir))
+from hay_model.cell_factory import HayCellFactory, model_path
+h = neuron.h
+
+
+class PassiveKernels(object):
+    '''
+    Impulse response kernels from every segment of the passive Hay model to
+    a set of recording segments.
+
+    kernels[r, j, n] is the change in membrane potential (mV) at the
+    recording segment recording_idx[r], n time steps after a 1 nA current
+    in segment j during one time step. Time steps are aligned as in the
+    currents recorded by LFPy, where the current at time step k is the one
+    that moved the membrane potential from step k - 1 to step k.
+    '''
+    def __init__(self, kernels, recording_idx, dt, v_rest, x, y, z):
+        self.kernels = kernels
+        self.recording_idx = list(recording_idx)
+        self.dt = dt
+        self.v_rest = v_rest
+        self.x = x
+        self.y = y
+        self.z = z
+        self.totnsegs = kernels.shape[1]
+
+    @classmethod
+    def compute(cls, factory=None, recording_idx=(0,), t_kernel=None,
+                amp=1., delay=10.):
+        '''
+        Compute the kernels with one NEURON simulation per recording
+        segment.
+
+        Parameters
+        ----------
+        factory : HayCellFactory or None, model to use (None: default model)
+        recording_idx : list of int, recording segments (0 is the soma)
+        t_kernel : float or None, kernel duration (ms), None: the duration of
+            the cell simulation minus delay
+        amp : float, amplitude of the current pulse (nA)
+        delay : float, time of the current pulse (ms)
+        '''
+        factory = HayCellFactory() if factory is None else factory
+        cell = factory.get_cell('passive')
+        ## the IClamp current switched on at step k0 acts from step k0 + 1
+        k0 = int(round(delay / cell.dt)) + 1
+        nk = None if t_kernel is None else int(round(t_kernel / cell.dt)) + 1
+        kernels = []
+        for idx in recording_idx:
+            _simulate_pulse(cell, idx, amp, delay)
+            v_rest = cell.vmem[:, :k0].mean()
+            kernels.append((cell.vmem[:, k0:] - v_rest) / amp)
+            kernels[-1] = kernels[-1][:, :nk]
+        return cls(np.array(kernels), recording_idx, cell.dt, v_rest,
+                   cell.x.copy(), cell.y.copy(), cell.z.copy())
+
+    def save(self, filename):
+        '''
+        save the kernels to a .npz file
+        '''
+        np.savez(filename, kernels=self.kernels,
+                 recording_idx=self.recording_idx, dt=self.dt,
+                 v_rest=self.v_rest, x=self.x, y=self.y, z=self.z)
+
+    @classmethod
+    def load(cls, filename):
+        '''
+        load kernels saved with save()
+        '''
+        f = np.load(filename)
+        return cls(f['kernels'], f['recording_idx'], float(f['dt']),
+                   float(f['v_rest']), f['x'], f['y'], f['z'])
+
+    def get_closest_idx(self, x=0., y=0., z=0.):
+        '''
+        index of the segment closest to the given position, as
+        LFPy.Cell.get_closest_idx
+        '''
+        dist = ((self.x.mean(axis=-1) - x)**2 + (self.y.mean(axis=-1) - y)**2
+                + (self.z.mean(axis=-1) - z)**2)
+        return int(np.argmin(dist))
+
+    def response(self, input_idx, currents, recording=0):
+        '''
+        Membrane potential at a recording segment for input currents.
+
+        Parameters
+        ----------
+        input_idx : int or list of int, input segment of each current
+        currents : ndarray, input currents (nA, positive depolarizing),
+            shape (n_t,) for one input or (n_inputs, n_t), sampled with the
+            kernel time step
+        recording : int, position of the recording segment in recording_idx
+
+        Returns
+        -------
+        v : ndarray, membrane potential (mV), shape (n_t,)
+        '''
+        input_idx = np.atleast_1d(input_idx)
+        currents = np.atleast_2d(currents)
+        n_t = currents.shape[-1]
+        kernels = self.kernels[recording, input_idx, :n_t]
+        dv = fftconvolve(currents, kernels, axes=-1)[:, :n_t].sum(axis=0)
+        return self.v_rest + dv
+
+    def synapse_current(self, n_t, input_spike_train, weight=0.001, tau=10.,
+                        e=0.):
+        '''
+        current (nA, positive depolarizing) of an ExpSyn synapse at rest,
+        sampled at n_t time steps
+        '''
+        t = np.arange(n_t) * self.dt
+        g = np.zeros(n_t)
+        for t_spike in np.atleast_1d(input_spike_train):
+            ## the conductance jump at t_spike first acts in the next step
+            k = int(np.ceil(t_spike / self.dt - 1e-9)) + 1
+            g[k:] += weight * np.exp(-(t[k:] - t[k]) / tau)
+        return -g * (self.v_rest - e)
+
+    def simulate(self, synaptic_y_pos=900, weight=0.001,
+                 input_spike_train=np.array([10.]), tstop=200.):
+        '''
+        Predicted response to a single synapse, with the same synapse as
+        return_cell() in the exercise. Returns an object with tvec, somav,
+        synidx, isyn and vmem (only the recording segments).
+        '''
+        result = _KernelResult()
+        n_t = int(round(tstop / self.dt)) + 1
+        idx = self.get_closest_idx(x=0., y=synaptic_y_pos, z=0.)
+        i_inj = self.synapse_current(n_t, input_spike_train, weight)
+        result.tvec = np.arange(n_t) * self.dt
+        result.vmem = np.array([self.response(idx, i_inj, r)
+                                for r in range(len(self.recording_idx))])
+        result.somav = result.vmem[self.recording_idx.index(0)] \
+            if 0 in self.recording_idx else None
+        result.isyn = -i_inj
+        result.synidx = [idx]
+        result.x, result.y, result.z = self.x, self.y, self.z
+        return result
+
+
+class _KernelResult(object):
+    pass
+
+
+def _simulate_pulse(cell, idx, amp, delay):
+    '''
+    Simulate cell with a one time step current pulse in segment idx. The
+    IClamp is a plain NEURON object that only exists during the simulation,
+    as the synapse of HayCellFactory, so the cell is left without inputs.
+    '''
+    seg = [seg for sec in cell.allseclist for seg in sec][idx]
+    stim = h.IClamp(seg)
+    stim.amp = amp
+    stim.dur = cell.dt
+    stim.delay = delay
+    try:
+        cell.simulate(rec_vmem=True)
+    finally:
+        stim = None
+
+
+def _model_hash(factory, recording_idx, t_kernel):
+    '''
+    hash of the model files and parameters that determine the kernels
+    '''
+    description = []
+    for name in ['cell1.hoc', 'custom_codes.hoc',
+                 'hay_biophysics.py']:
+        with open(os.path.join(model_path, name), 'rb') as f:
+            description.append(hashlib.sha1(f.read()).hexdigest())
+    params = {key: value for key, value in factory.cell_parameters.items()
+              if key not in ('morphology', 'custom_code', 'custom_fun')}
+    description += [sorted(params.items()), list(recording_idx), t_kernel]
+    return hashlib.sha1(repr(description).encode()).hexdigest()
+
+
+def get_kernels(recording_idx=(0,), t_kernel=None, factory=None,
+                cache_dir='.kernel_cache', verbose=False):
+    '''
+    Return the PassiveKernels of the Hay model, loaded from cache_dir if
+    they were computed before with the same model and parameters, otherwise
+    computed and stored there.
+    '''
+    factory = HayCellFactory() if factory is None else factory
+    filename = os.path.join(cache_dir, _model_hash(
+        factory, recording_idx, t_kernel) + '.npz')
+    if os.path.exists(filename):
+        if verbose:
+            print('loading kernels from {}'.format(filename))
+        return PassiveKernels.load(filename)
+    kernels = PassiveKernels.compute(factory, recording_idx, t_kernel)
+    os.makedirs(cache_dir, exist_ok=True)
+    kernels.save(filename)
+    if verbose:
+        print('kernels saved to {}'.format(filename))
+    return kernels
+
+
+if __name__ == '__main__':
+    factory = HayCellFactory()
+
+    t0 = time.time()
+    kernels = PassiveKernels.compute(factory)
+    print('kernels of {} segments computed in {:.2f} s'.format(
+        kernels.totnsegs, time.time() - t0))
+
+    distances = np.linspace(0, 1200, 5)
+    t_sim = t_kernel = 0.
+    for weight in [0.001, 0.01]:
+        err_exact, err_approx, peak = [], [], []
+        for dist in distances:
+            t0 = time.time()
+            cell = factory.simulate(dist, 'passive', weight)
+            t_sim += time.time() - t0
+            t0 = time.time()
+            pred = kernels.simulate(dist, weight)
+            t_kernel += time.time() - t0
+            ## the recorded synapse current gives the exact linear response
+            exact = kernels.response(cell.synidx[0], -cell.isyn)
+            err_exact.append(np.abs(exact - cell.somav).max())
+            err_approx.append(np.abs(pred.somav - cell.somav).max())
+            peak.append(cell.somav.max() - kernels.v_rest)
+        print('weight {}: peak somatic EPSP {:.2f}-{:.2f} mV, max error with '
+              'recorded current {:.1e} mV, with current-based synapse '
+              '{:.1e} mV'.format(weight, min(peak), max(peak),
+                                 max(err_exact), max(err_approx)))
+    n = 2 * len(distances)
+    print('time per point: NEURON {:.3f} s, kernels {:.5f} s'.format(
+        t_sim / n, t_kernel / n))
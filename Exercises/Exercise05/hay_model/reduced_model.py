@@ -0,0 +1,489 @@
+#!/usr/bin/env python
+'''
+Reduced-morphology surrogate of the Hay model.
+
+The full model has about 900 segments with up to eleven mechanisms each,
+which is too expensive for network and population simulations. Reduction
+collapses each section type of the configured full model (basal dend, apic,
+axon) into one equivalent cable attached to the soma, a chain of
+single-segment sections (compartments) of about compartment_length along
+the path distance from the soma:
+
+  - the diameter of a compartment is d_eq = (sum d^2)^(1/2) over the
+    branches at that path distance, which keeps the axial resistance of the
+    branches in parallel,
+  - every full segment is assigned to the compartments it overlaps, and the
+    capacitance and conductances (cm, g_pas, g*bar) of the compartment are
+    the totals of the assigned membrane divided by the compartment area
+    (the membrane is scaled as in Bush & Sejnowski 1993), so the channel
+    densities set by biophys_active, including the Ca hot zone of the apical
+    dendrite, are reused as they are. Other parameters (e.g. decay of
+    CaDynamics_E2, ek) are area weighted means; gamma of CaDynamics_E2 is
+    divided by the membrane scale factor, so that the scaled Ca current
+    gives the same Ca concentration.
+
+calibrate() then scales the axial resistivity of the apical compartments,
+with a scale factor whose log is piecewise linear in the path distance, so
+that the attenuation to the soma from the CALIBRATION_SITES (100 to 900 um,
+including the BAC site at 620 um) matches the full model, since the
+equivalent cable only approximates the attenuation along a tree whose
+branches end at different distances. The attenuation of the reduced model
+is that of the compartment containing a site, so the compartments are 50 um
+long by default; with 100 um compartments and only two sites (300 and 620
+um) the attenuation at 450 um was off by 14%. With 25 um compartments the
+attenuation matches as well, but the backpropagating spike of a somatic
+pulse alone triggers the Ca spike, unlike in the full model. The sites
+extend into the tuft, as with a constant scale factor beyond a last site at
+620 um the fit shorted the tuft (Ra scaled by 0.005) and the attenuation at
+700 um was off by 38%; the attenuation drops little from 525 to 620 um in
+the full model, so the compartment of the BAC site still gets a small scale
+factor. e_pas is set for a uniform resting potential with make_cell_uniform
+of hay_biophysics, as in the full model. Example usage:
+
+    factory = HayCellFactory()
+    full = measure_fidelity(factory.get_cell('active'))
+    reduction = Reduction.from_cell(factory.get_cell('active'))
+    factory.cell = None
+    h('forall delete_section()')
+    reduction.calibrate(full)
+    cells = [ReducedHayCell(reduction) for _ in range(100)]
+
+measure_fidelity() measures the somatic input resistance, the attenuation
+to the soma of a current injected in the apical dendrite at the calibration
+sites and at the HELD_OUT_SITES (150 and 450 um) and the BAC firing
+signature (Hay et al. 2011: somatic spikes for a somatic pulse, a dendritic
+EPSP-shaped current and both together, and the width of the dendritic Ca
+spike) of the cell that is instantiated in NEURON, so the full and reduced
+models must not exist at the same time when it is called. compare() checks
+the differences against TOLERANCES, which leave out the attenuation at the
+calibration sites: it matches by construction, so the attenuation at the
+held-out sites is the fidelity measure of the cable reduction.
+
+Run this file from the Exercise05 folder (python -m hay_model.reduced_model)
+to reduce the active model and report speedup and fidelity.
+'''
+import os
+import re
+import sys
+import time
+import numpy as np
+from scipy.optimize import root
+import neuron
+if __name__ == '__main__':
+    # run as a script: the repository root, for neuron_tools
+    sys.path.insert(0, os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir,
+        os.pardir))
+from hay_model.hay_biophysics import make_cell_uniform
+from neuron_tools import MorphologyIndex
+from neuron_tools.morphology import section_type
+h = neuron.h
+h.load_file('stdrun.hoc')
+
+CABLES = ['dend', 'apic', 'axon']
+
+# apical path distances (um) where calibrate() fits the attenuation, and
+# where it is only measured
+CALIBRATION_SITES = (100., 225., 375., 525., 620., 700., 900.)
+HELD_OUT_SITES = (150., 450.)
+
+# EPSP amplitude (nA) of the BAC protocol, Hay et al. 2011 use 0.5 nA. In
+# the full model (run this file) 0.5 nA does not trigger a Ca spike at 620
+# um, with 0.75 nA the Ca spike adds no somatic spike, 1 nA is the smallest
+# amplitude tested that gives BAC firing (2 spikes instead of 1) while the
+# EPSP alone stays subthreshold, and with 1.25 nA the EPSP alone fires.
+BAC_EPSP_AMP = 1.
+BAC_EPSP_AMPS = (0.5, 0.75, 1., 1.25)
+
+# relative tolerances, except for the spike counts (absolute)
+TOLERANCES = {
+    'input_resistance': 0.1,
+    'attenuation_150': 0.1,
+    'attenuation_450': 0.1,
+    'spikes_soma': 0,
+    'spikes_epsp': 0,
+    'spikes_bac': 0,
+    'ca_spike_width': 0.25,
+}
+
+
+def _parameter_names(mechanism):
+    '''
+    PARAMETER range variables of a density mechanism, e.g. g_pas, e_pas
+    '''
+    standard = h.MechanismStandard(mechanism, 1)
+    name = h.ref('')
+    names = []
+    for i in range(int(standard.count())):
+        standard.name(name, i)
+        names.append(name[0])
+    return names
+
+
+def _is_conductance(name):
+    return name == 'g_pas' or re.match(r'^g\w*bar_', name) is not None
+
+
+class Reduction(object):
+    '''
+    Geometry and parameters of the reduced model: for the soma and each
+    equivalent cable the length L and the inserted mechanisms, and per
+    compartment the path distance of its center from the soma, the
+    diameter, Ra and the parameter values.
+    '''
+    def __init__(self, L, distance, diam, Ra, mechanisms, values):
+        self.L = L
+        self.distance = distance
+        self.diam = diam
+        self.Ra = Ra
+        self.mechanisms = mechanisms
+        self.values = values
+
+    @classmethod
+    def from_cell(cls, cell, compartment_length=50., samples=10):
+        '''
+        Reduce a configured full model.
+
+        Parameters
+        ----------
+        cell : LFPy.Cell or object with an allseclist, the full model
+        compartment_length : float, largest compartment length of the
+            equivalent cables (um)
+        samples : int, path distances per compartment at which the
+            equivalent diameter is evaluated and averaged
+        '''
+        sections = list(cell.allseclist)
+        soma = [sec for sec in sections if section_type(sec.name()) == 'soma']
+        origin = soma[0](0.5)
+        L, distance, diam, Ra, mechanisms, values = {}, {}, {}, {}, {}, {}
+        for sec_type in ['soma'] + CABLES:
+            secs = [sec for sec in sections
+                    if section_type(sec.name()) == sec_type]
+            if not secs:
+                continue
+            segments = [seg for sec in secs for seg in sec]
+            area = np.array([seg.area() for seg in segments])
+            if sec_type == 'soma':
+                L[sec_type] = sum(sec.L for sec in secs)
+                diam[sec_type] = np.array([area.sum() / (np.pi
+                                                         * L[sec_type])])
+                distance[sec_type] = np.zeros(1)
+                weight = np.ones((len(segments), 1))
+            else:
+                ## path distance of the segment ends from the soma center
+                start = np.concatenate([
+                    h.distance(origin, sec(0))
+                    + np.arange(sec.nseg) * sec.L / sec.nseg for sec in secs])
+                end = start + np.concatenate([np.full(sec.nseg,
+                                                      sec.L / sec.nseg)
+                                              for sec in secs])
+                seg_diam = np.array([seg.diam for seg in segments])
+                L[sec_type] = end.max() - start.min()
+                n = max(1, int(np.ceil(L[sec_type] / compartment_length)))
+                edges = np.linspace(start.min(), end.max(), n + 1)
+                distance[sec_type] = (edges[:-1] + edges[1:]) / 2
+                ## axial resistance of the parallel branches, averaged
+                ## within each compartment
+                r = (edges[:-1, None] + (np.arange(samples) + 0.5)
+                     / samples * np.diff(edges)[:, None])
+                crossing = ((start[:, None, None] <= r[None])
+                            & (end[:, None, None] > r[None]))
+                diam[sec_type] = np.sqrt(np.einsum(
+                    'i,ijk->jk', seg_diam**2, crossing).mean(axis=1))
+                ## fraction of each segment in each compartment
+                overlap = (np.minimum(end[:, None], edges[None, 1:])
+                           - np.maximum(start[:, None], edges[None, :-1]))
+                weight = np.clip(overlap, 0, None) / (end - start)[:, None]
+            n = diam[sec_type].size
+            area_reduced = np.pi * diam[sec_type] * L[sec_type] / n
+            area_full = area @ weight
+            scale = area_full / area_reduced
+
+            Ra[sec_type] = np.full(n, np.mean([sec.Ra for sec in secs]))
+            mechanisms[sec_type] = sorted(set(
+                mech.name() for seg in segments for mech in seg
+                if not mech.name().endswith('_ion')))
+            names = ['cm'] + [name for mech in mechanisms[sec_type]
+                              for name in _parameter_names(mech)]
+            names += [name for ion, name in (('k_ion', 'ek'),
+                                             ('na_ion', 'ena'))
+                      if h.ismembrane(ion, sec=secs[0])]
+            values[sec_type] = {}
+            for name in names:
+                present = np.array([hasattr(seg, name) for seg in segments])
+                full = np.array([getattr(seg, name) if has else 0.
+                                 for seg, has in zip(segments, present)])
+                if _is_conductance(name) or name == 'cm':
+                    value = (full * area) @ weight / area_reduced
+                else:
+                    a = area * present
+                    value = (full * a) @ weight / (a @ weight)
+                    if name == 'gamma_CaDynamics_E2':
+                        value = value / scale
+                values[sec_type][name] = value
+        return cls(L, distance, diam, Ra, mechanisms, values)
+
+    @property
+    def nseg(self):
+        return {sec_type: diam.size for sec_type, diam in self.diam.items()}
+
+    def calibrate(self, target, sites=CALIBRATION_SITES, tol=1e-3):
+        '''
+        Scale Ra of the apical compartments so that the attenuation from
+        each site to the soma matches target (a measure_fidelity result of
+        the full model, with the attenuation at these sites). The log of the
+        scale factor is interpolated linearly between the sites and constant
+        beyond them. The full model must not be instantiated. Returns the
+        scale factor of each apical compartment.
+        '''
+        Ra0 = self.Ra['apic'].copy()
+        names = ['attenuation_{:.0f}'.format(site) for site in sites]
+
+        def set_scale(log_scale):
+            self.Ra['apic'] = Ra0 * np.exp(np.interp(self.distance['apic'],
+                                                     sites, log_scale))
+
+        def error(log_scale):
+            set_scale(log_scale)
+            cell = ReducedHayCell(self)
+            values = [attenuation(cell.soma(0.5), apical_segment(cell, site))
+                      for site in sites]
+            del cell
+            return np.log(values) - np.log([target[name] for name in names])
+
+        solution = root(error, np.zeros(len(sites)), options={'xtol': tol})
+        set_scale(solution.x)
+        return self.Ra['apic'] / Ra0
+
+
+class _Sections(object):
+    def __init__(self, sections):
+        self.allseclist = sections
+
+
+class ReducedHayCell(object):
+    '''
+    NEURON sections of a reduced model, see the module docstring. Has an
+    allseclist, the soma section and lists of the compartments of the
+    cables dend, apic and axon (those that exist in the reduction), from
+    the soma outwards.
+    '''
+    def __init__(self, reduction, v_init=-65):
+        self.allseclist = h.SectionList()
+        for sec_type in ['soma'] + CABLES:
+            if sec_type not in reduction.diam:
+                continue
+            n = reduction.diam[sec_type].size
+            sections = []
+            for i in range(n):
+                sec = h.Section(name='{}[{}]'.format(sec_type, i), cell=self)
+                sec.L = reduction.L[sec_type] / n
+                sec.diam = reduction.diam[sec_type][i]
+                sec.Ra = reduction.Ra[sec_type][i]
+                for mechanism in reduction.mechanisms[sec_type]:
+                    sec.insert(mechanism)
+                for name, value in reduction.values[sec_type].items():
+                    setattr(sec(0.5), name, value[i])
+                if sec_type != 'soma':
+                    sec.connect(sections[-1](1) if sections
+                                else self.soma(0.5), 0)
+                sections.append(sec)
+                self.allseclist.append(sec=sec)
+            setattr(self, sec_type, sections[0] if sec_type == 'soma'
+                    else sections)
+        ## the axon of the full model has no pas mechanism
+        passive = _Sections([sec for sec in self.allseclist
+                             if h.ismembrane('pas', sec=sec)])
+        make_cell_uniform(passive, MorphologyIndex.from_sections(
+            passive.allseclist), v_init)
+
+    def __repr__(self):
+        return 'ReducedHayCell[{}]'.format(id(self))
+
+
+def apical_segment(cell, distance):
+    '''
+    apical segment at the given path distance from the soma center (the
+    thickest one, i.e. on the trunk, if there are several)
+    '''
+    sections = list(cell.allseclist)
+    origin = [sec for sec in sections if section_type(sec.name())
+              == 'soma'][0](0.5)
+    best = None
+    for sec in sections:
+        if section_type(sec.name()) != 'apic':
+            continue
+        d0 = h.distance(origin, sec(0))
+        if d0 <= distance < d0 + sec.L:
+            seg = sec((distance - d0) / sec.L)
+            if best is None or seg.diam > best.diam:
+                best = seg
+    return best
+
+
+def _run(tstop, dt, v_init):
+    h.dt = dt
+    h.finitialize(v_init)
+    h.continuerun(tstop)
+
+
+def _step_response(segment, records, amp=-0.05, delay=100., dur=500.,
+                   dt=0.025, v_init=-65):
+    '''
+    steady-state voltage change at the recorded segments for a current step
+    in segment
+    '''
+    stim = h.IClamp(segment)
+    stim.amp, stim.delay, stim.dur = amp, delay, dur
+    vectors = [h.Vector().record(seg._ref_v) for seg in records]
+    _run(delay + dur, dt, v_init)
+    n = int(round(10. / dt))
+    return [np.mean(np.array(v)[-n:]) - np.mean(np.array(v)[
+        int(delay / dt) - n:int(delay / dt)]) for v in vectors]
+
+
+def input_resistance(segment, amp=-0.05, **kwargs):
+    '''
+    steady-state input resistance (MOhm) at segment
+    '''
+    return _step_response(segment, [segment], amp, **kwargs)[0] / amp
+
+
+def attenuation(soma, site, amp=-0.05, **kwargs):
+    '''
+    steady-state ratio of the voltage change at the soma to that at the
+    site, for a current step injected at the site
+    '''
+    dv_soma, dv_site = _step_response(site, [soma, site], amp, **kwargs)
+    return dv_soma / dv_site
+
+
+def _spike_count(v, threshold=-20.):
+    return int(np.count_nonzero((v[:-1] < threshold) & (v[1:] >= threshold)))
+
+
+def bac_firing(soma, site, soma_amp=1.9, epsp_amp=BAC_EPSP_AMP, delay=50.,
+               lag=5., tstop=150., dt=0.025, v_init=-65):
+    '''
+    BAC firing protocol of Hay et al. 2011: a 5 ms somatic current pulse,
+    an EPSP-shaped current at the dendritic site (rise 0.5 ms, decay 5 ms)
+    lag ms after the pulse onset, and both. The default EPSP amplitude
+    (BAC_EPSP_AMP) is 1 nA instead of 0.5 nA, which does not trigger a Ca
+    spike in this version of the model (uniform apical Ih), see
+    BAC_EPSP_AMPS.
+
+    Returns
+    -------
+    result : dict with the somatic spike counts 'spikes_soma', 'spikes_epsp'
+        and 'spikes_bac', the duration the dendritic site stays above
+        -40 mV during BAC firing 'ca_spike_width' (ms), the traces of the
+        BAC simulation 'v_soma', 'v_site' and its run time 'time' (s)
+    '''
+    t = np.arange(0, tstop + dt, dt)
+    s = np.clip(t - delay - lag, 0, None)
+    epsp = np.where(t >= delay + lag,
+                    (1 - np.exp(-s / 0.5)) * np.exp(-s / 5.), 0.)
+    epsp *= epsp_amp / epsp.max()
+    result = {}
+    for name, pulse, dendritic in [('spikes_soma', True, False),
+                                   ('spikes_epsp', False, True),
+                                   ('spikes_bac', True, True)]:
+        stim = h.IClamp(soma)
+        stim.amp, stim.delay, stim.dur = soma_amp * pulse, delay, 5.
+        dend_stim = h.IClamp(site)
+        dend_stim.delay, dend_stim.dur = 0, 1e9
+        waveform = h.Vector(epsp * dendritic)
+        waveform.play(dend_stim._ref_amp, dt)
+        v_soma = h.Vector().record(soma._ref_v)
+        v_site = h.Vector().record(site._ref_v)
+        t0 = time.time()
+        _run(tstop, dt, v_init)
+        result['time'] = time.time() - t0
+        result[name] = _spike_count(np.array(v_soma))
+        del stim, dend_stim, waveform
+    v_site = np.array(v_site)
+    result['ca_spike_width'] = np.count_nonzero(v_site > -40.) * dt
+    result['v_soma'] = np.array(v_soma)
+    result['v_site'] = v_site
+    return result
+
+
+def measure_fidelity(cell, dt=0.025):
+    '''
+    Input resistance, attenuation from the calibration and held-out sites
+    and BAC firing of the instantiated cell (full model or ReducedHayCell),
+    see the module docstring.
+    '''
+    soma = [sec for sec in cell.allseclist
+            if section_type(sec.name()) == 'soma'][0](0.5)
+    result = {'input_resistance': input_resistance(soma, dt=dt)}
+    for distance in sorted(CALIBRATION_SITES + HELD_OUT_SITES):
+        result['attenuation_{:.0f}'.format(distance)] = attenuation(
+            soma, apical_segment(cell, distance), dt=dt)
+    result.update(bac_firing(soma, apical_segment(cell, 620.), dt=dt))
+    return result
+
+
+def compare(full, reduced, tolerances=TOLERANCES):
+    '''
+    Difference of each measure_fidelity result of the reduced model to the
+    full model (relative, spike counts absolute) and whether it is within
+    tolerances: dict of name -> (full, reduced, difference, ok)
+    '''
+    report = {}
+    for name, tol in tolerances.items():
+        if name.startswith('spikes'):
+            diff = reduced[name] - full[name]
+        else:
+            diff = (reduced[name] - full[name]) / full[name]
+        report[name] = (full[name], reduced[name], diff, abs(diff) <= tol)
+    return report
+
+
+if __name__ == '__main__':
+    from hay_model.cell_factory import HayCellFactory
+
+    factory = HayCellFactory()
+    cell = factory.get_cell('active')
+    full = measure_fidelity(cell)
+    soma = [sec for sec in cell.allseclist
+            if section_type(sec.name()) == 'soma'][0](0.5)
+    scan = [bac_firing(soma, apical_segment(cell, 620.), epsp_amp=amp)
+            for amp in BAC_EPSP_AMPS]
+    t0 = time.time()
+    reduction = Reduction.from_cell(cell)
+    t_reduce = time.time() - t0
+    n_full = cell.totnsegs
+    factory.cell = cell = None
+    h('forall delete_section()')
+
+    t0 = time.time()
+    scale = reduction.calibrate(full)
+    t_calibrate = time.time() - t0
+    reduced_cell = ReducedHayCell(reduction)
+    reduced = measure_fidelity(reduced_cell)
+    print('{} segments reduced to {} compartments {} in {:.2f} s, apical Ra '
+          'scaled by {:.2f}-{:.2f} in {:.2f} s'.format(
+              n_full, sum(reduction.nseg.values()), reduction.nseg, t_reduce,
+              scale.min(), scale.max(), t_calibrate))
+    print('BAC simulation (150 ms): full {:.3f} s, reduced {:.3f} s, '
+          'speedup {:.0f}x'.format(full['time'], reduced['time'],
+                                   full['time'] / reduced['time']))
+    print('BAC protocol with a {:.1f} nA EPSP (Hay et al. 2011: 0.5 nA), '
+          'full model:'.format(BAC_EPSP_AMP))
+    for amp, result in zip(BAC_EPSP_AMPS, scan):
+        print('  EPSP {:.2f} nA: spikes soma {}, EPSP {}, BAC {}, Ca spike '
+              '{:.1f} ms, site peak {:.1f} mV'.format(
+                  amp, result['spikes_soma'], result['spikes_epsp'],
+                  result['spikes_bac'], result['ca_spike_width'],
+                  result['v_site'].max()))
+    print('calibrated (fitted, not a fidelity measure):')
+    calibrated = {'attenuation_{:.0f}'.format(site): 0.
+                  for site in CALIBRATION_SITES}
+    for name, (f, r, diff, ok) in compare(full, reduced, calibrated).items():
+        print('  {:18s} full {:8.3f} reduced {:8.3f} difference {:+.3f}'
+              .format(name, f, r, diff))
+    print('fidelity:')
+    for name, (f, r, diff, ok) in compare(full, reduced).items():
+        print('  {:18s} full {:8.3f} reduced {:8.3f} difference {:+.3f} {}'
+              .format(name, f, r, diff, 'ok' if ok else 'OUT OF TOLERANCE'))
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+'''
+Parallel ensemble runner for the Halnes interneuron configurations of
+Exercise 6.
+
+The exercise simulates its configurations (uniform or linear T-channel
+distribution, blocked Na or T channels, somatic or distal input) one after
+the other in the notebook process. run_ensemble() distributes a list of
+configurations over worker processes, which load the halnes mechanisms once
+when they start, and returns the membrane potential at the soma and the
+three dendritic recording positions of the exercise, and the synapse
+current, as NumPy arrays. Results are cached on disk per configuration, so
+re-running a notebook only simulates configurations that changed. The
+workers compile (once, into the shared build cache) and load the halnes
+mechanisms with neuron_tools.load_mechanisms. Example usage:
+
+    from halnes_ensemble import CONFIGURATIONS, run_ensemble
+    results = run_ensemble(CONFIGURATIONS)
+    for config, result in zip(CONFIGURATIONS, results):
+        plt.plot(result['tvec'], result['somav'], label=config['title'])
+
+Run this file to compare the runner with simulating the configurations
+sequentially.
+'''
+import os
+import sys
+import time
+import hashlib
+import inspect
+import multiprocessing
+import numpy as np
+from neuron import h
+import LFPy
+if __name__ == '__main__':
+    # run as a script: the repository root, for neuron_tools
+    sys.path.insert(0, os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir))
+from neuron_tools import load_mechanisms, MorphologyIndex
+
+model_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'halnes')
+
+# recording positions of the exercise: soma, close, far and distal dendrite
+RECORD_IDX = [0, 65, 110, 128]
+somapos = 0
+distdendpos = 128
+
+# the configurations of Fig. 2-6 and the blocked Na & T control
+CONFIGURATIONS = [
+    {'title': 'Fig. 2: Uniform T-dist. Somatic input', 'synpos': somapos,
+     'gna': 0.18, 'gkdr': 0.4, 'gcat': 1e-4, 'tdist': 1},
+    {'title': 'Fig. 3: Uniform T-dist. Na blocked. Somatic input',
+     'synpos': somapos, 'gna': 0., 'gkdr': 0.4, 'gcat': 1e-4, 'tdist': 1},
+    {'title': 'Fig. 4: Uniform T-dist. Distal input', 'synpos': distdendpos,
+     'gna': 0.18, 'gkdr': 0.4, 'gcat': 1e-4, 'tdist': 1},
+    {'title': 'Fig. 5: Linear T-dist. Somatic input', 'synpos': somapos,
+     'gna': 0.18, 'gkdr': 0.4, 'gcat': 1e-4, 'tdist': 2},
+    {'title': 'Fig. 6: Linear T-dist. Distal input', 'synpos': distdendpos,
+     'gna': 0.18, 'gkdr': 0.4, 'gcat': 1e-4, 'tdist': 2},
+    {'title': 'Na & T blocked. Somatic input', 'synpos': somapos,
+     'gna': 0., 'gkdr': 0.4, 'gcat': 0., 'tdist': 1},
+]
+
+# simulation parameters of the exercise
+SIMULATION = {'end_T': 200, 'dt': 2**-5, 'start_T': -100, 'weight': 0.01,
+              'spike_times': [60.0]}
+
+
+def active_conductances(cell, **kwargs):
+    '''
+    ion channels of the Halnes interneuron, as in the exercise
+    '''
+    rall = 113  # axial resistance
+    cap = 1.1  # membrane capacitance
+    Rm = 45000.0  # membrane resistance
+    Epas = -70.6
+    celsius = 36
+
+    gna = kwargs['gna']  # S/cm2
+    gkdr = kwargs['gkdr']
+    gcat = kwargs['gcat']
+    tdist = kwargs['tdist']
+
+    h.celsius = celsius
+
+    for sec in cell.allseclist:
+        sec.insert('pas')
+        sec.insert('Cad')
+        sec.insert('it2')
+        sec.insert('hh2')
+        sec.ena = 50  # Reversal potential for sodium
+        sec.ek = -90  # Reversal potential for potassium
+        sec.v = Epas
+        sec.e_pas = Epas
+        sec.g_pas = 1 / Rm
+        sec.Ra = rall
+        sec.cm = cap
+        sec.gnabar_hh2 = 0
+        sec.gkbar_hh2 = 0
+        if sec.name().rfind('soma') >= 0:
+            sec.gnabar_hh2 = gna
+            sec.gkbar_hh2 = gkdr
+    if tdist == 1:
+        for sec in cell.allseclist:
+            sec.gcabar_it2 = gcat
+    if tdist == 2:
+        ## linear in the path distance from the 0 end of the soma
+        sections = list(cell.allseclist)
+        soma = [sec for sec in sections if sec.name().rfind('soma') >= 0]
+        for sec in soma:
+            sec.gcabar_it2 = gcat * 0.1054
+        index = MorphologyIndex.from_sections(
+            sections, origin=soma[0](0),
+            key=(cell.morphology, tuple(sec.nseg for sec in sections)))
+        index.set_values('gcabar_it2',
+                         gcat * 0.1054 * (1 + 0.04 * index.distance),
+                         mask=~index.mask('soma'), sections=sections)
+    if tdist == 3:
+        for sec in cell.allseclist:
+            sec.gcabar_it2 = gcat
+            if sec.name().rfind('soma') >= 0:
+                sec.gnabar_hh2 = gna
+                sec.gkbar_hh2 = gkdr
+            else:
+                sec.gnabar_hh2 = gna * 0.05
+                sec.gkbar_hh2 = gkdr * 0.05
+
+
+def simulate_configuration(config, end_T=200, dt=2**-5, start_T=-100,
+                           weight=0.01, spike_times=(60.0,),
+                           record_idx=RECORD_IDX):
+    '''
+    Simulate one configuration in this process, the halnes mechanisms must
+    be loaded.
+
+    Parameters
+    ----------
+    config : dict with 'synpos', 'gna', 'gkdr', 'gcat' and 'tdist'
+    end_T, dt, start_T : float, simulation end, time step and start (ms)
+    weight : float, synaptic weight
+    spike_times : list of float, synaptic input times (ms)
+    record_idx : list of int, segments of which vmem is returned
+
+    Returns
+    -------
+    result : dict of ndarray, 'tvec', 'somav', 'vmem' (one row per
+        record_idx) and 'isyn'
+    '''
+    h('forall delete_section()')
+    cell = LFPy.Cell(morphology=os.path.join(model_path, 'Morf_default.hoc'),
+                     dt=dt, tstart=start_T, tstop=end_T,
+                     nsegs_method='lambda_f', lambda_f=100,
+                     custom_fun=[active_conductances],
+                     custom_fun_args=[{key: config[key] for key in
+                                       ('gna', 'gkdr', 'gcat', 'tdist')}])
+    synapse = LFPy.Synapse(cell, idx=config['synpos'], e=0,
+                           syntype='Exp2Syn', tau1=1, tau2=3, weight=weight,
+                           record_current=True)
+    synapse.set_spike_times(np.array(spike_times))
+    cell.simulate(rec_imem=False, rec_vmem=True)
+    result = {'tvec': np.array(cell.tvec),
+              'somav': np.array(cell.somav),
+              'vmem': np.array(cell.vmem[list(record_idx)]),
+              'isyn': np.array(synapse.i)}
+    cell.strip_hoc_objects()
+    return result
+
+
+def configuration_key(config, simulation, record_idx):
+    '''
+    hash of a configuration, the simulation parameters and the model
+    (mechanisms, morphology and active_conductances)
+    '''
+    sha = hashlib.sha1()
+    for fname in sorted(os.listdir(model_path)):
+        if fname.endswith('.mod') or fname.endswith('.hoc'):
+            with open(os.path.join(model_path, fname), 'rb') as f:
+                sha.update(fname.encode() + f.read())
+    sha.update(inspect.getsource(active_conductances).encode())
+    sha.update(inspect.getsource(simulate_configuration).encode())
+    description = (sorted((key, value) for key, value in config.items()
+                          if key != 'title'),
+                   sorted(simulation.items()), list(record_idx))
+    sha.update(repr(description).encode())
+    return sha.hexdigest()
+
+
+def _init_worker():
+    load_mechanisms(model_path)
+
+
+def _run(args):
+    config, simulation, record_idx = args
+    return simulate_configuration(config, record_idx=record_idx,
+                                  **simulation)
+
+
+def run_ensemble(configurations, processes=None, cache_dir='.ensemble_cache',
+                 record_idx=RECORD_IDX, verbose=False, **simulation):
+    '''
+    Simulate a list of configurations in parallel worker processes.
+
+    Parameters
+    ----------
+    configurations : list of dict, see CONFIGURATIONS
+    processes : int or None, number of worker processes (None: number of
+        CPUs, at most the number of configurations to simulate)
+    cache_dir : str or None, directory of cached results (None: no cache)
+    record_idx : list of int, segments of which vmem is returned
+    verbose : bool, print which configurations are simulated or cached
+    **simulation : simulation parameters overriding SIMULATION (end_T, dt,
+        start_T, weight, spike_times)
+
+    Returns
+    -------
+    results : list of dict, one per configuration, see
+        simulate_configuration
+    '''
+    simulation = dict(SIMULATION, **simulation)
+    results = [None] * len(configurations)
+    paths = [None] * len(configurations)
+    todo = []
+    for i, config in enumerate(configurations):
+        if cache_dir is not None:
+            paths[i] = os.path.join(cache_dir, configuration_key(
+                config, simulation, record_idx) + '.npz')
+            if os.path.isfile(paths[i]):
+                with np.load(paths[i]) as f:
+                    results[i] = dict(f)
+                continue
+        todo.append(i)
+    if verbose:
+        print('{} configurations cached, {} to simulate'.format(
+            len(configurations) - len(todo), len(todo)))
+
+    if todo:
+        if processes is None:
+            processes = os.cpu_count() or 1
+        processes = min(processes, len(todo))
+        # spawn: workers must not inherit the NEURON state of the caller
+        ctx = multiprocessing.get_context('spawn')
+        with ctx.Pool(processes, initializer=_init_worker) as pool:
+            args = [(configurations[i], simulation, record_idx)
+                    for i in todo]
+            for i, result in zip(todo, pool.map(_run, args, chunksize=1)):
+                results[i] = result
+                if cache_dir is not None:
+                    os.makedirs(cache_dir, exist_ok=True)
+                    np.savez(paths[i], **result)
+    return results
+
+
+if __name__ == '__main__':
+    import shutil
+    import tempfile
+
+    t0 = time.time()
+    load_mechanisms(model_path)
+    sequential = [simulate_configuration(config, **SIMULATION)
+                  for config in CONFIGURATIONS]
+    t_seq = time.time() - t0
+    print('sequential in this process: {:.2f} s'.format(t_seq))
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        for processes in [1, 2, 4]:
+            t0 = time.time()
+            results = run_ensemble(CONFIGURATIONS, processes=processes,
+                                   cache_dir=None)
+            err = max(np.abs(a['vmem'] - b['vmem']).max()
+                      for a, b in zip(sequential, results))
+            print('{} worker processes: {:.2f} s, max |dV| vs sequential '
+                  '{:.1e} mV'.format(processes, time.time() - t0, err))
+        run_ensemble(CONFIGURATIONS, cache_dir=cache_dir)
+        t0 = time.time()
+        run_ensemble(CONFIGURATIONS, cache_dir=cache_dir)
+        print('cached: {:.3f} s'.format(time.time() - t0))
+    finally:
+        shutil.rmtree(cache_dir)
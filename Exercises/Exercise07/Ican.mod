@@ -13,6 +13,7 @@ TITLE Slow Ca-dependent cation current
 INDEPENDENT {t FROM 0 TO 1 WITH 1 (ms)}
 
 NEURON {
+	THREADSAFE
 	SUFFIX ican
 	USEION other WRITE iother VALENCE 1
 	USEION Ca READ Cai VALENCE 2
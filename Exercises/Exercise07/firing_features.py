@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+'''
+Vectorized firing-pattern features of Exercise 7 voltage and Ca traces.
+
+The exercise classifies the firing patterns of Mymodel (tonic firing,
+bursting, rebound bursts) by looking at the show_output plots. The functions
+here compute the features of all traces of a sweep at once, from 2-D arrays
+with one trace per row as returned by mymodel_sweep.run_sweep:
+
+    n_spikes        spikes during the stimulus
+    rate            n_spikes / stimulus duration (Hz)
+    latency         first spike time after stimulus onset (ms)
+    isi_mean, isi_cv, isi_min   interspike interval statistics during the
+                    stimulus (ms)
+    adaptation      mean of (ISI[i+1] - ISI[i]) / (ISI[i+1] + ISI[i]),
+                    positive for a decreasing rate
+    n_bursts        runs of at least two spikes with ISIs below burst_isi
+    burst_fraction  fraction of the spikes that are in bursts
+    rebound_spikes  spikes within rebound_window after the stimulus
+    ca_rest, ca_peak, ca_plateau   Ca concentration at stimulus onset,
+                    its maximum during the stimulus and its mean over the
+                    last plateau_window of the stimulus
+
+Spikes are upward threshold crossings found for all traces with one
+comparison of the shifted arrays; the per-cell statistics are computed from
+the flat list of crossings with bincount instead of a loop over traces.
+Undefined features (e.g. ISIs of cells with less than two spikes) are NaN.
+Example usage:
+
+    t, result = run_sweep(params)
+    features = firing_features(result['v'], t, result['cai'],
+                               stim=(500., 1500.))
+    labels = classify(features)
+
+Run this file from the Exercise07 folder for a check of the adaptation sign
+and a comparison with a loop over traces on 10^4 traces.
+'''
+import os
+import sys
+import time
+import numpy as np
+
+FEATURE_NAMES = ['n_spikes', 'rate', 'latency', 'isi_mean', 'isi_cv',
+                 'isi_min', 'adaptation', 'n_bursts', 'burst_fraction',
+                 'rebound_spikes', 'ca_rest', 'ca_peak', 'ca_plateau']
+
+
+def spike_times(v, t, threshold=-20.):
+    '''
+    Upward threshold crossings of all traces.
+
+    Parameters
+    ----------
+    v : ndarray, membrane potential (mV), shape (n_cells, n_t) or (n_t,)
+    t : ndarray, sampling times (ms), shape (n_t,)
+    threshold : float, spike detection threshold (mV)
+
+    Returns
+    -------
+    cell : ndarray, trace index of each spike
+    times : ndarray, spike times (ms), linearly interpolated between
+        samples, sorted by cell and time
+    '''
+    v = np.atleast_2d(v)
+    cell, k = np.nonzero((v[:, :-1] < threshold) & (v[:, 1:] >= threshold))
+    v0 = v[cell, k]
+    v1 = v[cell, k + 1]
+    times = t[k] + (threshold - v0) / (v1 - v0) * (t[k + 1] - t[k])
+    return cell, times
+
+
+def split_spikes(cell, times, n_cells):
+    '''
+    list with the spike times of each cell, from the output of spike_times
+    '''
+    counts = np.bincount(cell, minlength=n_cells)
+    return np.split(times, np.cumsum(counts)[:-1])
+
+
+def _per_cell_mean(cell, values, n_cells):
+    count = np.bincount(cell, minlength=n_cells)
+    total = np.bincount(cell, values, minlength=n_cells)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count > 0, total / count, np.nan)
+
+
+def firing_features(v, t, cai=None, stim=None, threshold=-20.,
+                    burst_isi=20., rebound_window=200., plateau_window=100.):
+    '''
+    Firing-pattern features of all traces.
+
+    Parameters
+    ----------
+    v : ndarray, membrane potential (mV), shape (n_cells, n_t)
+    t : ndarray, sampling times (ms), shape (n_t,)
+    cai : ndarray or None, Ca concentration, same shape as v (None: no Ca
+        features)
+    stim : tuple of float or None, (start, end) of the stimulus (ms), None:
+        the whole trace
+    threshold : float, spike detection threshold (mV)
+    burst_isi : float, largest ISI within a burst (ms)
+    rebound_window : float, duration after the stimulus in which rebound
+        spikes are counted (ms)
+    plateau_window : float, duration at the end of the stimulus over which
+        the Ca plateau is averaged (ms)
+
+    Returns
+    -------
+    features : structured array with one record per trace and the fields
+        in FEATURE_NAMES
+    '''
+    v = np.atleast_2d(v)
+    n_cells = v.shape[0]
+    start, end = (t[0], t[-1]) if stim is None else stim
+    features = np.full(n_cells, np.nan,
+                       dtype=[(name, float) for name in FEATURE_NAMES])
+
+    cell, times = spike_times(v, t, threshold)
+    rebound = (times > end) & (times <= end + rebound_window)
+    features['rebound_spikes'] = np.bincount(cell[rebound],
+                                             minlength=n_cells)
+    during = (times >= start) & (times <= end)
+    cell, times = cell[during], times[during]
+    n_spikes = np.bincount(cell, minlength=n_cells)
+    features['n_spikes'] = n_spikes
+    features['rate'] = 1e3 * n_spikes / (end - start)
+    ## spikes are sorted by cell, the first spike of a cell is the one
+    ## without a predecessor in the same cell
+    first = np.ones(cell.size, dtype=bool)
+    first[1:] = cell[1:] != cell[:-1]
+    features['latency'][cell[first]] = times[first] - start
+
+    ## ISIs between consecutive spikes of the same cell
+    isi = np.diff(times)[~first[1:]]
+    isi_cell = cell[1:][~first[1:]]
+    mean = _per_cell_mean(isi_cell, isi, n_cells)
+    mean_sq = _per_cell_mean(isi_cell, isi**2, n_cells)
+    features['isi_mean'] = mean
+    with np.errstate(invalid='ignore'):
+        features['isi_cv'] = np.sqrt(np.maximum(mean_sq - mean**2, 0.)) / mean
+    isi_min = np.full(n_cells, np.inf)
+    np.minimum.at(isi_min, isi_cell, isi)
+    features['isi_min'] = np.where(np.isinf(isi_min), np.nan, isi_min)
+
+    ## pairs of consecutive ISIs of the same cell
+    pair = isi_cell[1:] == isi_cell[:-1]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ratio = ((isi[1:] - isi[:-1]) / (isi[1:] + isi[:-1]))[pair]
+    features['adaptation'] = _per_cell_mean(isi_cell[1:][pair], ratio,
+                                            n_cells)
+
+    ## a spike is in a burst if the ISI before or after it is short, a burst
+    ## starts at a short ISI that does not follow another short ISI
+    short = isi < burst_isi
+    in_burst = np.zeros(cell.size, dtype=bool)
+    idx = np.flatnonzero(~first)
+    in_burst[idx[short]] = True
+    in_burst[idx[short] - 1] = True
+    previous_short = np.zeros(isi.size, dtype=bool)
+    previous_short[1:] = short[:-1] & pair
+    features['n_bursts'] = np.bincount(isi_cell[short & ~previous_short],
+                                       minlength=n_cells)
+    with np.errstate(invalid='ignore'):
+        features['burst_fraction'] = np.bincount(
+            cell[in_burst], minlength=n_cells) / n_spikes
+
+    if cai is not None:
+        cai = np.atleast_2d(cai)
+        k0, k1 = np.searchsorted(t, [start, end])
+        k_plateau = np.searchsorted(t, end - plateau_window)
+        features['ca_rest'] = cai[:, k0]
+        features['ca_peak'] = cai[:, k0:k1 + 1].max(axis=1)
+        features['ca_plateau'] = cai[:, k_plateau:k1 + 1].mean(axis=1)
+    return features
+
+
+def classify(features, burst_fraction=0.5):
+    '''
+    Firing pattern of each trace: 'silent', 'tonic', 'bursting' (at least
+    burst_fraction of the spikes in bursts) or 'rebound' (no spikes during
+    the stimulus, but after it).
+    '''
+    labels = np.full(len(features), 'silent', dtype='<U8')
+    labels[features['n_spikes'] > 0] = 'tonic'
+    labels[features['burst_fraction'] >= burst_fraction] = 'bursting'
+    labels[(features['n_spikes'] == 0)
+           & (features['rebound_spikes'] > 0)] = 'rebound'
+    return labels
+
+
+def _firing_features_loop(v, t, cai=None, stim=None, threshold=-20.,
+                          burst_isi=20., rebound_window=200.,
+                          plateau_window=100.):
+    '''
+    reference implementation of firing_features with a loop over traces
+    '''
+    start, end = (t[0], t[-1]) if stim is None else stim
+    features = np.full(len(v), np.nan,
+                       dtype=[(name, float) for name in FEATURE_NAMES])
+    for i, trace in enumerate(v):
+        k = np.flatnonzero((trace[:-1] < threshold)
+                           & (trace[1:] >= threshold))
+        spikes = t[k] + (threshold - trace[k]) / (trace[k + 1] - trace[k]) \
+            * (t[k + 1] - t[k])
+        features['rebound_spikes'][i] = np.sum((spikes > end)
+                                               & (spikes <= end
+                                                  + rebound_window))
+        spikes = spikes[(spikes >= start) & (spikes <= end)]
+        features['n_spikes'][i] = len(spikes)
+        features['rate'][i] = 1e3 * len(spikes) / (end - start)
+        if len(spikes):
+            features['latency'][i] = spikes[0] - start
+        isi = np.diff(spikes)
+        if len(isi):
+            features['isi_mean'][i] = isi.mean()
+            features['isi_cv'][i] = isi.std() / isi.mean()
+            features['isi_min'][i] = isi.min()
+        if len(isi) > 1:
+            features['adaptation'][i] = np.mean(
+                (isi[1:] - isi[:-1]) / (isi[1:] + isi[:-1]))
+        n_bursts, in_burst, previous = 0, set(), False
+        for j, interval in enumerate(isi):
+            if interval < burst_isi:
+                in_burst.update([j, j + 1])
+                n_bursts += not previous
+            previous = interval < burst_isi
+        features['n_bursts'][i] = n_bursts
+        if len(spikes):
+            features['burst_fraction'][i] = len(in_burst) / len(spikes)
+        if cai is not None:
+            k0, k1 = np.searchsorted(t, [start, end])
+            k_plateau = np.searchsorted(t, end - plateau_window)
+            features['ca_rest'][i] = cai[i, k0]
+            features['ca_peak'][i] = cai[i, k0:k1 + 1].max()
+            features['ca_plateau'][i] = cai[i, k_plateau:k1 + 1].mean()
+    return features
+
+
+if __name__ == '__main__':
+    # the repository root, for neuron_tools in mymodel_sweep
+    sys.path.insert(0, os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir))
+    from mymodel_sweep import (FIRING_PATTERNS, run_sweep, load_mechanisms,
+                               model_path)
+    load_mechanisms(model_path)
+
+    ## an adapting train with ISIs of 10, 20, 40 and 80 ms has an
+    ## adaptation of (10/30 + 20/60 + 40/120) / 3 = 1/3, and -1/3 reversed
+    t = np.arange(0., 400., 0.5)
+    v = np.full((2, t.size), -65.)
+    v[0, np.searchsorted(t, 100. + np.array([0., 10., 30., 70., 150.]))] = 0.
+    v[1, np.searchsorted(t, 100. + np.array([0., 80., 120., 140., 150.]))] = 0.
+    for features in [firing_features(v, t), _firing_features_loop(v, t)]:
+        assert np.allclose(features['adaptation'], [1 / 3., -1 / 3.])
+    print('adaptation of a train with ISIs 10, 20, 40, 80 ms: {:.3f}, '
+          'reversed: {:.3f}'.format(*features['adaptation']))
+
+    t, result = run_sweep(FIRING_PATTERNS)
+    features = firing_features(result['v'], t, result['cai'],
+                               stim=(500., 1500.))
+    for label, f in zip('ABCDEFGH', features):
+        print('{}: {:8s} {:2.0f} spikes, {:2.0f} bursts, {:2.0f} rebound '
+              'spikes, Ca peak {:5.0f} nM'.format(
+                  label, classify(f[None])[0], f['n_spikes'], f['n_bursts'],
+                  f['rebound_spikes'], 1e6 * f['ca_peak']))
+
+    ## 10^4 traces: the firing patterns with random time shifts and noise
+    n = 10000
+    rng = np.random.default_rng(1234)
+    pattern = rng.integers(len(FIRING_PATTERNS), size=n)
+    shift = rng.integers(-100, 100, size=n)
+    rows = np.arange(n)[:, None]
+    cols = (np.arange(t.size)[None, :] - shift[:, None]) % t.size
+    v = result['v'][pattern][rows, cols] + rng.normal(0, 0.5, (n, t.size))
+    cai = result['cai'][pattern][rows, cols]
+
+    t0 = time.time()
+    features = firing_features(v, t, cai, stim=(500., 1500.))
+    t_vectorized = time.time() - t0
+    t0 = time.time()
+    reference = _firing_features_loop(v, t, cai, stim=(500., 1500.))
+    t_loop = time.time() - t0
+    equal = all(np.allclose(features[name], reference[name], equal_nan=True)
+                for name in FEATURE_NAMES)
+    print('{} traces of {} samples: vectorized {:.2f} s, loop over traces '
+          '{:.2f} s, same features: {}'.format(n, t.size, t_vectorized,
+                                               t_loop, equal))
@@ -9,6 +9,7 @@ TITLE Medium duration Ca-dependent potassium current
 INDEPENDENT {t FROM 0 TO 1 WITH 1 (ms)}
 
 NEURON {
+	THREADSAFE
 	SUFFIX iahp
 	USEION k READ ek WRITE ik VALENCE 1
 	USEION Ca READ Cai VALENCE 2
@@ -10,6 +10,7 @@ TITLE anomalous rectifier channel
 INDEPENDENT {t FROM 0 TO 1 WITH 1 (ms)}
 
 NEURON {
+	THREADSAFE
 	SUFFIX iar
 	USEION other WRITE iother VALENCE 1
         RANGE ghbar,  iother
@@ -13,6 +13,7 @@ TITLE Low threshold calcium current
 INDEPENDENT {t FROM 0 TO 1 WITH 1 (ms)}
 
 NEURON {
+	THREADSAFE
 	SUFFIX it2
 	USEION Ca READ Cai, Cao WRITE iCa VALENCE 2
 	RANGE gcabar, g
@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+'''
+Batched parameter sweeps of the Exercise 7 Mymodel cell.
+
+Instead of creating cell0, cellNa, ... by hand with a copy of the IClamp
+setup for each of them, run_sweep() instantiates one SweepCell per row of a
+parameter table in a single NEURON instance, distributes the cells over
+threads with ParallelContext.nthread, records only the soma membrane
+potential and Ca concentration at the chosen sampling interval and returns
+a structured array with one record per cell, keyed by the parameter values.
+The mechanisms in this folder must be loaded, with
+neuron_tools.load_mechanisms as in the exercise notebook; they are declared
+THREADSAFE, so nthread > 1 gives the same results as a single thread.
+Example usage:
+
+    load_mechanisms(model_path)
+    params = parameter_grid(gahp=[5e-5, 1.5e-4, 3e-4],
+                            gcat=[0., 2e-4, 4e-4])
+    t, result = run_sweep(params, amp=0.02, nthread=4)
+    trace = select(result, gahp=1.5e-4, gcat=2e-4)['v'][0]
+    plt.plot(t, trace)
+
+The stimulus amplitude, delay and duration can also be columns of the
+parameter table. Run this file for a comparison with the single cell setup
+of the exercise and a timing benchmark.
+'''
+import os
+import sys
+import json
+import time
+import itertools
+import numpy as np
+from neuron import h
+if __name__ == '__main__':
+    # run as a script: the repository root, for neuron_tools
+    sys.path.insert(0, os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir))
+from neuron_tools import load_mechanisms
+
+model_path = os.path.dirname(os.path.abspath(__file__))
+
+PARAM_NAMES = ['gna', 'gkdr', 'gahp', 'gcat', 'gcal', 'ghbar']
+DEFAULTS = {'gna': 0.01, 'gkdr': 0.01, 'gahp': 5e-5, 'gcat': 2e-4,
+            'gcal': 0.0009, 'ghbar': 0.00005}
+
+
+# NEURON parameter of each conductance of the exercise
+CONDUCTANCES = {'gna': 'gnabar_hh2', 'gkdr': 'gkbar_hh2',
+                'gahp': 'gkbar_iahp', 'gcat': 'gcabar_it2',
+                'gcal': 'pcabar_ical', 'ghbar': 'ghbar_iar'}
+
+
+class SweepCell(object):
+    '''
+    The single compartment cell of Mymodel in the exercise notebook, with
+    the conductances given as keyword arguments (see CONDUCTANCES). Unlike
+    Mymodel it does not call h.define_shape(), since the cell has no 3-D
+    geometry that the simulation uses, and it uses its ghbar argument,
+    whereas Mymodel uses the notebook variable ghbar.
+    '''
+    def __init__(self, **conductances):
+        soma = self.soma = h.Section(name='soma', cell=self)
+        soma.L = soma.diam = 20     # microns
+        for mechanism in ['pas', 'iar', 'hh2', 'Cad', 'it2', 'ical', 'iahp']:
+            soma.insert(mechanism)
+        soma.e_pas = -80
+        soma.g_pas = 1 / 45000.
+        soma.cm = 1.1
+        soma.ena = 50
+        soma.ek = -90
+        soma.vtraubNa_hh2 = -52.6
+        soma.vtraubK_hh2 = -51.2
+        for name, value in dict(DEFAULTS, **conductances).items():
+            setattr(soma, CONDUCTANCES[name], value)
+        h.celsius = 36
+
+
+def notebook_mymodel(notebook='Exercise_7.ipynb'):
+    '''
+    The Mymodel class of the exercise notebook, executed from the notebook
+    cell that defines it, and the namespace it was executed in (Mymodel
+    reads ghbar from that namespace)
+    '''
+    with open(os.path.join(model_path, notebook)) as f:
+        cells = json.load(f)['cells']
+    source = next(''.join(cell['source']) for cell in cells
+                  if ''.join(cell['source']).startswith('class Mymodel'))
+    namespace = {'h': h}
+    exec(source, namespace)
+    return namespace['Mymodel'], namespace
+
+
+def parameter_grid(**values):
+    '''
+    Structured array with all combinations of the given parameter values;
+    parameters that are not given have their default value.
+    '''
+    names = PARAM_NAMES + [name for name in values if name not in DEFAULTS]
+    columns = [np.atleast_1d(values.get(name, DEFAULTS.get(name)))
+               for name in names]
+    table = np.array(list(itertools.product(*columns)),
+                     dtype=float).reshape(-1, len(names))
+    return np.rec.fromarrays(table.T, names=names).view(np.ndarray)
+
+
+def _as_table(params, defaults=DEFAULTS):
+    '''
+    structured array from a structured array, a dict of columns or a list
+    of dicts, with the values in defaults for missing columns
+    '''
+    if isinstance(params, np.ndarray) and params.dtype.names:
+        columns = {name: params[name] for name in params.dtype.names}
+    elif isinstance(params, dict):
+        columns = {name: np.atleast_1d(value)
+                   for name, value in params.items()}
+    else:
+        columns = {name: np.array([row[name] for row in params])
+                   for name in params[0]}
+    n = len(next(iter(columns.values())))
+    for name, value in defaults.items():
+        if name not in columns:
+            columns[name] = np.full(n, value)
+    names = [name for name in defaults] + [name for name in columns
+                                           if name not in defaults]
+    return np.rec.fromarrays([np.asarray(columns[name], dtype=float)
+                              for name in names],
+                             names=names).view(np.ndarray)
+
+
+def run_sweep(params, amp=0.02, delay=500., dur=1000., tstop=2000.,
+              dt=0.025, v_init=-65., sample_dt=0.5, nthread=1,
+              record_ca=True):
+    '''
+    Simulate one SweepCell per row of the parameter table.
+
+    Parameters
+    ----------
+    params : structured array, dict of arrays or list of dicts with (some
+        of) the columns gna, gkdr, gahp, gcat, gcal, ghbar (missing columns
+        take the values in DEFAULTS), and optionally amp, delay and dur of
+        the IClamp of each cell
+    amp, delay, dur : float, IClamp amplitude (nA), delay and duration (ms)
+        for cells without these columns
+    tstop, dt : float, simulation duration and time step (ms)
+    v_init : float, initial membrane potential (mV)
+    sample_dt : float, sampling interval of the recordings (ms)
+    nthread : int, number of threads
+    record_ca : bool, also record the soma Ca concentration
+
+    Returns
+    -------
+    t : ndarray, sampling times (ms)
+    result : structured array with the columns of params (including
+        amp, delay and dur) and 'v' (and 'cai') with the recorded traces
+    '''
+    table = _as_table(params, dict(DEFAULTS, amp=amp, delay=delay, dur=dur))
+
+    cells, stims = [], []
+    for row in table:
+        cell = SweepCell(**{name: row[name] for name in PARAM_NAMES})
+        iclamp = h.IClamp(cell.soma(0.5))
+        iclamp.amp = row['amp']
+        iclamp.delay = row['delay']
+        iclamp.dur = row['dur']
+        cells.append(cell)
+        stims.append(iclamp)
+
+    ## the recorded variables of all cells are read in one call per sample.
+    ## Vector.record with a sampling interval records wrong values for
+    ## cells that are not in the first thread (see _record_with_interval),
+    ## so the simulation is instead advanced from sample to sample
+    names = ['v', 'cai'] if record_ca else ['v']
+    refs = {'v': '_ref_v', 'cai': '_ref_Cai'}
+    pointers = {}
+    for name in names:
+        pointers[name] = h.PtrVector(len(cells))
+        for i, cell in enumerate(cells):
+            pointers[name].pset(i, getattr(cell.soma(0.5), refs[name]))
+    n_t = int(round(tstop / sample_dt)) + 1
+    traces = {name: np.zeros((n_t, len(cells))) for name in names}
+    buffer = h.Vector(len(cells))
+
+    pc = h.ParallelContext()
+    nthread_before = int(pc.nthread())
+    pc.nthread(nthread)
+    try:
+        ## psolve requires a maximum step for the (absent) spike exchange
+        pc.set_maxstep(10)
+        h.dt = dt
+        h.finitialize(v_init)
+        for k in range(n_t):
+            if k > 0:
+                pc.psolve(k * sample_dt)
+            for name in names:
+                pointers[name].gather(buffer)
+                traces[name][k] = buffer.as_numpy()
+    finally:
+        pc.nthread(nthread_before)
+
+    dtype = table.dtype.descr + [(name, float, (n_t,)) for name in names]
+    result = np.zeros(len(table), dtype=dtype)
+    for name in table.dtype.names:
+        result[name] = table[name]
+    for name in names:
+        result[name] = traces[name].T
+    return np.arange(n_t) * sample_dt, result
+
+
+def select(result, **values):
+    '''
+    records of result with the given parameter values
+    '''
+    mask = np.ones(len(result), dtype=bool)
+    for name, value in values.items():
+        mask &= np.isclose(result[name], value)
+    return result[mask]
+
+
+# the eight cells of the firing pattern figure of the exercise (A-H)
+FIRING_PATTERNS = [
+    {'gna': 0.01, 'gkdr': 0.01, 'gahp': 5e-5, 'gcat': 2e-4, 'gcal': 0.0009,
+     'ghbar': 0.00005, 'amp': 0.02},
+    {'gna': 0.01, 'gkdr': 0.01, 'gahp': 3 * 5e-5, 'gcat': 3 * 2e-4,
+     'gcal': 0.0009, 'ghbar': 0.00005, 'amp': 0.02},
+    {'gna': 0.01, 'gkdr': 0.01, 'gahp': 6 * 5e-5, 'gcat': 1.5 * 2e-4,
+     'gcal': 0.0009, 'ghbar': 0.00005, 'amp': 0.02},
+    {'gna': 0.01, 'gkdr': 0.01, 'gahp': 5e-5, 'gcat': 0 * 2e-4,
+     'gcal': 0.0009, 'ghbar': 0.00005, 'amp': 0.02},
+    {'gna': 0.02, 'gkdr': 2.5 * 0.02, 'gahp': 5e-5, 'gcat': 0 * 2e-4,
+     'gcal': 3 * 0.0009, 'ghbar': 0.00005, 'amp': 0.02},
+    {'gna': 0.02, 'gkdr': 0.02, 'gahp': 3 * 5e-5, 'gcat': 0 * 2e-4,
+     'gcal': 3 * 0.0009, 'ghbar': 0.00005, 'amp': 0.02},
+    {'gna': 0 * 0.01, 'gkdr': 0 * 0.01, 'gahp': 0 * 5e-5, 'gcat': 0 * 2e-4,
+     'gcal': 0 * 0.0009, 'ghbar': 0.00005, 'amp': -0.02},
+    {'gna': 0.01, 'gkdr': 0.01, 'gahp': 5e-5, 'gcat': 2 * 2e-4,
+     'gcal': 0.0009, 'ghbar': 0.00005, 'amp': -0.02},
+]
+
+
+def _record_with_interval(params, nthread, tstop=2000., dt=0.025,
+                          v_init=-65., sample_dt=0.5):
+    '''
+    soma v of the cells of run_sweep, recorded with Vector.record at
+    sample_dt, as run_sweep would without the sample to sample loop
+    '''
+    table = _as_table(params, dict(DEFAULTS, amp=0.02, delay=500.,
+                                   dur=1000.))
+    cells, stims, vecs = [], [], []
+    for row in table:
+        cell = SweepCell(**{name: row[name] for name in PARAM_NAMES})
+        iclamp = h.IClamp(cell.soma(0.5))
+        iclamp.amp = row['amp']
+        iclamp.delay = row['delay']
+        iclamp.dur = row['dur']
+        vec = h.Vector()
+        vec.record(cell.soma(0.5)._ref_v, sample_dt)
+        cells.append(cell)
+        stims.append(iclamp)
+        vecs.append(vec)
+    pc = h.ParallelContext()
+    nthread_before = int(pc.nthread())
+    pc.nthread(nthread)
+    try:
+        pc.set_maxstep(10)
+        h.dt = dt
+        h.finitialize(v_init)
+        pc.psolve(tstop)
+    finally:
+        pc.nthread(nthread_before)
+    n_t = int(round(tstop / sample_dt)) + 1
+    return np.array([vec.as_numpy()[:n_t] for vec in vecs])
+
+
+if __name__ == '__main__':
+    load_mechanisms(model_path)
+    h.load_file('stdrun.hoc')
+    Mymodel, namespace = notebook_mymodel()
+
+    ## the exercise: one Mymodel of the notebook with its own IClamp per
+    ## firing pattern, all recorded at every time step and run with h.run()
+    t0 = time.time()
+    cells, stims, v_vecs = [], [], []
+    for p in FIRING_PATTERNS:
+        namespace['ghbar'] = p['ghbar']
+        cell = Mymodel(*[p[name] for name in PARAM_NAMES])
+        stim = h.IClamp(cell.soma(0.5))
+        stim.delay = 500
+        stim.dur = 1000
+        stim.amp = p['amp']
+        v_vec = h.Vector()
+        v_vec.record(cell.soma(0.5)._ref_v)
+        cells.append(cell)
+        stims.append(stim)
+        v_vecs.append(v_vec)
+    h.tstop = 2000
+    h.run()
+    reference = np.array(v_vecs)[:, ::20]
+    del cells, stims, v_vecs
+    print('exercise setup, 8 cells: {:.2f} s'.format(time.time() - t0))
+
+    t0 = time.time()
+    t, result = run_sweep(FIRING_PATTERNS)
+    print('run_sweep, 8 cells: {:.2f} s, max |dV| vs exercise {:.1e} mV'
+          .format(time.time() - t0, np.abs(result['v'] - reference).max()))
+    t, result = run_sweep(FIRING_PATTERNS, nthread=2)
+    print('run_sweep, 8 cells, 2 threads: max |dV| vs exercise {:.1e} mV'
+          .format(np.abs(result['v'] - reference).max()))
+
+    ## why run_sweep does not use Vector.record with an interval: the
+    ## cells outside thread 0 (the second half here) are recorded wrongly
+    for nthread in [1, 2]:
+        v = _record_with_interval(FIRING_PATTERNS, nthread)
+        print('Vector.record at 0.5 ms, {} threads: max |dV| vs exercise '
+              'per cell {}'.format(nthread, np.array2string(
+                  np.abs(v - reference).max(axis=1), precision=1)))
+
+    params = parameter_grid(gahp=np.linspace(0, 3e-4, 8),
+                            gcat=np.linspace(0, 4e-4, 8),
+                            gcal=[0.0009, 0.0027],
+                            gkdr=[0.01, 0.02])
+    for nthread in [1, 2, 4]:
+        t0 = time.time()
+        t, result = run_sweep(params, nthread=nthread)
+        print('run_sweep, {} cells, {} threads: {:.2f} s'.format(
+            len(params), nthread, time.time() - t0))
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+'''
+Cell constructors of Exercise 9, shared by spike_visibility.py and
+population_lfp.py.
+
+return_cell() is the Hay model and return_IN_cell() the passive
+interneuron of the exercise, with the same parameters as the functions of
+the same names in the notebook. Keyword arguments override cell
+parameters, e.g. tstop. The cells are CachedCells of
+neuron_tools.morphology_cache, which read the morphology, the nseg of the
+lambda_f rule and the segment geometry from a cache after the first cell.
+Example usage:
+
+    from cells import return_cell, return_IN_cell, load_hay_mechanisms
+    load_hay_mechanisms()
+    cell = return_cell(conductance_type='active', tstop=200)
+
+The mechanisms in hay_model/mod are compiled (once) and loaded with
+neuron_tools.load_mechanisms. The repository root must be on sys.path for
+neuron_tools, as set up by the exercise notebook and by the scripts of this
+folder when they are run.
+'''
+import os
+from os.path import join
+from hay_model.hay_active_declarations import active_declarations
+from neuron_tools import load_mechanisms
+from neuron_tools.morphology_cache import CachedCell
+
+exercise_path = os.path.dirname(os.path.abspath(__file__))
+model_path = join(exercise_path, 'hay_model')
+
+
+def load_hay_mechanisms():
+    '''
+    compile (once) and load the mechanisms of the Hay model
+    '''
+    load_mechanisms(join(model_path, 'mod'))
+
+
+def return_cell(conductance_type='active', **kwargs):
+    '''
+    CachedCell with the Hay model, as return_cell in the exercise
+
+    Parameters
+    ----------
+    conductance_type : str, 'active' or 'passive'
+    **kwargs : cell parameters that differ from the exercise
+    '''
+    cell_parameters = {
+        'morphology': join(model_path, 'cell1.hoc'),
+        'v_init': -65,
+        'passive': False,
+        'nsegs_method': 'lambda_f',
+        'lambda_f': 100,
+        'dt': 2**-4,
+        'tstart': -100,
+        'tstop': 100,
+        'custom_code': [join(model_path, 'custom_codes.hoc')],
+        'custom_fun': [active_declarations],
+        'custom_fun_args': [{'conductance_type': conductance_type}],
+    }
+    cell_parameters.update(kwargs)
+    return CachedCell(**cell_parameters)
+
+
+def return_IN_cell(**kwargs):
+    '''
+    CachedCell with the passive interneuron model, as return_IN_cell in
+    the exercise
+
+    Parameters
+    ----------
+    **kwargs : cell parameters that differ from the exercise
+    '''
+    cell_parameters = {
+        'morphology': join(exercise_path, 'IN.hoc'),
+        'v_init': -65,
+        'passive': True,
+        'nsegs_method': 'lambda_f',
+        'lambda_f': 100,
+        'dt': 2**-4,
+        'tstart': -100,
+        'tstop': 100,
+    }
+    cell_parameters.update(kwargs)
+    return CachedCell(**cell_parameters)
@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+'''
+Population LFP synthesis from single-cell kernels for Task 3 of Exercise 9.
+
+The hint of Task 3 is that the LFP results from many synaptic inputs onto
+many cells, while the exercise only simulates one return_cell() or
+return_IN_cell(). Simulating thousands of cells is not needed when the
+cells respond linearly to their input: each combination of cell type and
+synapse position is simulated once with a single input spike, and its
+transmembrane currents after the spike are stored as a kernel
+(CellKernel). A population LFP is then synthesized for any number of cells
+with random soma positions, rotations around the apical (y) axis and input
+spike trains:
+
+  1. the kernel segments are rotated and shifted to each cell position,
+     and the line source transformation matrix of all cells of a kernel is
+     computed with one lfpykit call per electrode,
+  2. the LFP kernel of each cell (matrix times kernel currents) is added
+     to the population LFP at each of its input spikes with one bincount
+     over all spikes of a chunk of cells, or, for high input rates,
+     convolved with the spike trains by FFT and summed over the cells in
+     the frequency domain.
+
+Kernels are cached on disk per model, cell type, synapse position and
+weight. Example usage:
+
+    kernels = [get_kernel('pyramidal', 0.), get_kernel('pyramidal', 900.)]
+    population = random_population(1000, n_kernels=2, rate=5.)
+    lfp = population_lfp(kernels, population, elec_x, elec_y, elec_z)
+
+The linear superposition neglects the interactions of inputs within a cell
+(e.g. shunting and active conductances), which is accurate for the weak
+inputs of Tasks 2 and 3. The cells are built by return_cell and
+return_IN_cell of cells.py. Run this file from the Exercise09 folder to
+compare with simulating the cells of a small population.
+'''
+import os
+import sys
+import glob
+import time
+import hashlib
+from os.path import join
+import numpy as np
+from scipy import fft
+import neuron
+import LFPy
+from lfpykit.lfpcalc import calc_lfp_linesource
+if __name__ == '__main__':
+    # run as a script: the repository root, for neuron_tools
+    sys.path.insert(0, os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir))
+from cells import (return_cell, return_IN_cell, load_hay_mechanisms,
+                   exercise_path, model_path)
+from neuron_tools.lfp import get_transformation_matrix
+
+
+CELL_TYPES = {'pyramidal': return_cell,
+              'interneuron': return_IN_cell}
+MODEL_FILES = {'pyramidal': [join(model_path, 'cell1.hoc'),
+                             join(model_path, 'custom_codes.hoc'),
+                             join(model_path, 'hay_active_declarations.py'),
+                             join(exercise_path, 'cells.py')]
+               + sorted(glob.glob(join(model_path, 'mod', '*.mod'))),
+               'interneuron': [join(exercise_path, 'IN.hoc'),
+                               join(exercise_path, 'cells.py')]}
+
+# shared by all exercises: the repository root
+DEFAULT_CACHE_DIR = os.path.normpath(join(exercise_path, os.pardir, os.pardir,
+                                          '.kernel_cache'))
+
+
+def insert_synapse(cell, synaptic_y_pos=0, weight=0.01,
+                   input_spike_train=np.array([20.])):
+    '''
+    ExpSyn synapse closest to (0, synaptic_y_pos, 0), as in the exercise
+    '''
+    synapse = LFPy.Synapse(cell, idx=cell.get_closest_idx(
+        x=0., y=synaptic_y_pos, z=0.), e=0., syntype='ExpSyn', tau=10.,
+        weight=weight, record_current=True)
+    synapse.set_spike_times(np.asarray(input_spike_train, dtype=float))
+    return synapse
+
+
+class CellKernel(object):
+    '''
+    Transmembrane current response of one cell type to one input spike at a
+    synapse position.
+
+    imem[j, n] is the change in the current (nA) of segment j, n time steps
+    after the input spike. x, y, z and d are the segment end points and
+    diameters, relative to the soma position.
+    '''
+    def __init__(self, imem, dt, x, y, z, d, synidx):
+        self.imem = imem
+        self.dt = dt
+        self.x = x
+        self.y = y
+        self.z = z
+        self.d = d
+        self.synidx = synidx
+
+    @classmethod
+    def compute(cls, cell_type='pyramidal', synaptic_y_pos=0., weight=0.001,
+                t_kernel=100., t_spike=20.):
+        '''
+        Simulate the cell type once with a single input spike at t_spike.
+
+        Parameters
+        ----------
+        cell_type : str, key of CELL_TYPES
+        synaptic_y_pos : float, synapse position along the apical axis (um)
+        weight : float, synaptic weight (uS)
+        t_kernel : float, kernel duration (ms)
+        t_spike : float, time of the input spike in the simulation (ms)
+        '''
+        h = neuron.h
+        h('forall delete_section()')
+        cell = CELL_TYPES[cell_type](tstop=t_spike + t_kernel)
+        synapse = insert_synapse(cell, synaptic_y_pos, weight,
+                                 np.array([t_spike]))
+        cell.simulate(rec_imem=True)
+        k_spike = int(round(t_spike / cell.dt))
+        baseline = cell.imem[:, :k_spike].mean(axis=-1, keepdims=True)
+        soma = np.array(cell.somapos)
+        kernel = cls(cell.imem[:, k_spike:] - baseline, cell.dt,
+                     cell.x - soma[0], cell.y - soma[1], cell.z - soma[2],
+                     np.array(cell.d), synapse.idx)
+        cell.strip_hoc_objects()
+        return kernel
+
+    def save(self, filename):
+        '''
+        save the kernel to a .npz file
+        '''
+        np.savez(filename, imem=self.imem, dt=self.dt, x=self.x, y=self.y,
+                 z=self.z, d=self.d, synidx=self.synidx)
+
+    @classmethod
+    def load(cls, filename):
+        '''
+        load a kernel saved with save()
+        '''
+        with np.load(filename) as f:
+            return cls(f['imem'], float(f['dt']), f['x'], f['y'], f['z'],
+                       f['d'], int(f['synidx']))
+
+    def geometry(self, positions, rotations):
+        '''
+        Segment end points of cells at the given soma positions (n_cells x 3,
+        um), rotated by the given angles (rad) around the y axis as
+        LFPy.Cell.set_rotation(y=...). Returns x, y, z of shape
+        (n_cells, n_segments, 2).
+        '''
+        positions = np.atleast_2d(positions)
+        cos = np.cos(rotations)[:, None, None]
+        sin = np.sin(rotations)[:, None, None]
+        x = cos * self.x + sin * self.z + positions[:, 0, None, None]
+        y = np.broadcast_to(self.y, x.shape) + positions[:, 1, None, None]
+        z = -sin * self.x + cos * self.z + positions[:, 2, None, None]
+        return x, y, z
+
+    def transformation_matrices(self, positions, rotations, elec_x, elec_y,
+                                elec_z, sigma=0.3):
+        '''
+        Line source transformation matrices of all cells, shape
+        (n_cells, n_electrodes, n_segments).
+        '''
+        x, y, z = self.geometry(positions, rotations)
+        n_cells, n_segments = x.shape[:2]
+        r_limit = np.tile(self.d / 2, n_cells)
+        M = np.empty((len(elec_x), n_cells * n_segments))
+        for i in range(len(elec_x)):
+            M[i] = calc_lfp_linesource(x.reshape(-1, 2), y.reshape(-1, 2),
+                                       z.reshape(-1, 2), elec_x[i],
+                                       elec_y[i], elec_z[i], sigma, r_limit)
+        return M.reshape(len(elec_x), n_cells, n_segments).transpose(1, 0, 2)
+
+
+def _kernel_hash(cell_type, synaptic_y_pos, weight, t_kernel):
+    '''
+    hash of the model files and kernel parameters
+    '''
+    description = []
+    for fname in MODEL_FILES[cell_type]:
+        with open(fname, 'rb') as f:
+            description.append(hashlib.sha1(f.read()).hexdigest())
+    description += [cell_type, float(synaptic_y_pos), float(weight),
+                    float(t_kernel)]
+    return hashlib.sha1(repr(description).encode()).hexdigest()
+
+
+def get_kernel(cell_type='pyramidal', synaptic_y_pos=0., weight=0.001,
+               t_kernel=100., cache_dir=None, verbose=False):
+    '''
+    Return the CellKernel of a cell type and synapse position, loaded from
+    cache_dir (None: DEFAULT_CACHE_DIR) if it was computed before, otherwise
+    computed and stored there.
+    '''
+    cache_dir = DEFAULT_CACHE_DIR if cache_dir is None else cache_dir
+    filename = os.path.join(cache_dir, _kernel_hash(
+        cell_type, synaptic_y_pos, weight, t_kernel) + '.npz')
+    if os.path.exists(filename):
+        if verbose:
+            print('loading kernel from {}'.format(filename))
+        return CellKernel.load(filename)
+    kernel = CellKernel.compute(cell_type, synaptic_y_pos, weight, t_kernel)
+    os.makedirs(cache_dir, exist_ok=True)
+    kernel.save(filename)
+    if verbose:
+        print('kernel saved to {}'.format(filename))
+    return kernel
+
+
+def random_population(n_cells, n_kernels=1, radius=500., rate=5., tstop=1000.,
+                      dt=2**-4, seed=1234):
+    '''
+    Cells with uniformly random soma positions in a disc of the given radius
+    in the x-z plane, random rotations around the y axis, a random kernel
+    and Poisson input spike trains on the time grid.
+
+    Returns
+    -------
+    population : dict with 'kernel_idx', 'positions' (n_cells x 3),
+        'rotations', 'spike_cells' and 'spike_times' (one entry per input
+        spike, sorted by cell) and 'tstop'
+    '''
+    rng = np.random.default_rng(seed)
+    r = radius * np.sqrt(rng.random(n_cells))
+    angle = 2 * np.pi * rng.random(n_cells)
+    positions = np.array([r * np.cos(angle), np.zeros(n_cells),
+                          r * np.sin(angle)]).T
+    n_spikes = rng.poisson(rate * tstop / 1000., n_cells)
+    spike_cells = np.repeat(np.arange(n_cells), n_spikes)
+    spike_times = dt * rng.integers(0, int(round(tstop / dt)),
+                                    n_spikes.sum())
+    order = np.lexsort((spike_times, spike_cells))
+    return {'kernel_idx': rng.integers(n_kernels, size=n_cells),
+            'positions': positions,
+            'rotations': 2 * np.pi * rng.random(n_cells),
+            'spike_cells': spike_cells[order],
+            'spike_times': spike_times[order], 'tstop': tstop}
+
+
+def population_lfp(kernels, population, elec_x, elec_y, elec_z, sigma=0.3,
+                   chunk=100, method='auto'):
+    '''
+    LFP of a population by superposition of the kernels.
+
+    Parameters
+    ----------
+    kernels : list of CellKernel, with the same dt
+    population : dict, see random_population
+    elec_x, elec_y, elec_z : ndarray, electrode positions (um)
+    sigma : float, extracellular conductivity (S/m)
+    chunk : int, number of cells whose LFP kernels are held at once
+    method : str, 'shift' (add the LFP kernel of a cell at each of its
+        input spikes), 'fft' (FFT convolution with the spike trains) or
+        'auto' (the cheaper of the two for each chunk of cells)
+
+    Returns
+    -------
+    lfp : ndarray, extracellular potential (mV), shape
+        (n_electrodes, n_t) on the time grid 0, dt, ..., tstop
+    '''
+    dt = kernels[0].dt
+    n_e = len(elec_x)
+    n_t = int(round(population['tstop'] / dt)) + 1
+    n_k = max(kernel.imem.shape[1] for kernel in kernels)
+    n_fft = fft.next_fast_len(n_t + n_k - 1)
+    lfp = np.zeros(n_e * (n_t + n_k))
+    lfp_f = np.zeros((n_e, n_fft // 2 + 1), dtype=complex)
+    spike_bins = np.round(population['spike_times'] / dt).astype(int)
+    for k, kernel in enumerate(kernels):
+        cells = np.flatnonzero(population['kernel_idx'] == k)
+        n_s = kernel.imem.shape[1]
+        for c0 in range(0, cells.size, chunk):
+            idx = cells[c0:c0 + chunk]
+            M = kernel.transformation_matrices(
+                population['positions'][idx], population['rotations'][idx],
+                elec_x, elec_y, elec_z, sigma)
+            ## LFP kernel of each cell, shape (cells, electrodes, n_s)
+            lfp_kernels = (M.reshape(-1, M.shape[-1])
+                           @ kernel.imem).reshape(idx.size, n_e, n_s)
+            spikes = np.isin(population['spike_cells'], idx)
+            cell = np.searchsorted(idx, population['spike_cells'][spikes])
+            bins = spike_bins[spikes]
+            use_fft = method == 'fft' or method == 'auto' and (
+                bins.size * n_s > idx.size * n_fft * np.log2(n_fft))
+            if use_fft:
+                trains = np.zeros((idx.size, n_fft))
+                np.add.at(trains, (cell, bins), 1.)
+                lfp_f += np.einsum('cef,cf->ef',
+                                   fft.rfft(lfp_kernels, n_fft, axis=-1),
+                                   fft.rfft(trains, axis=-1))
+            else:
+                ## flat index of electrode e, time bin + n for each spike
+                offsets = (np.arange(n_e)[:, None] * (n_t + n_k)
+                           + np.arange(n_s)[None, :])
+                flat = bins[:, None, None] + offsets[None, :, :]
+                lfp += np.bincount(flat.ravel(),
+                                   lfp_kernels[cell].ravel(),
+                                   minlength=lfp.size)
+    lfp = lfp.reshape(n_e, n_t + n_k)[:, :n_t]
+    return lfp + fft.irfft(lfp_f, n_fft, axis=-1)[:, :n_t]
+
+
+if __name__ == '__main__':
+    import shutil
+    import tempfile
+    load_hay_mechanisms()
+
+    ## laminar probe through the population
+    elec_y = np.linspace(-500, 1500, 16)
+    elec_x = np.full(16, 25.)
+    elec_z = np.zeros(16)
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        t0 = time.time()
+        kernels = [get_kernel('pyramidal', y, cache_dir=cache_dir)
+                   for y in (0., 900.)]
+        kernels.append(get_kernel('interneuron', 0., cache_dir=cache_dir))
+        print('3 kernels: {:.2f} s'.format(time.time() - t0))
+    finally:
+        shutil.rmtree(cache_dir)
+
+    ## small population: simulate every cell and compare
+    tstop = 200.
+    population = random_population(6, n_kernels=3, rate=20., tstop=tstop,
+                                   seed=4321)
+    t0 = time.time()
+    lfp = population_lfp(kernels, population, elec_x, elec_y, elec_z)
+    t_kernel = time.time() - t0
+    t0 = time.time()
+    reference = 0.
+    for c in range(6):
+        neuron.h('forall delete_section()')
+        k = population['kernel_idx'][c]
+        cell_type = 'interneuron' if k == 2 else 'pyramidal'
+        cell = CELL_TYPES[cell_type](tstop=tstop)
+        insert_synapse(cell, [0., 900., 0.][k], 0.001,
+                       population['spike_times'][
+                           population['spike_cells'] == c])
+        cell.set_rotation(y=population['rotations'][c])
+        cell.set_pos(*population['positions'][c])
+        cell.simulate(rec_imem=True)
+        reference = reference + get_transformation_matrix(
+            cell, elec_x, elec_y, elec_z, sigma=0.3, cache_dir=None) \
+            @ (cell.imem - cell.imem[:, :1])
+        cell.strip_hoc_objects()
+    t_sim = time.time() - t0
+    print('6 cells, {} input spikes: simulated {:.2f} s, kernels {:.3f} s, '
+          'max error {:.1e} uV of {:.2f} uV'.format(
+              population['spike_times'].size, t_sim, t_kernel,
+              1e3 * np.abs(lfp - reference).max(),
+              1e3 * np.abs(reference).max()))
+
+    for n_cells in [1000, 5000]:
+        population = random_population(n_cells, n_kernels=3, rate=5.)
+        t0 = time.time()
+        lfp = population_lfp(kernels, population, elec_x, elec_y, elec_z)
+        t_pop = time.time() - t0
+        t0 = time.time()
+        lfp_fft = population_lfp(kernels, population, elec_x, elec_y,
+                                 elec_z, method='fft', chunk=20)
+        t_fft = time.time() - t0
+        print('{} cells, 1 s, {} input spikes: {:.2f} s, with FFT {:.2f} s, '
+              'difference {:.1e} uV (simulating the cells: about {:.0f} s)'
+              .format(n_cells, population['spike_times'].size, t_pop, t_fft,
+                      1e3 * np.abs(lfp - lfp_fft).max(),
+                      t_sim / 6 * 5 * n_cells))
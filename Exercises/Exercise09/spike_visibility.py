@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+'''
+Spike visibility versus distance for Task 1 of Exercise 9.
+
+Task 1 asks how far from the soma a spike of the Hay model stays visible
+above white noise with an RMS of 15 uV, which the exercise answers by
+editing elec_x and re-running make_extracellular_electrode and
+plot_electrode_signal for one electrode position at a time. Here the spike
+is simulated once, the extracellular spike waveform is computed at
+thousands of candidate electrode positions (distances x directions around
+the soma) with one transformation matrix, and noise realizations are added
+to all waveforms at once. A spike counts as detected in a realization if
+the noisy trace crosses -threshold (threshold = k * noise RMS) during the
+spike window; the noise alone crosses it with the false positive
+probability that is reported as well. Example usage:
+
+    cell = simulate_spike()
+    x, y, z, distance = candidate_positions(np.arange(20, 301, 5))
+    profile = visibility_profile(cell, x, y, z, distance)
+    plt.plot(profile['distance'], profile['p_detect'])
+    print(profile['visible_distance'])
+
+The cell is built by return_cell of cells.py. Run this file from the
+Exercise09 folder to compare with one electrode per position as in the
+exercise.
+'''
+import os
+import sys
+import time
+import numpy as np
+import LFPy
+if __name__ == '__main__':
+    # run as a script: the repository root, for neuron_tools
+    sys.path.insert(0, os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir))
+from cells import return_cell, load_hay_mechanisms
+from neuron_tools.lfp import get_transformation_matrix
+
+
+def simulate_spike(weight=0.018, input_spike_train=np.array([20.])):
+    '''
+    Simulate the active Hay model with a somatic synapse, as in Task 1.
+    Returns the cell with imem and vmem recorded.
+    '''
+    cell = return_cell(conductance_type='active')
+    synapse = LFPy.Synapse(cell, idx=cell.get_closest_idx(x=0., y=0., z=0.),
+                           e=0., syntype='ExpSyn', tau=10., weight=weight,
+                           record_current=True)
+    synapse.set_spike_times(input_spike_train)
+    cell.simulate(rec_imem=True, rec_vmem=True)
+    return cell
+
+
+def candidate_positions(distances, n_directions=64, plane=True, seed=1234):
+    '''
+    Electrode positions at the given distances from the soma (origin).
+
+    Parameters
+    ----------
+    distances : ndarray, distances from the origin (um)
+    n_directions : int, number of directions per distance
+    plane : bool, directions evenly spaced in the x-z plane (perpendicular
+        to the apical dendrite, as with elec_x in the exercise), otherwise
+        random directions in 3-D
+    seed : int, seed of the random directions
+
+    Returns
+    -------
+    x, y, z : ndarray, positions (um), shape (len(distances) * n_directions,)
+    distance : ndarray, distance of each position (um)
+    '''
+    if plane:
+        angle = 2 * np.pi * np.arange(n_directions) / n_directions
+        directions = np.array([np.cos(angle), np.zeros(n_directions),
+                               np.sin(angle)])
+    else:
+        directions = np.random.default_rng(seed).normal(size=(3,
+                                                              n_directions))
+        directions /= np.linalg.norm(directions, axis=0)
+    distance = np.repeat(np.asarray(distances, dtype=float), n_directions)
+    x, y, z = directions[:, None, :] * np.asarray(distances,
+                                                  dtype=float)[None, :, None]
+    return x.flatten(), y.flatten(), z.flatten(), distance
+
+
+def spike_waveforms(cell, x, y, z, window=(-1., 3.), sigma=0.3):
+    '''
+    Extracellular spike waveforms (uV) at all positions, in a window around
+    the peak of the somatic spike, shape (n_positions, n_t), computed with
+    one transformation matrix (cached by neuron_tools.lfp).
+    '''
+    k_peak = np.argmax(cell.somav)
+    k0 = max(0, k_peak + int(round(window[0] / cell.dt)))
+    k1 = k_peak + int(round(window[1] / cell.dt)) + 1
+    M = get_transformation_matrix(cell, x, y, z, sigma=sigma)
+    return 1000 * M @ cell.imem[:, k0:k1]
+
+
+def detection_probability(waveforms, noise_rms=15., k=4., n_realizations=200,
+                          batch=20, seed=1234):
+    '''
+    Fraction of noise realizations in which the noisy waveform crosses
+    -k * noise_rms, for each waveform, and the same fraction for noise
+    alone (false positives).
+
+    Parameters
+    ----------
+    waveforms : ndarray, spike waveforms (uV), shape (n_positions, n_t)
+    noise_rms : float, RMS of the white noise (uV)
+    k : float, detection threshold in units of noise_rms
+    n_realizations : int, number of noise realizations
+    batch : int, realizations drawn at once, memory grows with batch
+    seed : int, seed of the noise
+
+    Returns
+    -------
+    p_detect : ndarray, shape (n_positions,)
+    p_false : float
+    '''
+    rng = np.random.default_rng(seed)
+    threshold = -k * noise_rms
+    detected = np.zeros(waveforms.shape[0])
+    false = 0
+    for n in range(0, n_realizations, batch):
+        m = min(batch, n_realizations - n)
+        noise = rng.normal(0, noise_rms, size=(m,) + waveforms.shape)
+        false += np.count_nonzero(noise.min(axis=-1) < threshold)
+        noise += waveforms
+        detected += np.count_nonzero(noise.min(axis=-1) < threshold, axis=0)
+    return (detected / n_realizations,
+            false / (n_realizations * waveforms.shape[0]))
+
+
+def visibility_profile(cell, x, y, z, distance, noise_rms=15., k=4.,
+                       n_realizations=200, p_visible=0.5, window=(-1., 3.)):
+    '''
+    Spike amplitude and detection probability versus distance.
+
+    Returns
+    -------
+    profile : dict with 'distance' (unique distances, um), 'amplitude'
+        (mean peak-to-peak amplitude over the directions, uV),
+        'p_detect' (mean detection probability over the directions),
+        'p_false' (false positive probability), 'visible_distance' (largest
+        distance with p_detect >= p_visible, um) and the per-position
+        'waveforms' and 'p_detect_positions'
+    '''
+    waveforms = spike_waveforms(cell, x, y, z, window)
+    p_detect, p_false = detection_probability(waveforms, noise_rms, k,
+                                              n_realizations)
+    distances, inverse = np.unique(distance, return_inverse=True)
+    count = np.bincount(inverse)
+    amplitude = np.bincount(inverse, np.ptp(waveforms, axis=-1)) / count
+    p_mean = np.bincount(inverse, p_detect) / count
+    visible = distances[p_mean >= p_visible]
+    return {'distance': distances, 'amplitude': amplitude,
+            'p_detect': p_mean, 'p_false': p_false,
+            'visible_distance': visible.max() if visible.size else np.nan,
+            'waveforms': waveforms, 'p_detect_positions': p_detect}
+
+
+if __name__ == '__main__':
+    load_hay_mechanisms()
+    t0 = time.time()
+    cell = simulate_spike()
+    print('simulation: {:.2f} s'.format(time.time() - t0))
+
+    distances = np.arange(20., 301., 5.)
+    x, y, z, distance = candidate_positions(distances, n_directions=64)
+
+    ## the exercise: one electrode and transformation matrix per position
+    t0 = time.time()
+    reference = np.array([1000 * np.ptp(
+        LFPy.RecExtElectrode(cell, sigma=0.3, x=x[i:i + 1], y=y[i:i + 1],
+                             z=z[i:i + 1]).get_transformation_matrix()
+        @ cell.imem) for i in range(x.size)])
+    t_loop = time.time() - t0
+
+    t0 = time.time()
+    waveforms = spike_waveforms(cell, x, y, z)
+    t_batch = time.time() - t0
+    print('amplitudes at {} positions: one electrode each {:.2f} s, one '
+          'transformation matrix {:.2f} s, max difference {:.1e} uV'.format(
+              x.size, t_loop, t_batch,
+              np.abs(np.ptp(waveforms, axis=-1) - reference).max()))
+
+    t0 = time.time()
+    profile = visibility_profile(cell, x, y, z, distance)
+    print('profile with 200 noise realizations per position: {:.2f} s'
+          .format(time.time() - t0))
+    print('spike visible (p_detect >= 0.5 at a {:.0f} uV threshold) up to '
+          '{:.0f} um, false positive probability {:.3f}'.format(
+              4 * 15., profile['visible_distance'], profile['p_false']))
+    for d, a, p in zip(profile['distance'][::6], profile['amplitude'][::6],
+                       profile['p_detect'][::6]):
+        print('  {:5.0f} um: {:6.1f} uV, p_detect {:.2f}'.format(d, a, p))
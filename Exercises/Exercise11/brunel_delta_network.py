@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+#
+# brunel_delta_network.py
+#
+# Based on brunel_delta_nest.py, which is part of NEST.
+#
+# Copyright (C) 2004 The NEST Initiative
+#
+# NEST is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# NEST is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with NEST.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Random balanced network (delta synapses)
+----------------------------------------
+
+This script simulates an excitatory and an inhibitory population on
+the basis of the network used in [1]_
+
+When connecting the network, customary synapse models are used, which
+allow for querying the number of created synapses. Using spike
+recorders, the average firing rates of the neurons in the populations
+are established. The building as well as the simulation time of the
+network are recorded.
+
+This module is the model of ``brunel_delta_nest.py`` (the script of Task 1
+of the exercise, which is left as it is) with building and simulating as
+separate functions, so that the network is built once and can be simulated
+repeatedly with changed external rate or weights, which are set on the
+existing nodes and connections instead of reconnecting the ~15 million
+synapses. Spikes are kept in memory instead of written to file:
+
+    net = build({'order': 2500})
+    result = simulate(net, 1000.)
+    net = build({'order': 2500, 'eta': 1.})   # reuses the built network
+    result = simulate(net, 1000.)
+    report(result)
+
+References
+~~~~~~~~~~
+
+.. [1] Brunel N (2000). Dynamics of sparsely connected networks of
+       excitatory and inhibitory spiking neurons. Journal of Computational
+       Neuroscience 8, 183-208.
+
+"""
+
+###############################################################################
+# Import all necessary modules for simulation, analysis and plotting.
+
+import time
+import nest
+import nest.raster_plot
+import matplotlib.pyplot as plt
+
+###############################################################################
+# Default parameters. ``dt`` is the resolution in ms and ``delay`` the
+# synaptic delay in ms. ``g`` (ratio inhibitory weight/excitatory weight),
+# ``eta`` (external rate relative to threshold rate) and ``epsilon``
+# (connection probability) are crucial for asynchronous irregular firing of
+# the neurons. The network has ``4 * order`` excitatory and ``order``
+# inhibitory neurons, and spikes are recorded from ``N_rec`` neurons of each
+# population. ``J`` is the postsynaptic amplitude in mV.
+#
+# ``eta``, ``g`` and ``J`` only change the generator rate and the synaptic
+# weights, so a network built with different values of these parameters is
+# reused by ``build``; all other parameters change the structure of the
+# network, and changing them rebuilds it.
+
+default_params = {"dt": 0.1,
+                  "delay": 1.5,
+                  "g": 5.0,
+                  "eta": 2.0,
+                  "epsilon": 0.1,
+                  "order": 2500,
+                  "J": 0.1,
+                  "N_rec": 50,
+                  "seed": 122131234}
+
+dynamic_params = ("eta", "g", "J")
+
+###############################################################################
+# Initialization of the parameters of the integrate and fire neuron. The
+# parameters of the neuron are stored in a dictionary.
+
+tauMem = 20.0  # time constant of membrane potential in ms
+theta = 20.0  # membrane threshold potential in mV
+neuron_params = {"C_m": 1.0,
+                 "tau_m": tauMem,
+                 "t_ref": 2.0,
+                 "E_L": 0.0,
+                 "V_reset": 0.0,
+                 "V_m": 0.0,
+                 "V_th": theta}
+
+###############################################################################
+# The network built last, reused by ``build`` as long as the structural
+# parameters are unchanged and the kernel has not been reset.
+
+_cached_network = None
+
+
+class Network:
+    """
+    Handles and parameters of a built network.
+
+    ``params`` are the full parameters, ``build_time`` is the time (s) of
+    the ``build`` call that returned the network, i.e. close to zero if a
+    built network was reused.
+    """
+
+    def __init__(self, params):
+        self.params = dict(params)
+        self.NE = 4 * params["order"]  # number of excitatory neurons
+        self.NI = params["order"]  # number of inhibitory neurons
+        self.N_neurons = self.NE + self.NI  # number of neurons in total
+        # number of excitatory and inhibitory synapses per neuron
+        self.CE = int(params["epsilon"] * self.NE)
+        self.CI = int(params["epsilon"] * self.NI)
+        self.build_time = 0.0
+
+    def structure(self):
+        return {key: value for key, value in self.params.items()
+                if key not in dynamic_params}
+
+
+###############################################################################
+# Definition of threshold rate, which is the external rate needed to fix the
+# membrane potential around its threshold, the external firing rate and the
+# rate of the poisson generator which is multiplied by the in-degree CE and
+# converted to Hz by multiplication by 1000.
+
+def poisson_rate(net):
+    nu_th = theta / (net.params["J"] * net.CE * tauMem)
+    nu_ex = net.params["eta"] * nu_th
+    return 1000.0 * nu_ex * net.CE
+
+
+def build(params=None):
+    """
+    Build the network, or reuse the network built last if only ``eta``,
+    ``g`` or ``J`` differ.
+
+    params : dict, parameters differing from ``default_params``
+
+    Returns the ``Network``.
+    """
+    global _cached_network
+    startbuild = time.time()
+    net = Network(dict(default_params, **(params or {})))
+
+    if (_cached_network is not None
+            and _cached_network.structure() == net.structure()
+            and nest.network_size == _cached_network.N_neurons + 3):
+        net = _cached_network
+        update(net, {key: value for key, value in (params or {}).items()
+                     if key in dynamic_params})
+        net.build_time = time.time() - startbuild
+        return net
+
+    nest.ResetKernel()
+
+    ###########################################################################
+    # Configuration of the simulation kernel by the previously defined time
+    # resolution used in the simulation. Setting ``print_time`` to `True`
+    # prints the already processed simulation time as well as its percentage
+    # of the total simulation time.
+
+    nest.resolution = net.params["dt"]
+    nest.print_time = True
+    nest.overwrite_files = True
+    nest.rng_seed = net.params["seed"]
+
+    print("Building network")
+
+    ###########################################################################
+    # Creation of the nodes using ``Create``. We store the returned handles in
+    # the network for later reference. Here the excitatory and inhibitory, as
+    # well as the poisson generator and two spike recorders. The spike
+    # recorders will later be used to record excitatory and inhibitory spikes.
+    # Properties of the nodes are specified via ``params``, which expects a
+    # dictionary. Spikes are kept in memory instead of written to file.
+
+    net.nodes_ex = nest.Create("iaf_psc_delta", net.NE, params=neuron_params)
+    net.nodes_in = nest.Create("iaf_psc_delta", net.NI, params=neuron_params)
+    net.noise = nest.Create("poisson_generator",
+                            params={"rate": poisson_rate(net)})
+    net.espikes = nest.Create("spike_recorder")
+    net.ispikes = nest.Create("spike_recorder")
+
+    print("Connecting devices")
+
+    ###########################################################################
+    # Definition of a synapse using ``CopyModel``, which expects the model
+    # name of a pre-defined synapse, the name of the customary synapse and an
+    # optional parameter dictionary. The parameters defined in the dictionary
+    # will be the default parameter for the customary synapse. Here we define
+    # one synapse for the excitatory and one for the inhibitory connections
+    # giving the weights and equal delays.
+
+    # amplitudes of the excitatory and inhibitory postsynaptic potentials
+    J_ex = net.params["J"]
+    J_in = -net.params["g"] * J_ex
+    nest.CopyModel("static_synapse", "excitatory",
+                   {"weight": J_ex, "delay": net.params["delay"]})
+    nest.CopyModel("static_synapse", "inhibitory",
+                   {"weight": J_in, "delay": net.params["delay"]})
+
+    ###########################################################################
+    # Connecting the poisson generator to all neurons, and the first ``N_rec``
+    # nodes of the excitatory and inhibitory population to the associated
+    # spike recorders, using the excitatory synapse.
+
+    nest.Connect(net.noise, net.nodes_ex, syn_spec="excitatory")
+    nest.Connect(net.noise, net.nodes_in, syn_spec="excitatory")
+    N_rec = net.params["N_rec"]
+    nest.Connect(net.nodes_ex[:N_rec], net.espikes, syn_spec="excitatory")
+    nest.Connect(net.nodes_in[:N_rec], net.ispikes, syn_spec="excitatory")
+
+    print("Connecting network")
+
+    ###########################################################################
+    # Connecting the excitatory and the inhibitory population to all neurons
+    # using the connection rule ``fixed_indegree`` and the pre-defined
+    # synapses.
+
+    print("Excitatory connections")
+    conn_params_ex = {'rule': 'fixed_indegree', 'indegree': net.CE}
+    nest.Connect(net.nodes_ex, net.nodes_ex + net.nodes_in, conn_params_ex,
+                 "excitatory")
+
+    print("Inhibitory connections")
+    conn_params_in = {'rule': 'fixed_indegree', 'indegree': net.CI}
+    nest.Connect(net.nodes_in, net.nodes_ex + net.nodes_in, conn_params_in,
+                 "inhibitory")
+
+    net.build_time = time.time() - startbuild
+    _cached_network = net
+    return net
+
+
+def update(net, params):
+    """
+    Change ``eta``, ``g`` and/or ``J`` of a built network by setting the
+    generator rate and the weights of the existing connections.
+
+    net : Network
+    params : dict, new values of (some of) ``dynamic_params``
+    """
+    unknown = set(params) - set(dynamic_params)
+    if unknown:
+        raise ValueError(f"{sorted(unknown)} change the network structure, "
+                         "build a new network instead")
+    changed = {key for key, value in params.items()
+               if net.params[key] != value}
+    net.params.update(params)
+    if changed:
+        net.noise.rate = poisson_rate(net)
+    if changed & {"g", "J"}:
+        J_ex = net.params["J"]
+        J_in = -net.params["g"] * J_ex
+        nest.GetConnections(synapse_model="excitatory").set(weight=J_ex)
+        nest.GetConnections(synapse_model="inhibitory").set(weight=J_in)
+
+
+def simulate(net, duration):
+    """
+    Simulate the network for ``duration`` ms, continuing from the end of the
+    previous simulation of the network.
+
+    Returns a dict with the firing rates (Hz) of the recorded neurons during
+    this simulation, the number of synapses and the build and simulation
+    times (s).
+    """
+    net.espikes.n_events = 0
+    net.ispikes.n_events = 0
+
+    print("Simulating")
+
+    startsimulate = time.time()
+    nest.Simulate(duration)
+    sim_time = time.time() - startsimulate
+
+    ###########################################################################
+    # Calculation of the average firing rate of the excitatory and the
+    # inhibitory neurons by dividing the total number of recorded spikes by
+    # the number of neurons recorded from and the simulation time. The
+    # multiplication by 1000.0 converts the unit 1/ms to 1/s=Hz.
+
+    N_rec = net.params["N_rec"]
+    rate_ex = net.espikes.n_events / duration * 1000 / N_rec
+    rate_in = net.ispikes.n_events / duration * 1000 / N_rec
+
+    num_synapses = (nest.GetDefaults("excitatory")["num_connections"] +
+                    nest.GetDefaults("inhibitory")["num_connections"])
+
+    return {"N_neurons": net.N_neurons,
+            "num_synapses": num_synapses,
+            "num_excitatory": int(net.CE * net.N_neurons) + net.N_neurons,
+            "num_inhibitory": int(net.CI * net.N_neurons),
+            "rate_ex": rate_ex,
+            "rate_in": rate_in,
+            "build_time": net.build_time,
+            "sim_time": sim_time}
+
+
+def report(result):
+    """
+    Print the network properties, firing rates and building times.
+    """
+    print("Brunel network simulation (Python)")
+    print(f"Number of neurons : {result['N_neurons']}")
+    print(f"Number of synapses: {result['num_synapses']}")
+    print(f"       Exitatory  : {result['num_excitatory']}")
+    print(f"       Inhibitory : {result['num_inhibitory']}")
+    print(f"Excitatory rate   : {result['rate_ex']:.2f} Hz")
+    print(f"Inhibitory rate   : {result['rate_in']:.2f} Hz")
+    print(f"Building time     : {result['build_time']:.2f} s")
+    print(f"Simulation time   : {result['sim_time']:.2f} s")
+
+
+if __name__ == "__main__":
+    simtime = 1000.0  # Simulation time in ms
+
+    net = build()
+    report(simulate(net, simtime))
+
+    ###########################################################################
+    # Plot a raster of the excitatory neurons and a histogram.
+
+    nest.raster_plot.from_device(net.espikes, hist=True)
+    plt.show()
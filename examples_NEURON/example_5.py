@@ -8,9 +8,7 @@ input
 import matplotlib.pyplot as plt
 import numpy as np
 import neuron
-
-# Fix seed for numpy random number generation
-np.random.seed(1234)
+from noise_stimulus import NoiseCurrent
 
 ################################################################################
 # Neuron topology is defined using Sections
@@ -56,12 +54,13 @@ iclamp.delay = 0. # switch on current after delay period in ms
 iclamp.dur = 1E9   # duration of stimulus current in ms
 
 # create a white noise signal with values from a Gaussian distribution with
-# expected mean of zero and standard deviation of 0.25. 
-noise = neuron.h.Vector(np.random.randn(10000) / 4.)
-
-# Play back noise signal into clamp amplitude reference with update every dt.
+# expected mean of zero and standard deviation of 0.25, updated every dt.
+# The noise is generated on the fly in blocks with a fixed seed, so it lasts
+# for the whole simulation without storing the full signal. Set tau (ms) to
+# get Ornstein-Uhlenbeck noise instead of white noise.
 dt = 0.1
-noise.play(iclamp._ref_amp, dt)
+noise = NoiseCurrent(dt=dt)
+noise.add_clamp(iclamp, mean=0., std=0.25, tau=None, seed=1234)
 
 # print out section information again
 neuron.h.psection()
@@ -131,5 +130,6 @@ plt.close(fig)
 i = None
 v = None
 t = None
+noise = None
 iclamp = None
 soma = None
@@ -4,11 +4,40 @@
 NEURON and Python - Create a small network of mutually connected
 single-compartment neurons with Hodkin-Huxley style membrane properties
 
+The cells and the network are set up through NEURON's ParallelContext, so the
+same code runs on a single core, thread-parallel on one machine, or
+distributed over MPI ranks:
+
+    python example_7.py                 # serial
+    python example_7.py 4               # 4 threads
+    mpiexec -n 4 python example_7.py    # 4 MPI ranks
+
+Cells are given global identifiers (gids) and are assigned round-robin to
+the ranks; connections are made by gid, and spikes are exchanged between
+ranks by the ParallelContext instead of by direct NetCon object references.
+
 '''
-# Import modules for plotting and NEURON itself 
-import matplotlib.pyplot as plt
+# Import modules for numerics and NEURON itself
+import sys
+import numpy as np
 import neuron
 
+# MPI must be initialized before the ParallelContext is created. Without an
+# MPI launcher this is a no-op and the network runs in a single process.
+neuron.h.nrnmpi_init()
+pc = neuron.h.ParallelContext()
+rank = int(pc.id())
+nhost = int(pc.nhost())
+
+################################################################################
+# Global spike buffers shared by all cells on this rank. Each cell writes its
+# threshold crossings (spike times) and its gid into these two vectors, so
+# spike recording costs memory proportional to the number of spikes only.
+################################################################################
+spike_times = neuron.h.Vector()
+spike_gids = neuron.h.Vector()
+
+
 ################################################################################
 # Create a class that can be reused for multiple neuron representations
 ################################################################################
@@ -16,9 +45,20 @@ class HHCell(neuron.nrn.Section):
     '''
     Cell class based on inheritance from NEURON's Section object, that allows
     for setting parameters upon creation. The Hodkin-Huxley formalism is
-    inserted into the cell by default
+    inserted into the cell by default.
+
+    Spikes are always detected and stored in the global buffers
+    `spike_times` and `spike_gids`. Membrane voltage is only recorded if
+    `record_v` is True, optionally decimated to every `rec_dt` ms, so large
+    networks can be run with only a few (or no) voltage traces.
+
+    If a gid is given, the cell registers it with the ParallelContext on the
+    rank that creates it, which makes it a valid spike source for
+    `pc.gid_connect`. Cells without a gid can be created freely, as single
+    cells outside a Network.
     '''
-    def __init__(self, L=30., diam=30., Ra=100., cm=1.,):
+    def __init__(self, L=30., diam=30., Ra=100., cm=1., gid=None,
+                 record_v=True, rec_dt=None, threshold=0.):
         '''
         Parameters
         ----------
@@ -26,7 +66,13 @@ class HHCell(neuron.nrn.Section):
         diam : float, section diameter
         Ra : float, axial resistivity
         cm : float, membrane capacitance
-        
+        gid : int or None, global cell identifier stored with each spike
+            (None: the cell is not registered, and its spikes are stored
+            with the identifier -1)
+        record_v : bool, record membrane voltage of this cell
+        rec_dt : float or None, voltage sampling interval (None: every dt)
+        threshold : float, spike detection threshold
+
         '''
         neuron.nrn.Section.__init__(self)
         # Set Section attributes
@@ -34,14 +80,33 @@ class HHCell(neuron.nrn.Section):
         self.diam = diam
         self.Ra = Ra
         self.cm = cm
-        
+
         # Insert Hodkin-Huxley formalism
         self.insert('hh')
 
-        #create recording device for membrane voltage
-        self.vm = neuron.h.Vector()
-        self.vm.record(self(0.5)._ref_v)
-        
+        self.gid = gid
+
+        # spike detector writing spike times and gid into the global buffers,
+        # registered as the spike source of this gid on this rank
+        self.spike_detector = neuron.h.NetCon(self(0.5)._ref_v, None,
+                                              sec=self)
+        self.spike_detector.threshold = threshold
+        self.spike_detector.record(spike_times, spike_gids,
+                                   -1 if gid is None else gid)
+        if gid is not None:
+            pc.set_gid2node(gid, rank)
+            pc.cell(gid, self.spike_detector)
+
+        #create recording device for membrane voltage, if requested
+        if record_v:
+            self.vm = neuron.h.Vector()
+            if rec_dt is None:
+                self.vm.record(self(0.5)._ref_v)
+            else:
+                self.vm.record(self(0.5)._ref_v, rec_dt)
+        else:
+            self.vm = None
+
         # create lists containing Synapses, NetStim and NetCon devices
         self.synapses = []
         self.netstims = []
@@ -49,10 +114,10 @@ class HHCell(neuron.nrn.Section):
 
 
     def create_noise_input(self, noise=1., start=0., number=10000, interval=10.,
-                           tau=1., e=0., weight=0.002):
+                           tau=1., e=0., weight=0.002, seed=0):
         '''
         Create and attach noisy input to neuron.
-        
+
         Parameters
         ----------
         noise : float, Fractional randomness (1 = intervals from exp dist)
@@ -62,6 +127,8 @@ class HHCell(neuron.nrn.Section):
         tau : float, synapse time constant
         e : float, synapse reversal potential
         weight : float, synapse strength
+        seed : int, seed of the noise stream (combined with the cell gid,
+            not used for cells without a gid)
         '''
         # Create a NetStim device to activate synapse
         self.netstims.append(neuron.h.NetStim(0.5))    # spike generator object
@@ -69,127 +136,204 @@ class HHCell(neuron.nrn.Section):
         self.netstims[-1].start = start
         self.netstims[-1].number = number
         self.netstims[-1].interval = interval
+        # Each NetStim of a cell with a gid draws from its own Random123
+        # stream identified by the gid, so the input does not depend on the
+        # number of threads or ranks the network is distributed over.
+        if self.gid is not None:
+            self.netstims[-1].noiseFromRandom123(self.gid,
+                                                 len(self.netstims), seed)
         # Some may wonder about indexing the last element, turns out one cannot
         # create python object, set the parameters and then append the object to
         # the list. The network may break when the original python object
-        # reference is destroyed, i.e., when the function is done executing. 
-        
+        # reference is destroyed, i.e., when the function is done executing.
+
         # Create a synapse
         self.synapses.append(neuron.h.ExpSyn(0.5, sec=self))
         self.synapses[-1].tau = tau
         self.synapses[-1].e = e
-        
+
         # Connect NetStim device to synapse
         self.netcons.append(neuron.h.NetCon(self.netstims[-1],
                                             self.synapses[-1]))
         self.netcons[-1].weight[0] = weight
-        
 
-    def connect_cell(self, target, threshold=0., tau=2., e=-80.,
-                     weight=0.1, delay=2.):
+
+    def connect_from(self, source_gid, tau=2., e=-80., weight=0.1, delay=2.):
         '''
-        Connect synapse on postsynaptic cell to this cell with a specific
-        weight and delay, triggered on this presynaptic cell's potential
-        
+        Connect a new synapse on this (postsynaptic) cell to the presynaptic
+        cell with gid `source_gid`. The presynaptic cell may live on any rank,
+        its spikes are delivered through the ParallelContext. The spike
+        detection threshold is set by the presynaptic cell.
+
         Parameters
         ----------
-        target : HHCell object, presynaptic neuron
-        threshold : float, spike detection threshold
+        source_gid : int, gid of presynaptic neuron
         tau : float, synapse time constant
         e : float, synapse reversal potential
         weight : float, connection weight
         delay : float, connection delay
         '''
-        # Create a synapse object on the target cell
-        target.synapses.append(neuron.h.ExpSyn(0.5, sec=target))
-        target.synapses[-1].tau = tau
-        target.synapses[-1].e = e
-
-        
-        # Create new NetCon objects for the connections
-        self.netcons.append(neuron.h.NetCon(self(0.5)._ref_v,
-                                            target.synapses[-1],
-                                            sec=self))
-        self.netcons[-1].threshold = threshold
+        # Create a synapse object on this cell
+        self.synapses.append(neuron.h.ExpSyn(0.5, sec=self))
+        self.synapses[-1].tau = tau
+        self.synapses[-1].e = e
+
+        # Create new NetCon object receiving spikes from the source gid
+        self.netcons.append(pc.gid_connect(source_gid, self.synapses[-1]))
         self.netcons[-1].weight[0] = weight
         self.netcons[-1].delay = delay
 
- 
-################################################################################
-# fill in a list with HHCell objects
-################################################################################
-cells = [HHCell() for x in range(5)]
 
 ################################################################################
-# create noisy input to each cell to keep them activated
+# Create a class for the network, distributing cells over ranks and threads
 ################################################################################
-for i in range(len(cells)):
-    cells[i].create_noise_input()
+class Network(object):
+    '''
+    Network of HHCell objects with noisy input and inhibitory connections.
+    Cell gids are assigned round-robin to the MPI ranks (gid % nhost == rank),
+    and each rank only creates its own cells and their incoming connections.
+    '''
+    def __init__(self, ncells=5, indegree=None, record_gids=(), rec_dt=None,
+                 weight=0.1, delay=2., seed=1234, cell_params=None,
+                 noise_params=None):
+        '''
+        Parameters
+        ----------
+        ncells : int, total number of cells in the network
+        indegree : int or None, number of random presynaptic cells per cell
+            (None: all-to-all connectivity avoiding connections to self)
+        record_gids : sequence of int, gids for which voltage is recorded
+        rec_dt : float or None, voltage sampling interval (None: every dt)
+        weight : float, connection weight
+        delay : float, connection delay
+        seed : int, seed for connectivity and noise input
+        cell_params : dict or None, keyword arguments passed on to HHCell
+        noise_params : dict or None, keyword arguments passed on to
+            HHCell.create_noise_input
+        '''
+        cell_params = dict(cell_params or {})
+        noise_params = dict(noise_params or {})
+        self.ncells = ncells
+        self.gids = list(range(rank, ncells, nhost))
+        self.cells = [HHCell(gid=gid, record_v=gid in record_gids,
+                             rec_dt=rec_dt, **cell_params)
+                      for gid in self.gids]
 
-################################################################################
-# connect all cells to all other cells in an inhibitory network
-# (avoiding connections to self)
-################################################################################
-for i in range(len(cells)):     # pre
-    for j in range(len(cells)): # post
-        if i != j:
-            cells[i].connect_cell(cells[j])
+        # create noisy input to each cell to keep them activated
+        for cell in self.cells:
+            cell.create_noise_input(seed=seed, **noise_params)
 
-################################################################################
-# Recording of additional variables
-################################################################################
-t = neuron.h.Vector()
-t.record(neuron.h._ref_t)
+        # connect each cell to its presynaptic cells. The presynaptic gids are
+        # drawn from a gid-specific random stream so the connectivity does
+        # not depend on how cells are distributed over ranks.
+        for cell in self.cells:
+            if indegree is None:
+                sources = [gid for gid in range(ncells) if gid != cell.gid]
+            else:
+                rng = np.random.RandomState(seed + cell.gid)
+                candidates = np.delete(np.arange(ncells), cell.gid)
+                sources = rng.choice(candidates, indegree, replace=False)
+            for source_gid in sources:
+                cell.connect_from(int(source_gid), weight=weight, delay=delay)
 
+    def run(self, tstop, v_init=-65., nthread=1, dt=0.1):
+        '''
+        Initialize and run the network until tstop using nthread threads on
+        each rank, and return the wall clock time spent in integration.
+        '''
+        pc.nthread(nthread)
+        neuron.h.dt = dt
+        pc.set_maxstep(10)
+        neuron.h.finitialize(v_init)
+        neuron.h.fcurrent()
+        pc.barrier()
+        t0 = pc.time()
+        pc.psolve(tstop)
+        pc.barrier()
+        return pc.time() - t0
 
-################################################################################
-# Simulation control
-################################################################################
-neuron.h.dt = 0.1   # simulation time resolution
-tstop = 500.        # simulation duration
-v_init = -65        # membrane voltage(s) at t = 0
+    def gather_spikes(self):
+        '''
+        Return spike times and gids from all ranks as numpy arrays on rank 0
+        (None on the other ranks), sorted by spike time.
+        '''
+        data = pc.py_gather((spike_times.to_python(), spike_gids.to_python()),
+                            0)
+        if rank != 0:
+            return None, None
+        times = np.concatenate([d[0] for d in data])
+        gids = np.concatenate([d[1] for d in data])
+        order = np.argsort(times, kind='stable')
+        return times[order], gids[order].astype(int)
 
-def initialize():
-    '''
-    initializing function, setting the membrane voltages to v_init and
-    resetting all state variables
-    '''
-    neuron.h.finitialize(v_init)
-    neuron.h.fcurrent()
 
-def integrate():
-    '''
-    run the simulation up until the simulation duration
-    '''
-    while neuron.h.t < tstop:
-        neuron.h.fadvance()
+if __name__ == '__main__':
+    import matplotlib.pyplot as plt
 
-# run simulation
-initialize()
-integrate()
+    ############################################################################
+    # Recording policy: spikes are recorded from all cells, voltage only from
+    # the cells in record_gids, sampled every rec_dt ms (None: every time step)
+    ############################################################################
+    ncells = 5
+    record_gids = [0, 1]
+    rec_dt = 0.5
+    nthread = int(sys.argv[1]) if len(sys.argv) > 1 else 1
 
-################################################################################
-# Plot simulated output
-################################################################################
-fig, axes = plt.subplots(len(cells))
-fig.suptitle('point-neuron responses')
-for i, cell in enumerate(cells):
-    axes[i].plot(t, cell.vm, 'r', lw=2)
-    axes[i].axis(axes[i].axis('tight'))
-    axes[i].set_ylabel('cell {}'.format(i+1))
-axes[i].set_xlabel('time (ms)')
+    ############################################################################
+    # create the network; with a fully connected inhibitory network, each
+    # cell receives input from all other cells
+    ############################################################################
+    net = Network(ncells=ncells, record_gids=record_gids, rec_dt=rec_dt)
 
-fig.savefig('example_7.pdf')
-plt.show()
-plt.close(fig)
+    ############################################################################
+    # Simulation control
+    ############################################################################
+    tstop = 500.        # simulation duration
+    v_init = -65        # membrane voltage(s) at t = 0
 
+    dt = 0.1            # simulation time resolution
 
-################################################################################
-# customary cleanup of object references - the psection() function may not write
-# correct information if NEURON still has object references in memory, even if
-# Python references has been deleted.
-################################################################################
-for cell in cells:
-    cell = None
-cells = None
+    # run simulation
+    net.run(tstop, v_init=v_init, nthread=nthread, dt=dt)
+
+    # voltage traces are sent to rank 0 for plotting
+    traces = pc.py_gather([(cell.gid, cell.vm.to_python())
+                           for cell in net.cells if cell.vm is not None], 0)
+    times, gids = net.gather_spikes()
+
+    ############################################################################
+    # Plot simulated output
+    ############################################################################
+    if rank == 0:
+        traces = sorted(sum(traces, []))
+        fig, axes = plt.subplots(len(traces) + 1, sharex=True)
+        fig.suptitle('point-neuron responses')
+        for i, (gid, vm) in enumerate(traces):
+            # time axis of the (possibly decimated) voltage recordings
+            t = np.arange(len(vm)) * (dt if rec_dt is None else rec_dt)
+            axes[i].plot(t, vm, 'r', lw=2)
+            axes[i].axis(axes[i].axis('tight'))
+            axes[i].set_ylabel('cell {}'.format(gid+1))
+
+        # spike raster of all cells from the global spike buffers
+        axes[-1].plot(times, gids + 1, 'k|', ms=10)
+        axes[-1].set_ylim(0.5, ncells + 0.5)
+        axes[-1].set_ylabel('cell')
+        axes[-1].set_xlabel('time (ms)')
+
+        fig.savefig('example_7.pdf')
+        plt.show()
+        plt.close(fig)
+
+
+    ############################################################################
+    # customary cleanup of object references - the psection() function may not
+    # write correct information if NEURON still has object references in
+    # memory, even if Python references has been deleted.
+    ############################################################################
+    net = None
 
+    # finalize MPI (if in use) and exit NEURON
+    pc.barrier()
+    pc.done()
+    neuron.h.quit()
@@ -0,0 +1,112 @@
+#!/usr/env/bin python
+# -*- coding: utf-8 -*-
+'''
+NEURON and Python - Strong-scaling benchmark of the HHCell network from
+example_7.py
+
+A fixed network (ncells cells with random inhibitory connections) is
+simulated with 1, 2, 4 and 8 workers, first as threads in one process
+(ParallelContext.nthread), then as MPI ranks (mpiexec -n N). The wall clock
+time of the integration and the speedup relative to one worker are printed.
+
+    python example_7_scaling.py
+
+A single MPI measurement is made by launching this file with the 'worker'
+argument under mpiexec, which is what the benchmark does for each rank count.
+'''
+import os
+import sys
+import shutil
+import subprocess
+
+ncells = 1000       # number of cells, fixed for all worker counts
+indegree = 50       # presynaptic cells per cell
+weight = 0.002      # connection weight, scaled down for the larger indegree
+tstop = 1000.       # simulation duration in ms
+workers = [1, 2, 4, 8]
+
+
+def build_and_run(nthread=1):
+    '''
+    build the benchmark network and return the integration time and the
+    number of spikes on rank 0 (None on other ranks)
+    '''
+    from example_7 import Network, pc
+    net = Network(ncells=ncells, indegree=indegree, weight=weight)
+    sim_time = net.run(tstop, nthread=nthread)
+    times, gids = net.gather_spikes()
+    pc.barrier()
+    if times is None:
+        return None
+    return sim_time, len(times)
+
+
+def run_threads():
+    '''
+    strong scaling over threads in a single process. The network is built
+    once and re-run with increasing number of threads
+    '''
+    from example_7 import Network, pc, spike_times, spike_gids
+    net = Network(ncells=ncells, indegree=indegree, weight=weight)
+    results = []
+    for nthread in workers:
+        spike_times.resize(0)
+        spike_gids.resize(0)
+        sim_time = net.run(tstop, nthread=nthread)
+        results.append((nthread, sim_time, int(spike_times.size())))
+    pc.nthread(1)
+    return results
+
+
+def run_mpi():
+    '''
+    strong scaling over MPI ranks, each rank count in a separate mpiexec call
+    '''
+    mpiexec = shutil.which('mpiexec')
+    if mpiexec is None:
+        print('mpiexec not found, skipping MPI benchmark')
+        return []
+    here = os.path.dirname(os.path.abspath(__file__))
+    results = []
+    for nhost in workers:
+        output = subprocess.run([mpiexec, '-n', str(nhost), sys.executable,
+                                 os.path.abspath(__file__), 'worker'],
+                                cwd=here, capture_output=True, text=True)
+        lines = [line for line in output.stdout.splitlines()
+                 if line.startswith('RESULT')]
+        if output.returncode != 0 or not lines:
+            print('MPI run with {} ranks failed:\n{}'.format(nhost,
+                                                              output.stderr))
+            continue
+        _, sim_time, nspikes = lines[-1].split()
+        results.append((nhost, float(sim_time), int(nspikes)))
+    return results
+
+
+def print_table(title, results):
+    '''
+    print wall clock times and speedups relative to the first entry
+    '''
+    print(title)
+    print('{:>8} {:>12} {:>10} {:>10}'.format('workers', 'time (s)',
+                                               'speedup', 'spikes'))
+    for n, sim_time, nspikes in results:
+        print('{:>8} {:>12.3f} {:>10.2f} {:>10}'.format(
+            n, sim_time, results[0][1] / sim_time, nspikes))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'worker':
+        result = build_and_run()
+        if result is not None:
+            print('RESULT {} {}'.format(*result))
+        from example_7 import pc
+        import neuron
+        pc.barrier()
+        pc.done()
+        neuron.h.quit()
+    else:
+        print('{} cells, indegree {}, tstop {} ms, {} cores available'.format(
+            ncells, indegree, tstop, os.cpu_count()))
+        print_table('threads (ParallelContext.nthread)', run_threads())
+        print_table('MPI ranks (mpiexec -n)', run_mpi())
@@ -0,0 +1,127 @@
+#!/usr/env/bin python
+# -*- coding: utf-8 -*-
+'''
+NEURON and Python - Streaming noise current stimulus
+
+Instead of precomputing the whole noise signal and playing it into the clamp
+amplitude with Vector.play, the noise is generated on the fly in blocks of
+fixed size. Memory use is therefore independent of the simulation duration,
+and the stimulus never runs out.
+
+Each clamp draws from its own, independently seeded random number stream.
+Both white noise and Ornstein-Uhlenbeck (low-pass filtered) noise are
+supported. Example usage:
+
+    iclamp = neuron.h.IClamp(0.5, sec=soma)
+    iclamp.delay = 0.
+    iclamp.dur = 1E9
+    noise = NoiseCurrent(dt=0.1)
+    noise.add_clamp(iclamp, mean=0., std=0.25, seed=1234)
+
+'''
+import numpy as np
+from scipy.signal import lfilter
+import neuron
+
+
+class NoiseCurrent(object):
+    '''
+    Noisy current amplitudes for any number of IClamp objects, updated every
+    dt ms. Values for all clamps are written with a single PtrVector scatter
+    per update, and new values are drawn in blocks of block_size samples, so
+    memory use is (number of clamps) x block_size.
+    '''
+    def __init__(self, dt=0.1, block_size=1000, seed=None):
+        '''
+        Parameters
+        ----------
+        dt : float, update interval of the current amplitudes in ms
+        block_size : int, number of samples generated per clamp at a time
+        seed : int or None, seed from which streams of clamps added without
+            an explicit seed are derived
+        '''
+        self.dt = dt
+        self.block_size = block_size
+        self.seed_sequence = np.random.SeedSequence(seed)
+
+        self.clamps = []
+        self.params = []
+
+        # (re)start the noise streams on every call to finitialize
+        self.cvode = neuron.h.CVode()
+        self.fih = neuron.h.FInitializeHandler(1, self._initialize)
+
+
+    def add_clamp(self, iclamp, mean=0., std=0.25, tau=None, seed=None):
+        '''
+        Drive the amplitude of iclamp with noise.
+
+        Parameters
+        ----------
+        iclamp : IClamp object, should have delay=0 and long duration
+        mean : float, mean current in nA
+        std : float, standard deviation of the current in nA
+        tau : float or None, correlation time of Ornstein-Uhlenbeck noise in
+            ms (None: white noise, drawn independently every dt)
+        seed : int or None, seed of the random stream of this clamp (None:
+            derived from the seed of the NoiseCurrent object)
+        '''
+        if seed is None:
+            seed = self.seed_sequence.spawn(1)[0]
+        self.clamps.append(iclamp)
+        self.params.append(dict(mean=mean, std=std, tau=tau, seed=seed))
+
+
+    def _initialize(self):
+        '''
+        set up the random streams and pointers, fill in the first block and
+        schedule the first update
+        '''
+        nclamps = len(self.clamps)
+        self.rngs = [np.random.default_rng(p['seed']) for p in self.params]
+        self.ou_state = np.zeros(nclamps)
+
+        self.ptrs = neuron.h.PtrVector(nclamps)
+        for i, iclamp in enumerate(self.clamps):
+            self.ptrs.pset(i, iclamp._ref_amp)
+        self.values = neuron.h.Vector(nclamps)
+        self.block = np.empty((nclamps, self.block_size))
+
+        # the OU process starts from its stationary distribution
+        for i, p in enumerate(self.params):
+            if p['tau'] is not None:
+                self.ou_state[i] = self.rngs[i].standard_normal()
+
+        self.step = 0
+        self._fill_block()
+        self._update()
+
+
+    def _fill_block(self):
+        '''
+        draw the next block_size samples for all clamps
+        '''
+        for i, p in enumerate(self.params):
+            xi = self.rngs[i].standard_normal(self.block_size)
+            if p['tau'] is not None:
+                # exact update of the unit variance OU process over one dt:
+                # x[k+1] = a x[k] + sqrt(1 - a^2) xi[k]
+                a = np.exp(-self.dt / p['tau'])
+                xi, zi = lfilter([np.sqrt(1. - a**2)], [1., -a], xi,
+                                 zi=[a * self.ou_state[i]])
+                self.ou_state[i] = xi[-1]
+            self.block[i] = p['mean'] + p['std'] * xi
+
+
+    def _update(self):
+        '''
+        write the current sample of all clamps and schedule the next update
+        '''
+        k = self.step % self.block_size
+        if k == 0 and self.step > 0:
+            self._fill_block()
+        self.values.from_python(self.block[:, k])
+        self.ptrs.scatter(self.values)
+        self.step += 1
+        # times are computed from the step count to avoid round-off drift
+        self.cvode.event(self.step * self.dt, self._update)
@@ -0,0 +1,7 @@
+from .state_cache import StateCache
+from .mechanisms import load_mechanisms, build_mechanisms
+from .morphology import MorphologyIndex
+from .lfp import (get_transformation_matrix, extracellular_potential,
+                  lfp_chunked)
+from .discretization import optimize_nseg
+from .profiler import profile, Profile
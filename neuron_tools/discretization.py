@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+'''
+Accuracy-aware choice of the number of segments (nseg) of each section.
+
+The models of the course are discretized with ad hoc rules: geom_nseg of the
+Hay model uses 1 + 2*int(L/40), Exercise 4 nseg = int(L/10), Exercise 9
+lambda_f = 100 and example_6.py fixed values (25, 5, 35). optimize_nseg()
+instead picks per-section nseg values for a given model and stimulus that
+keep the membrane potential within a voltage tolerance of a refined
+reference:
+
+  1. the reference is the model with every section refined (refine times
+     the larger of its current nseg and the d_lambda = 0.1 rule at 100 Hz),
+     simulated once. The membrane potential is recorded at the center of
+     every section, which is a node for any odd nseg, so all
+     discretizations are compared at the same locations.
+  2. the frequency content of the stimulus (frequency, by default the
+     frequency below which 99 % of the power of the reference traces lies)
+     gives the AC length constant lambda_f of every section, and the
+     largest d_lambda (segment length in units of lambda_f) whose d_lambda
+     rule meets the tolerance is searched.
+  3. sections are then coarsened one at a time (nseg reduced by a third),
+     largest nseg first, as long as the error stays within the tolerance,
+     until no section can be coarsened or max_evaluations simulations have
+     been run.
+
+Only odd nseg values are used, so that point processes at the section
+centers and the recording sites do not move. Example usage:
+
+    from neuron_tools.discretization import optimize_nseg
+    ... build the model and its stimulus ...
+    result = optimize_nseg(tolerance=0.5, tstop=200.)
+    print(result['nseg'], result['error'])
+
+When nseg changes, NEURON copies range variables from the old segments, so
+distance dependent parameters (e.g. distribute_channels of the Hay model)
+must be set again by a configure function, which is called after every
+change of nseg. Run this file for the model of example_6.py, or with a
+morphology .hoc file as argument.
+'''
+import sys
+import time
+import numpy as np
+import neuron
+h = neuron.h
+h.load_file('stdrun.hoc')
+
+
+def lambda_f(sec, frequency=100.):
+    '''
+    AC length constant (um) of a section at frequency (Hz), as lambda_f of
+    the NEURON standard library (averaged over the 3D points)
+    '''
+    factor = 4 * np.pi * frequency * sec.Ra * sec.cm
+    n3d = int(sec.n3d())
+    if n3d < 2:
+        return 1e5 * np.sqrt(sec.diam / factor)
+    arc = np.array([sec.arc3d(i) for i in range(n3d)])
+    diam = np.array([sec.diam3d(i) for i in range(n3d)])
+    lam = np.sum(np.diff(arc) / np.sqrt(diam[1:] + diam[:-1]))
+    return sec.L / (lam * np.sqrt(2) * 1e-5 * np.sqrt(factor))
+
+
+def d_lambda_nseg(sec, d_lambda=0.1, frequency=100.):
+    '''
+    odd nseg with segments of at most d_lambda * lambda_f(frequency)
+    '''
+    return int((sec.L / (d_lambda * lambda_f(sec, frequency)) + 0.9) / 2) \
+        * 2 + 1
+
+
+def _odd(n):
+    n = max(1, int(n))
+    return n if n % 2 else n - 1
+
+
+def frequency_content(v, dt, fraction=0.99):
+    '''
+    Frequency (Hz) below which fraction of the power of the traces v (shape
+    (n_traces, n_t), sampled every dt ms) lies, without the mean
+    '''
+    v = np.atleast_2d(v)
+    power = (np.abs(np.fft.rfft(v - v.mean(axis=1, keepdims=True),
+                                axis=1))**2).sum(axis=0)
+    frequencies = np.fft.rfftfreq(v.shape[1], dt * 1e-3)
+    cumulative = np.cumsum(power)
+    if cumulative[-1] == 0:
+        return frequencies[1]
+    return frequencies[np.searchsorted(cumulative, fraction * cumulative[-1])]
+
+
+class _Simulation(object):
+    '''
+    Runs the model with given nseg values and records the membrane
+    potential at the section centers.
+    '''
+    def __init__(self, sections, run, configure, tstop, v_init, dt):
+        self.sections = sections
+        self.run = run
+        self.configure = configure
+        self.tstop = tstop
+        self.v_init = v_init
+        self.dt = dt
+        self.evaluations = 0
+        self.time = 0.
+
+    def __call__(self, nseg):
+        for sec, n in zip(self.sections, nseg):
+            sec.nseg = int(n)
+        if self.configure is not None:
+            self.configure()
+        vectors = [h.Vector().record(sec(0.5)._ref_v, self.dt)
+                   for sec in self.sections]
+        t0 = time.time()
+        if self.run is None:
+            h.dt = self.dt
+            h.finitialize(self.v_init)
+            h.continuerun(self.tstop)
+        else:
+            self.run()
+        self.time += time.time() - t0
+        self.evaluations += 1
+        n = min(len(v) for v in vectors)
+        return np.array([np.array(v)[:n] for v in vectors])
+
+
+def optimize_nseg(sections=None, tolerance=0.5, frequency=None, run=None,
+                  configure=None, tstop=100., v_init=-65., dt=0.025,
+                  refine=3, max_evaluations=100, verbose=False):
+    '''
+    Find small per-section nseg values that keep the membrane potential at
+    the section centers within tolerance of a refined reference, see the
+    module docstring. The sections are left with the chosen nseg.
+
+    Parameters
+    ----------
+    sections : list of sections or None (all sections)
+    tolerance : float, largest absolute voltage difference to the reference
+        over time and sections (mV)
+    frequency : float or None, frequency (Hz) for lambda_f, None: estimated
+        from the reference traces
+    run : callable or None, runs one simulation of the model with its
+        stimulus, None: h.finitialize(v_init) and h.continuerun(tstop)
+    configure : callable or None, called after nseg changed, e.g. to set
+        distance dependent parameters again
+    tstop, v_init, dt : float, simulation duration, initial potential and
+        time step (dt is also the recording interval if run is given)
+    refine : int, odd refinement factor of the reference
+    max_evaluations : int, largest number of simulations
+    verbose : bool, print progress
+
+    Returns
+    -------
+    result : dict with 'nseg' (section name -> nseg), 'error' (mV), 'total'
+        (sum of nseg), 'reference_total', 'd_lambda', 'frequency' (Hz),
+        'evaluations' and 'time' (s, spent simulating)
+    '''
+    sections = list(h.allsec()) if sections is None else list(sections)
+    simulate = _Simulation(sections, run, configure, tstop, v_init, dt)
+    reference_nseg = np.array([_odd(refine) * _odd(max(
+        sec.nseg, d_lambda_nseg(sec, 0.1, 100.))) for sec in sections])
+    reference = simulate(reference_nseg)
+    if frequency is None:
+        frequency = max(frequency_content(reference, dt), 1.)
+
+    def error(nseg):
+        v = simulate(nseg)
+        n = min(v.shape[1], reference.shape[1])
+        err = np.abs(v[:, :n] - reference[:, :n]).max()
+        if verbose:
+            print('{} segments: error {:.3f} mV'.format(nseg.sum(), err))
+        return err
+
+    ## largest d_lambda meeting the tolerance, on a factor 2 grid
+    def rule(d_lambda):
+        return np.minimum([d_lambda_nseg(sec, d_lambda, frequency)
+                           for sec in sections], reference_nseg)
+
+    d_lambda, nseg = 0.1, rule(0.1)
+    err = error(nseg)
+    if err <= tolerance:
+        while simulate.evaluations < max_evaluations and nseg.sum() > len(
+                sections):
+            candidate = rule(2 * d_lambda)
+            if np.array_equal(candidate, nseg):
+                d_lambda *= 2
+                continue
+            candidate_err = error(candidate)
+            if candidate_err > tolerance:
+                break
+            d_lambda, nseg, err = 2 * d_lambda, candidate, candidate_err
+    else:
+        while simulate.evaluations < max_evaluations:
+            d_lambda /= 2
+            nseg = rule(d_lambda)
+            if np.array_equal(nseg, reference_nseg):
+                err = 0.
+                break
+            err = error(nseg)
+            if err <= tolerance:
+                break
+    if verbose:
+        print('d_lambda {:g} at {:.0f} Hz: {} segments, error {:.3f} mV'
+              .format(d_lambda, frequency, nseg.sum(), err))
+
+    ## coarsen single sections, largest nseg first
+    changed = True
+    while changed and simulate.evaluations < max_evaluations:
+        changed = False
+        for i in np.argsort(-nseg, kind='stable'):
+            if nseg[i] == 1 or simulate.evaluations >= max_evaluations:
+                continue
+            candidate = nseg.copy()
+            candidate[i] = _odd(nseg[i] * 2 // 3)
+            candidate_err = error(candidate)
+            if candidate_err <= tolerance:
+                nseg, err, changed = candidate, candidate_err, True
+                if verbose:
+                    print('{}: nseg {}, error {:.3f} mV'.format(
+                        sections[i].name(), nseg[i], err))
+
+    for sec, n in zip(sections, nseg):
+        sec.nseg = int(n)
+    if configure is not None:
+        configure()
+    return {'nseg': {sec.name(): int(n) for sec, n in zip(sections, nseg)},
+            'error': err, 'total': int(nseg.sum()),
+            'reference_total': int(reference_nseg.sum()),
+            'd_lambda': d_lambda, 'frequency': frequency,
+            'evaluations': simulate.evaluations, 'time': simulate.time}
+
+
+def _run_time(tstop, v_init, dt, repeat=3):
+    times = []
+    for i in range(repeat):
+        t0 = time.time()
+        h.dt = dt
+        h.finitialize(v_init)
+        h.continuerun(tstop)
+        times.append(time.time() - t0)
+    return min(times)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        ## morphology with passive dendrites, active soma and a dendritic
+        ## synapse
+        h.load_file(sys.argv[1])
+        h.define_shape()
+        sections = list(h.allsec())
+        for sec in sections:
+            sec.Ra, sec.cm = 150., 1.
+            if 'soma' in sec.name():
+                sec.insert('hh')
+            else:
+                sec.insert('pas')
+                sec.g_pas, sec.e_pas = 1e-4, -65.
+        ad_hoc = {sec.name(): 1 + 2 * int(sec.L / 40) for sec in sections}
+        dend = max(sections, key=lambda sec: h.distance(sections[0](0.5),
+                                                         sec(0.5)))
+        weight = 0.05
+    else:
+        ## the model of example_6.py
+        soma, apic, dend, axon = [h.Section(name=name) for name in
+                                  ['soma', 'apic', 'dend', 'axon']]
+        apic.connect(soma(1), 0)
+        dend.connect(soma(0), 0)
+        axon.connect(soma(0), 0)
+        sections = [soma, apic, dend, axon]
+        for sec, L, diam in zip(sections, [30., 600., 200., 1000.],
+                                [30., 1., 2., 1.]):
+            sec.L, sec.diam, sec.Ra, sec.cm = L, diam, 100., 1.
+        for sec in [apic, dend]:
+            sec.insert('pas')
+            sec.g_pas, sec.e_pas = 0.0002, -65.
+        for sec in [soma, axon]:
+            sec.insert('hh')
+        ad_hoc = {'soma': 1, 'apic': 25, 'dend': 5, 'axon': 35}
+        dend = apic
+        weight = 2.
+    syn = h.ExpSyn(dend(0.5))
+    syn.e, syn.tau = 0., 2.
+    stim = h.NetStim()
+    stim.noise, stim.start, stim.number, stim.interval = 1., 0., 1000, 10.
+    stim.seed(1234)
+    netcon = h.NetCon(stim, syn)
+    netcon.weight[0] = weight
+    tstop, v_init, dt = 200., -65., 0.025
+
+    for sec in sections:
+        sec.nseg = ad_hoc[sec.name()]
+    t_ad_hoc = _run_time(tstop, v_init, dt)
+
+    t0 = time.time()
+    ## error of the ad hoc nseg, against the reference of optimize_nseg
+    simulate = _Simulation(sections, None, None, tstop, v_init, dt)
+    reference = simulate([3 * _odd(max(ad_hoc[sec.name()],
+                                       d_lambda_nseg(sec)))
+                          for sec in sections])
+    error = np.abs(simulate([ad_hoc[sec.name()] for sec in sections])
+                   - reference).max()
+    print('ad hoc nseg: {} segments, {:.3f} s per run, error {:.3f} mV'
+          .format(sum(ad_hoc.values()), t_ad_hoc, error))
+
+    for tolerance in [0.5, 2.]:
+        for sec in sections:
+            sec.nseg = ad_hoc[sec.name()]
+        t0 = time.time()
+        result = optimize_nseg(sections, tolerance=tolerance, tstop=tstop,
+                               v_init=v_init, dt=dt)
+        t_optimize = time.time() - t0
+        t_optimized = _run_time(tstop, v_init, dt)
+        print('optimized for {:g} mV ({} simulations, {:.1f} s, frequency '
+              '{:.0f} Hz, d_lambda {:g}): {} segments, {:.3f} s per run, '
+              'error {:.3f} mV'.format(
+                  tolerance, result['evaluations'], t_optimize,
+                  result['frequency'], result['d_lambda'], result['total'],
+                  t_optimized, result['error']))
+        if len(sections) <= 10:
+            print('  nseg: {}'.format(result['nseg']))
@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+'''
+Cached electrode transformation matrices for LFP computations.
+
+The extracellular potential of a cell is M @ cell.imem, where the
+transformation matrix M (n_electrodes x n_segments) depends only on the
+segment geometry, the electrode positions and the electrode parameters.
+Functions such as dense_2D_LFP in Exercise 9 construct an
+LFPy.RecExtElectrode and call get_transformation_matrix() on every call,
+although only the synapse position or weight changed between runs.
+get_transformation_matrix() here keys M by a hash of the segment
+coordinates and diameters, the electrode positions and parameters (sigma,
+method, contact shape) and the LFPy version, keeps it in memory and stores
+it in cache_dir, so it is computed once per morphology and electrode setup.
+The in-memory cache holds at most max_memory bytes of matrices (see
+set_max_memory) and cache_dir at most max_disk bytes (see set_max_disk),
+the least recently used are dropped first. Example usage:
+
+    from neuron_tools.lfp import extracellular_potential
+    cell.simulate(rec_imem=True)
+    data = extracellular_potential(cell, elec_x, elec_y, elec_z, sigma=0.3)
+
+For dense grids (e.g. 3-D grids around the Hay model), lfp_chunked()
+computes the potential in tiles of electrodes and time steps, reads the
+currents from a memory-mapped .npy file written by save_imem() and writes
+the potential to a memory-mapped .npy file, with the tiles in memory bounded
+by memory_budget:
+
+    save_imem(cell, 'imem.npy')
+    del cell.imem
+    data = lfp_chunked(cell, x, y, z, 'lfp.npy', imem='imem.npy',
+                       memory_budget=64e6)
+
+LFPy is only imported when a matrix has to be computed. Run this file with
+a morphology .hoc file as argument to compare cached and uncached
+computations on the 26 x 26 electrode grid of Exercise 9, and the chunked
+computation on a 3-D grid.
+'''
+import os
+import sys
+import time
+import hashlib
+import numpy as np
+
+# in order of use, least recently used first
+_matrix_cache = {}
+_max_memory = 512e6
+_max_disk = 2e9
+
+
+def set_max_memory(max_memory):
+    '''
+    Bound the bytes of the matrices kept in memory (default 512 MB)
+    '''
+    global _max_memory
+    _max_memory = max_memory
+    _evict()
+
+
+def _evict():
+    total = sum(M.nbytes for M in _matrix_cache.values())
+    for key in list(_matrix_cache):
+        if total <= _max_memory:
+            break
+        total -= _matrix_cache.pop(key).nbytes
+
+
+def set_max_disk(max_disk, cache_dir='.lfp_cache'):
+    '''
+    Bound the bytes of the matrix files kept in cache_dir (default 2 GB)
+    '''
+    global _max_disk
+    _max_disk = max_disk
+    _evict_disk(cache_dir)
+
+
+def _evict_disk(cache_dir, keep=None):
+    '''
+    remove the least recently used matrix files of cache_dir (by
+    modification time, which is updated when a file is read) until they
+    take at most _max_disk bytes, except the file keep
+    '''
+    if not os.path.isdir(cache_dir):
+        return
+    files = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.endswith('.npy') and path != keep:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for mtime, size, path in files)
+    if keep is not None and os.path.isfile(keep):
+        total += os.path.getsize(keep)
+    for mtime, size, path in sorted(files):
+        if total <= _max_disk:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+
+def _hash_arrays(sha, *arrays):
+    for array in arrays:
+        array = np.ascontiguousarray(array, dtype=float)
+        sha.update(repr(array.shape).encode())
+        sha.update(array.tobytes())
+
+
+def matrix_key(cell, x, y, z, **electrode_parameters):
+    '''
+    Return the hash of the segment geometry of cell, the electrode positions
+    and the other RecExtElectrode parameters (sigma, method, N, r, n,
+    contact_shape, ...).
+    '''
+    import LFPy
+    sha = hashlib.sha1(LFPy.__version__.encode())
+    _hash_arrays(sha, cell.x, cell.y, cell.z, cell.d, x, y, z)
+    ## the point source methods treat the soma segments differently
+    sha.update(repr(getattr(cell, 'somaidx', None)).encode())
+    for name, value in sorted(electrode_parameters.items()):
+        sha.update(name.encode())
+        if isinstance(value, (np.ndarray, list, tuple)):
+            _hash_arrays(sha, value)
+        else:
+            sha.update(repr(value).encode())
+    return sha.hexdigest()
+
+
+def get_transformation_matrix(cell, x, y, z, sigma=0.3, cache_dir='.lfp_cache',
+                              keep_in_memory=True, **electrode_parameters):
+    '''
+    Transformation matrix from the transmembrane currents of cell to the
+    potential at the electrode contacts, from the cache if possible.
+
+    Parameters
+    ----------
+    cell : LFPy.Cell
+    x, y, z : ndarray, electrode contact positions (um)
+    sigma : float, extracellular conductivity (S/m)
+    cache_dir : str or None, directory of cached matrices, bounded by
+        set_max_disk (None: in-memory cache only)
+    keep_in_memory : bool, keep the matrix in the in-memory cache, unless
+        it is larger than its size limit (False: matrices found in
+        cache_dir are returned memory-mapped)
+    **electrode_parameters : other LFPy.RecExtElectrode parameters, e.g.
+        method='root_as_point'. Contacts with random points (n > 1) must
+        have a fixed seedvalue to be cached meaningfully.
+
+    Returns
+    -------
+    M : ndarray, shape (n_electrodes, cell.totnsegs), potential (mV) per
+        segment current (nA)
+    '''
+    x, y, z = [np.atleast_1d(np.asarray(a, dtype=float)) for a in (x, y, z)]
+    electrode_parameters['sigma'] = sigma
+    key = matrix_key(cell, x, y, z, **electrode_parameters)
+    if key in _matrix_cache:
+        ## move to the end, as the most recently used
+        _matrix_cache[key] = _matrix_cache.pop(key)
+        return _matrix_cache[key]
+    path = None if cache_dir is None else os.path.join(cache_dir,
+                                                       key + '.npy')
+    if path is not None and os.path.isfile(path):
+        M = np.load(path, mmap_mode=None if keep_in_memory else 'r')
+        ## mark the file as recently used for _evict_disk
+        os.utime(path)
+    else:
+        import LFPy
+        electrode = LFPy.RecExtElectrode(cell, x=x, y=y, z=z,
+                                         **electrode_parameters)
+        M = electrode.get_transformation_matrix()
+        if path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            np.save(path, M)
+            _evict_disk(cache_dir, keep=path)
+    if keep_in_memory:
+        _matrix_cache[key] = M
+        _evict()
+    return M
+
+
+def extracellular_potential(cell, x, y, z, sigma=0.3, cache_dir='.lfp_cache',
+                            **electrode_parameters):
+    '''
+    Extracellular potential (mV) at the electrode contacts, shape
+    (n_electrodes, n_t), for a cell simulated with rec_imem=True. See
+    get_transformation_matrix for the parameters.
+    '''
+    M = get_transformation_matrix(cell, x, y, z, sigma, cache_dir,
+                                  **electrode_parameters)
+    return M @ cell.imem
+
+
+def save_imem(cell, filename, dtype=float):
+    '''
+    Write cell.imem to a .npy file that lfp_chunked() reads memory-mapped,
+    after which cell.imem can be deleted.
+    '''
+    imem = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype,
+                                     shape=cell.imem.shape)
+    imem[:] = cell.imem
+    imem.flush()
+    del imem
+
+
+def chunk_sizes(n_electrodes, n_segments, n_t, memory_budget, itemsize=8):
+    '''
+    Electrode and time tile sizes with at most memory_budget bytes for the
+    matrix tile (n_e x n_segments), the current tile (n_segments x n_t) and
+    the potential tile (n_e x n_t); half of the budget goes to the matrix
+    tile.
+    '''
+    budget = memory_budget / itemsize
+    n_e = int(min(n_electrodes, max(1, budget / 2 / n_segments)))
+    chunk_t = int(min(n_t, max(1, (budget - n_e * n_segments)
+                               / (n_segments + n_e))))
+    return n_e, chunk_t
+
+
+def lfp_chunked(cell, x, y, z, filename, imem=None, memory_budget=256e6,
+                sigma=0.3, dtype=float, cache_dir=None,
+                **electrode_parameters):
+    '''
+    Extracellular potential at many electrode contacts, computed in tiles of
+    electrodes and time steps and written to a memory-mapped .npy file, so
+    that neither the full transformation matrix, the full current array nor
+    the full potential array is held in memory.
+
+    Parameters
+    ----------
+    cell : LFPy.Cell, provides the segment geometry
+    x, y, z : ndarray, electrode contact positions (um)
+    filename : str, output .npy file, shape (n_electrodes, n_t)
+    imem : ndarray, memmap, str or None, transmembrane currents (nA), an
+        array, a .npy file written by save_imem (read memory-mapped) or
+        None: cell.imem
+    memory_budget : float, bound on the bytes of the tiles in memory
+    sigma : float, extracellular conductivity (S/m)
+    dtype : numpy dtype of the output
+    cache_dir : str or None, directory in which the matrix tiles are cached
+        (see get_transformation_matrix), None: not cached
+    **electrode_parameters : other LFPy.RecExtElectrode parameters
+
+    Returns
+    -------
+    data : memmap, extracellular potential (mV)
+    '''
+    x, y, z = [np.atleast_1d(np.asarray(a, dtype=float)) for a in (x, y, z)]
+    if imem is None:
+        imem = cell.imem
+    elif isinstance(imem, str):
+        imem = np.load(imem, mmap_mode='r')
+    n_segments, n_t = imem.shape
+    n_e, chunk_t = chunk_sizes(x.size, n_segments, n_t, memory_budget,
+                               max(np.dtype(dtype).itemsize,
+                                   imem.dtype.itemsize))
+    data = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype,
+                                     shape=(x.size, n_t))
+    for e0 in range(0, x.size, n_e):
+        e = slice(e0, e0 + n_e)
+        M = get_transformation_matrix(cell, x[e], y[e], z[e], sigma,
+                                      cache_dir, keep_in_memory=False,
+                                      **electrode_parameters)
+        for t0 in range(0, n_t, chunk_t):
+            t = slice(t0, t0 + chunk_t)
+            data[e, t] = M @ imem[:, t]
+        del M
+    data.flush()
+    return data
+
+
+def clear(cache_dir='.lfp_cache'):
+    '''
+    Remove the cached matrices in memory and in cache_dir
+    '''
+    _matrix_cache.clear()
+    if cache_dir is not None and os.path.isdir(cache_dir):
+        for fname in os.listdir(cache_dir):
+            if fname.endswith('.npy'):
+                os.remove(os.path.join(cache_dir, fname))
+
+
+if __name__ == '__main__':
+    import shutil
+    import tempfile
+    import LFPy
+
+    cell = LFPy.Cell(morphology=sys.argv[1], passive=True,
+                     nsegs_method='lambda_f', lambda_f=100, dt=2**-4,
+                     tstart=-100, tstop=100)
+    synapse = LFPy.Synapse(cell, idx=cell.get_closest_idx(0., 0., 0.), e=0.,
+                           syntype='ExpSyn', tau=10., weight=0.001)
+    synapse.set_spike_times(np.array([20.]))
+    cell.simulate(rec_imem=True)
+
+    ## the dense grid of Exercise 9
+    x, y = np.meshgrid(np.linspace(-1000, 1000, 26),
+                       np.linspace(-500, 1500, 26))
+    elec_x, elec_y = x.flatten(), y.flatten()
+    elec_z = np.zeros(elec_x.size)
+
+    t0 = time.time()
+    electrode = LFPy.RecExtElectrode(cell, sigma=0.3, x=elec_x, y=elec_y,
+                                     z=elec_z)
+    reference = electrode.get_transformation_matrix() @ cell.imem
+    t_lfpy = time.time() - t0
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        t0 = time.time()
+        extracellular_potential(cell, elec_x, elec_y, elec_z,
+                                cache_dir=cache_dir)
+        t_first = time.time() - t0
+        _matrix_cache.clear()
+        t0 = time.time()
+        extracellular_potential(cell, elec_x, elec_y, elec_z,
+                                cache_dir=cache_dir)
+        t_disk = time.time() - t0
+        t0 = time.time()
+        data = extracellular_potential(cell, elec_x, elec_y, elec_z,
+                                       cache_dir=cache_dir)
+        t_memory = time.time() - t0
+
+        ## a sweep of 5 shifted grids, with disk space for two matrices
+        M_bytes = elec_x.size * cell.totnsegs * 8
+        set_max_disk(2.5 * M_bytes, cache_dir)
+        for shift in range(5):
+            get_transformation_matrix(cell, elec_x + shift, elec_y, elec_z,
+                                      cache_dir=cache_dir,
+                                      keep_in_memory=False)
+        n_files = len(os.listdir(cache_dir))
+        set_max_disk(2e9, cache_dir)
+    finally:
+        shutil.rmtree(cache_dir)
+    print('{} electrodes, {} segments: RecExtElectrode {:.3f} s, first call '
+          '{:.3f} s, from disk {:.3f} s, from memory {:.4f} s, max '
+          'difference {:.1e} mV'.format(
+              elec_x.size, cell.totnsegs, t_lfpy, t_first, t_disk, t_memory,
+              np.abs(data - reference).max()))
+    print('5 shifted grids with disk space for 2 matrices: {} files in the '
+          'cache'.format(n_files))
+
+    ## 3-D grid, chunked with a 32 MB budget
+    x, y, z = np.meshgrid(np.linspace(-1000, 1000, 20),
+                          np.linspace(-500, 1500, 20),
+                          np.linspace(-1000, 1000, 20))
+    x, y, z = x.flatten(), y.flatten(), z.flatten()
+    t0 = time.time()
+    reference = extracellular_potential(cell, x, y, z, cache_dir=None)
+    t_full = time.time() - t0
+    full_bytes = reference.nbytes + cell.imem.nbytes \
+        + x.size * cell.totnsegs * 8
+    _matrix_cache.clear()
+
+    import tracemalloc
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        save_imem(cell, os.path.join(tmp_dir, 'imem.npy'))
+        tracemalloc.start()
+        t0 = time.time()
+        data = lfp_chunked(cell, x, y, z, os.path.join(tmp_dir, 'lfp.npy'),
+                           imem=os.path.join(tmp_dir, 'imem.npy'),
+                           memory_budget=32e6)
+        t_chunked = time.time() - t0
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        err = np.abs(data - reference).max()
+        del data
+    finally:
+        shutil.rmtree(tmp_dir)
+    print('{} electrodes: in memory {:.2f} s ({:.0f} MB of arrays), chunked '
+          '{:.2f} s (peak allocation {:.0f} MB), max difference {:.1e} mV'
+          .format(x.size, t_full, full_bytes / 1e6, t_chunked, peak / 1e6,
+                  err))
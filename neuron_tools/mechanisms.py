@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+'''
+Content-hashed build cache for NMODL mechanisms.
+
+The exercises compile their mod files with nrnivmodl on every run, and some
+mechanism directories are duplicated between exercises (hay_model/mod in
+Exercise05 and Exercise09). load_mechanisms() hashes the mod sources of a
+directory together with the NEURON version and the platform, compiles them
+once into a shared cache directory named by that hash, and loads the
+compiled library from there with neuron.load_mechanisms. Identical sources
+in different directories share one build, and a directory whose hash is
+already loaded in the running process is not loaded again. Example usage,
+from a notebook in Exercises/ExerciseXX:
+
+    import sys
+    sys.path.insert(0, join('..', '..'))
+    from neuron_tools import load_mechanisms
+    load_mechanisms(join('hay_model', 'mod'))   # replaces !nrnivmodl
+
+Run this file with a mechanism directory as argument to compare the time
+of a cached load with a fresh nrnivmodl build.
+'''
+import os
+import sys
+import glob
+import time
+import shutil
+import hashlib
+import platform
+import tempfile
+import subprocess
+import neuron
+
+# shared by all exercises: the repository root
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    '.mechanism_cache')
+
+# files nrnivmodl compiles or that mod files may include
+SOURCE_PATTERNS = ['*.mod', '*.inc', '*.h', '*.c', '*.cpp']
+
+# hash of each mechanism set loaded in this process -> cache entry
+_loaded = {}
+
+
+def _source_files(mod_dir):
+    files = set()
+    for pattern in SOURCE_PATTERNS:
+        files.update(glob.glob(os.path.join(mod_dir, pattern)))
+    return sorted(files, key=os.path.basename)
+
+
+def mechanism_key(mod_dir):
+    '''
+    Return the hash of the mechanism sources in mod_dir, the NEURON version
+    and the platform.
+    '''
+    files = _source_files(mod_dir)
+    if not any(f.endswith('.mod') for f in files):
+        raise FileNotFoundError('no .mod files in {}'.format(mod_dir))
+    sha = hashlib.sha1()
+    for item in (neuron.__version__, platform.system(), platform.machine()):
+        sha.update(item.encode() + b'\0')
+    for fname in files:
+        sha.update(os.path.basename(fname).encode() + b'\0')
+        with open(fname, 'rb') as f:
+            sha.update(f.read())
+        sha.update(b'\0')
+    return sha.hexdigest()
+
+
+def build_mechanisms(mod_dir, cache_dir=None, verbose=False):
+    '''
+    Compile the mechanisms in mod_dir into the cache, unless a build of the
+    same sources exists already.
+
+    Parameters
+    ----------
+    mod_dir : str, directory with the mod files
+    cache_dir : str or None, cache directory (None: DEFAULT_CACHE_DIR)
+    verbose : bool, print whether the build was cached and the nrnivmodl
+        output
+
+    Returns
+    -------
+    entry : str, cache directory of the build, to be passed to
+        neuron.load_mechanisms
+    '''
+    cache_dir = DEFAULT_CACHE_DIR if cache_dir is None else cache_dir
+    key = mechanism_key(mod_dir)
+    entry = os.path.join(cache_dir, key)
+    if os.path.isdir(entry):
+        if verbose:
+            print('using cached build {} of {}'.format(key, mod_dir))
+        return entry
+
+    os.makedirs(cache_dir, exist_ok=True)
+    # build in a temporary directory and move it in place when complete, so
+    # interrupted or concurrent builds never leave a broken entry
+    build_dir = tempfile.mkdtemp(prefix=key + '.', dir=cache_dir)
+    try:
+        for fname in _source_files(mod_dir):
+            shutil.copy(fname, build_dir)
+        t0 = time.time()
+        result = subprocess.run(['nrnivmodl'], cwd=build_dir,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                universal_newlines=True)
+        if verbose:
+            print(result.stdout)
+        if result.returncode != 0:
+            raise RuntimeError('nrnivmodl failed for {}:\n{}'.format(
+                mod_dir, result.stdout))
+        try:
+            os.rename(build_dir, entry)
+        except OSError:
+            # built concurrently by another process
+            if not os.path.isdir(entry):
+                raise
+    finally:
+        if os.path.isdir(build_dir):
+            shutil.rmtree(build_dir)
+    if verbose:
+        print('built {} of {} in {:.1f} s'.format(key, mod_dir,
+                                                 time.time() - t0))
+    return entry
+
+
+def load_mechanisms(mod_dir, cache_dir=None, verbose=False):
+    '''
+    Load the mechanisms in mod_dir, compiling them into the cache first if
+    needed. Mechanisms with the same sources as a set loaded earlier in this
+    process are not loaded again.
+
+    Parameters
+    ----------
+    mod_dir : str, directory with the mod files
+    cache_dir : str or None, cache directory (None: DEFAULT_CACHE_DIR)
+    verbose : bool, print build and load information
+
+    Returns
+    -------
+    entry : str, cache directory the mechanisms were loaded from
+    '''
+    key = mechanism_key(mod_dir)
+    if key in _loaded:
+        if verbose:
+            print('mechanisms of {} already loaded from {}'.format(
+                mod_dir, _loaded[key]))
+        return _loaded[key]
+    entry = build_mechanisms(mod_dir, cache_dir, verbose)
+    if not neuron.load_mechanisms(entry, warn_if_already_loaded=verbose):
+        raise RuntimeError('could not load mechanisms from {}'.format(entry))
+    _loaded[key] = entry
+    return entry
+
+
+def clear(cache_dir=None):
+    '''
+    Remove all cached builds
+    '''
+    cache_dir = DEFAULT_CACHE_DIR if cache_dir is None else cache_dir
+    if os.path.isdir(cache_dir):
+        shutil.rmtree(cache_dir)
+
+
+if __name__ == '__main__':
+    mod_dir = sys.argv[1]
+    cache_dir = tempfile.mkdtemp()
+    try:
+        t0 = time.time()
+        build_mechanisms(mod_dir, cache_dir)
+        t_build = time.time() - t0
+        t0 = time.time()
+        load_mechanisms(mod_dir, cache_dir)
+        t_load = time.time() - t0
+        print('{}: first build {:.2f} s, cached build and load {:.3f} s'
+              .format(mod_dir, t_build, t_load))
+    finally:
+        shutil.rmtree(cache_dir)
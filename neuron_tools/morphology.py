@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+'''
+Per-segment morphology index for distance dependent channel distributions
+and synapse placement.
+
+Channel distributions such as distribute_channels in the Hay model or the
+T-channel gradient of Exercise 6 loop over all segments and call
+h.distance() for each of them, every time a cell is configured.
+MorphologyIndex computes the per-segment quantities once per morphology as
+NumPy arrays:
+
+    distance     path distance from the origin (um)
+    order        branch order (number of sections between the segment and
+                 the root section)
+    length, area, diam   segment length (um), membrane area (um2) and
+                 diameter (um)
+    cumulative_length    cumulative segment length in index order (um)
+    cx, cy, cz   segment centre coordinates from the 3D points (um), with
+                 coordinates=True
+    x_ends, y_ends, z_ends   segment start and end coordinates (um), shape
+                 (nsegs, 2) as the x, y, z of LFPy.Cell, with
+                 coordinates=True
+
+together with per-section names, types, parents and end distances. Indexes
+are cached in memory per morphology (and origin), keyed on an explicit key
+given by the caller, and can be saved to and loaded from .npz files, so
+they can be computed once and shared. Example usage:
+
+    from neuron_tools import MorphologyIndex
+    index = MorphologyIndex.from_sections(
+        cell.allseclist, key=(cell.morphology, 'lambda_f', 100))
+    gcat = gcat0 * 0.1054 * (1 + 0.04 * index.distance)
+    index.set_values('gcabar_it2', gcat, mask=~index.mask('soma'))
+    syn_idx = index.sample(100, weight='area', mask=index.mask('dend'))
+
+The default origin is the 0 end of the root section, as with
+h.distance() without arguments; any other segment can be given as origin.
+Run this file with a morphology .hoc file as argument to compare with
+per-segment h.distance() calls.
+'''
+import os
+import sys
+import time
+import hashlib
+import numpy as np
+import neuron
+h = neuron.h
+
+# per-segment and per-section arrays stored by save()
+SEGMENT_FIELDS = ['section_idx', 'x', 'distance', 'order', 'length',
+                  'cumulative_length', 'area', 'diam', 'cx', 'cy', 'cz',
+                  'x_ends', 'y_ends', 'z_ends']
+SECTION_FIELDS = ['section_names', 'section_types', 'section_parent',
+                  'section_end_distance', 'section_terminal']
+
+_index_cache = {}
+
+
+def section_type(name):
+    '''
+    section type from the name, e.g. 'dend' for 'dend[3]' or
+    'Cell[0].dend[3]'
+    '''
+    return name.split('.')[-1].split('[')[0]
+
+
+def _signature(sections, origin):
+    '''
+    hash of the morphology: section names, topology, nseg, length, diameter
+    and end points, and the origin
+    '''
+    description = [None if origin is None else (origin.sec.name(), origin.x)]
+    for sec in sections:
+        parent = sec.parentseg()
+        n3d = sec.n3d()
+        description.append((
+            sec.name(), sec.nseg, sec.L, sec.diam, n3d,
+            None if parent is None else (parent.sec.name(), parent.x),
+            None if n3d == 0 else (sec.x3d(0), sec.y3d(0), sec.z3d(0),
+                                   sec.x3d(n3d - 1), sec.y3d(n3d - 1),
+                                   sec.z3d(n3d - 1))))
+    return hashlib.sha1(repr(description).encode()).hexdigest()
+
+
+class MorphologyIndex(object):
+    '''
+    Per-segment morphology table, see the module docstring for the fields.
+    Segments are ordered by section, in the order of the sections the index
+    was built from, and by position within each section. The coordinates
+    are None unless the index was built with coordinates=True.
+    '''
+    def __init__(self, **fields):
+        for name in SEGMENT_FIELDS + SECTION_FIELDS:
+            value = fields.get(name)
+            setattr(self, name, None if value is None else np.asarray(value))
+        self.type = self.section_types[self.section_idx]
+        self.nsegs = self.distance.size
+
+    @classmethod
+    def from_sections(cls, sections=None, origin=None, key=None,
+                      coordinates=False, points=None, cache_dir=None):
+        '''
+        Build the index of the given sections, or return it from the cache.
+
+        Without a key, the cache is keyed on a hash of the names, topology
+        and geometry of all sections, which costs about as much as a
+        per-segment h.distance() loop. Callers that know which morphology
+        and nseg rule they have should pass a key instead, e.g. the
+        morphology file and the nseg of each section; the index is then
+        looked up without reading the sections.
+
+        Parameters
+        ----------
+        sections : iterable of sections or None, e.g. cell.allseclist
+            (None: h.allsec())
+        origin : segment or None, origin of the path distances (None: the 0
+            end of the root section)
+        key : hashable or None, identifies the morphology (None: computed
+            from the sections)
+        coordinates : bool, also compute the segment coordinates, which
+            reads all 3D points
+        points : dict or None, 3D points (xyz, arc) by section name to use
+            instead of reading them from NEURON, e.g. from a
+            neuron_tools.morphology_cache.MorphologyData; only used for
+            sections with the same number of points
+        cache_dir : str or None, directory of .npz files to share indexes
+            between processes (None: in-memory cache only)
+        '''
+        sections = list(h.allsec() if sections is None else sections)
+        if key is None:
+            key = _signature(sections, origin)
+        else:
+            key = (key, None if origin is None else
+                   (origin.sec.name(), origin.x))
+        key = (key, coordinates)
+        if key not in _index_cache:
+            path = None if cache_dir is None else os.path.join(
+                cache_dir, hashlib.sha1(repr(key).encode()).hexdigest()
+                + '.npz')
+            if path is not None and os.path.isfile(path):
+                _index_cache[key] = cls.load(path)
+            else:
+                _index_cache[key] = cls._compute(sections, origin,
+                                                 coordinates, points)
+                if path is not None:
+                    os.makedirs(cache_dir, exist_ok=True)
+                    _index_cache[key].save(path)
+        return _index_cache[key]
+
+    @classmethod
+    def _compute(cls, sections, origin=None, coordinates=False, points=None):
+        names = [sec.name() for sec in sections]
+        position = {name: i for i, name in enumerate(names)}
+        nseg = np.array([sec.nseg for sec in sections])
+        parent = np.full(len(sections), -1)
+        for i, sec in enumerate(sections):
+            pseg = sec.parentseg()
+            if pseg is not None and pseg.sec.name() in position:
+                parent[i] = position[pseg.sec.name()]
+        if origin is None:
+            origin = sections[np.flatnonzero(parent < 0)[0]](0)
+
+        ## branch order: walk up to the root once per section, memoized
+        order = np.full(len(sections), -1)
+        for i in range(len(sections)):
+            path = []
+            j = i
+            while j >= 0 and order[j] < 0:
+                path.append(j)
+                j = parent[j]
+            k = order[j] if j >= 0 else -1
+            for j in reversed(path):
+                k += 1
+                order[j] = k
+        terminal = np.ones(len(sections), dtype=bool)
+        terminal[parent[parent >= 0]] = False
+
+        section_idx = np.repeat(np.arange(len(sections)), nseg)
+        x, area, diam = np.array([(seg.x, seg.area(), seg.diam)
+                                  for sec in sections for seg in sec]).T
+        L = np.array([sec.L for sec in sections])
+
+        ## distance is linear along each section, except in the section
+        ## containing the origin
+        d0 = np.array([h.distance(origin, sec(0)) for sec in sections])
+        d1 = np.array([h.distance(origin, sec(1)) for sec in sections])
+        distance = d0[section_idx] + x * (d1 - d0)[section_idx]
+        origin_name = origin.sec.name()
+        if origin_name in position:
+            i = position[origin_name]
+            in_origin = section_idx == i
+            distance[in_origin] = np.abs(x[in_origin] - origin.x) * L[i]
+
+        length = (L / nseg)[section_idx]
+
+        ## centre, start and end coordinates, interpolated along the 3D
+        ## points at the positions LFPy uses
+        coords = {}
+        if coordinates:
+            points = {} if points is None else points
+            centres = np.full((x.size, 3), np.nan)
+            ends = np.full((x.size, 2, 3), np.nan)
+            start = 0
+            for sec in sections:
+                n3d = sec.n3d()
+                xyz, arc = points.get(sec.name(), (None, None))
+                if n3d and (xyz is None or len(xyz) != n3d):
+                    arc = np.array([sec.arc3d(i) for i in range(n3d)])
+                    xyz = np.array([[sec.x3d(i), sec.y3d(i), sec.z3d(i)]
+                                    for i in range(n3d)])
+                if n3d:
+                    rel = arc / arc[-1] if arc[-1] > 0 else arc
+                    segx = x[start:start + sec.nseg]
+                    half = 0.5 / sec.nseg
+                    for dim in range(3):
+                        centres[start:start + sec.nseg, dim] = np.interp(
+                            segx, rel, xyz[:, dim])
+                        for end, pos in enumerate([segx - half,
+                                                   segx + half]):
+                            ends[start:start + sec.nseg, end, dim] = \
+                                np.interp(pos.round(6), rel, xyz[:, dim])
+                start += sec.nseg
+            coords = {'cx': centres[:, 0], 'cy': centres[:, 1],
+                      'cz': centres[:, 2], 'x_ends': ends[:, :, 0],
+                      'y_ends': ends[:, :, 1], 'z_ends': ends[:, :, 2]}
+
+        return cls(section_idx=section_idx, x=x, distance=distance,
+                   order=order[section_idx], length=length,
+                   cumulative_length=np.cumsum(length), area=area,
+                   diam=diam, section_names=np.array(names),
+                   section_types=np.array([section_type(name)
+                                           for name in names]),
+                   section_parent=parent, section_end_distance=d1,
+                   section_terminal=terminal, **coords)
+
+    def save(self, filename):
+        '''
+        save the index to a .npz file
+        '''
+        np.savez(filename, **{name: getattr(self, name)
+                              for name in SEGMENT_FIELDS + SECTION_FIELDS
+                              if getattr(self, name) is not None})
+
+    @classmethod
+    def load(cls, filename):
+        '''
+        load an index saved with save()
+        '''
+        with np.load(filename) as f:
+            return cls(**{name: f[name] for name in f.files})
+
+    def mask(self, sec_type=None, dmin=None, dmax=None):
+        '''
+        Boolean mask of the segments of a section type (str or list of str,
+        None: all) with dmin <= distance <= dmax.
+        '''
+        mask = np.ones(self.nsegs, dtype=bool)
+        if sec_type is not None:
+            mask &= np.isin(self.type, np.atleast_1d(sec_type))
+        if dmin is not None:
+            mask &= self.distance >= dmin
+        if dmax is not None:
+            mask &= self.distance <= dmax
+        return mask
+
+    def longest_branch(self, sec_type=None):
+        '''
+        Largest distance of the end of a terminal section of the given type,
+        as getLongestBranch in the Hay model (for the same origin)
+        '''
+        sections = self.section_terminal.copy()
+        if sec_type is not None:
+            sections &= np.isin(self.section_types, np.atleast_1d(sec_type))
+        return self.section_end_distance[sections].max()
+
+    def closest(self, x=0., y=0., z=0.):
+        '''
+        index of the segment with the centre closest to (x, y, z)
+        '''
+        if self.cx is None:
+            raise ValueError('the index has no coordinates, build it with '
+                             'coordinates=True')
+        return int(np.nanargmin((self.cx - x)**2 + (self.cy - y)**2
+                                + (self.cz - z)**2))
+
+    def sample(self, n, weight='area', mask=None, seed=None):
+        '''
+        Draw n segment indices (with replacement) with probability
+        proportional to weight, e.g. for synapse placement.
+
+        Parameters
+        ----------
+        n : int, number of segments
+        weight : str or ndarray, 'area', 'length' or one weight per segment
+        mask : ndarray or None, segments that may be drawn
+        seed : int or None, seed of the random number generator
+        '''
+        if isinstance(weight, str):
+            weight = getattr(self, weight)
+        weight = np.asarray(weight, dtype=float)
+        if mask is not None:
+            weight = np.where(mask, weight, 0.)
+        cumulative = np.cumsum(weight)
+        if not cumulative[-1] > 0:
+            raise ValueError('the total weight of the segments is 0')
+        rng = np.random.default_rng(seed)
+        return np.searchsorted(cumulative, rng.random(n) * cumulative[-1],
+                               side='right')
+
+    def segments(self, sections=None):
+        '''
+        Return the NEURON segments in index order, looking the sections up
+        by name among sections (None: h.allsec())
+        '''
+        sections = {sec.name(): sec for sec in (h.allsec() if sections is None
+                                                 else sections)}
+        secs = [sections[name] for name in self.section_names]
+        return [secs[i](x) for i, x in zip(self.section_idx, self.x)]
+
+    def set_values(self, name, values, mask=None, sections=None):
+        '''
+        Write the range variable name of the segments in mask (None: all),
+        values is a scalar or one value per segment.
+        '''
+        values = np.broadcast_to(values, (self.nsegs,))
+        idx = np.arange(self.nsegs) if mask is None else np.flatnonzero(mask)
+        segments = self.segments(sections)
+        for i in idx:
+            setattr(segments[i], name, values[i])
+
+
+if __name__ == '__main__':
+    h.load_file(sys.argv[1])
+    h.define_shape()
+    for sec in h.allsec():
+        sec.nseg = 1 + 2 * int(sec.L / 40)
+
+    ## reference: per-segment h.distance() loop from the 0 end of the root
+    t0 = time.time()
+    root = [sec for sec in h.allsec() if sec.parentseg() is None][0]
+    h.distance(0, root(0))
+    ref = np.array([h.distance(seg.x, sec=sec)
+                    for sec in h.allsec() for seg in sec])
+    t_loop = time.time() - t0
+
+    t0 = time.time()
+    index = MorphologyIndex._compute(list(h.allsec()))
+    t_compute = time.time() - t0
+    MorphologyIndex.from_sections(
+        key=(sys.argv[1], tuple(sec.nseg for sec in h.allsec())))
+    ## the lookup including the key: the morphology file and nseg
+    t0 = time.time()
+    MorphologyIndex.from_sections(
+        key=(sys.argv[1], tuple(sec.nseg for sec in h.allsec())))
+    t_cached = time.time() - t0
+    print('{} segments: index {:.1f} ms (h.distance loop {:.1f} ms), cached '
+          'lookup {:.2f} ms, max distance difference {:.1e} um'.format(
+              index.nsegs, 1e3 * t_compute, 1e3 * t_loop, 1e3 * t_cached,
+              np.abs(index.distance - ref).max()))
+
+    t0 = time.time()
+    n = 10000
+    idx = index.sample(n, weight='area')
+    t_sample = time.time() - t0
+    print('{} synapse positions drawn in {:.2f} ms, sections with most '
+          'synapses: {}'.format(n, 1e3 * t_sample, ', '.join(
+              index.section_names[np.bincount(
+                  index.section_idx[idx]).argsort()[-3:]])))
@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+'''
+Serialized morphology cache for fast LFPy.Cell construction.
+
+Every return_cell() in Exercises 5 and 9 and return_IN_cell() in Exercise 9
+interprets the morphology .hoc file (cell1.hoc, IN.hoc) again, and LFPy then
+reads the 3D points of every section back from NEURON one point at a time to
+compute the segment coordinates. MorphologyData holds the content of a hoc
+morphology as arrays: the section arrays the file creates, the section tree
+(parent section, connection points), the 3D points before and after
+define_shape, the logical connection points set with pt3dstyle, nseg, Ra and
+cm of each section, the named SectionLists (e.g. all, somatic, apical) and
+the accessed section. It is converted once per hoc file, stored in
+cache_dir, and instantiate() recreates the same hoc sections directly, with
+one vectorized pt3dadd call per section.
+
+CachedCell is an LFPy.Cell that builds its sections this way. The nseg
+given by the nseg rule (lambda100, lambda_f or fixed_length) after the
+custom code is stored in the MorphologyData per rule and section
+properties, so the rule is not evaluated again for the next cell. The
+segment geometry (coordinates, area, diameter and length) is taken from
+the MorphologyIndex of neuron_tools.morphology, computed from the cached 3D
+points once per morphology and nseg. It takes the same arguments as
+LFPy.Cell, so custom_code, custom_fun and the nseg rules work as before:
+
+    from neuron_tools.morphology_cache import CachedCell
+    cell = CachedCell(morphology=join(model_path, 'cell1.hoc'), **params)
+
+CachedCell overrides the private methods _load_geometry and
+_collect_geometry of LFPy.Cell, which are not part of the LFPy API; it is
+written for LFPy 2.3 and warns with other versions. instantiate() deletes
+all existing sections, so delete_sections=False is not supported. Only
+morphology files that create sections at the top level of hoc (not in
+templates) are supported. This module imports LFPy, so it is not imported
+by the neuron_tools package. Run this file with a morphology .hoc file as
+argument to compare the construction time and geometry with LFPy.Cell.
+'''
+import os
+import re
+import sys
+import time
+import hashlib
+import warnings
+import numpy as np
+import neuron
+import LFPy
+if __name__ == '__main__':
+    # run as a script: the repository root, for neuron_tools
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+        __file__))))
+from neuron_tools.morphology import MorphologyIndex
+h = neuron.h
+
+if not LFPy.__version__.startswith('2.3'):
+    warnings.warn('morphology_cache overrides private methods of LFPy 2.3, '
+                  'found LFPy {}'.format(LFPy.__version__))
+
+# shared by all exercises: the repository root
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    '.morphology_cache')
+
+FIELDS = ['names', 'parent', 'parent_x', 'child_x', 'n3d', 'pt3d', 'xyz',
+          'arc', 'style', 'nseg', 'Ra', 'cm', 'L', 'diam', 'list_names',
+          'list_members', 'accessed']
+
+_morphology_cache = {}
+
+
+def _array_name(name):
+    '''
+    hoc array name and index of a section name, e.g. ('dend', 3) for
+    'dend[3]' and ('soma', None) for 'soma'
+    '''
+    match = re.match(r'^(\w+)(\[(\d+)\])?$', name)
+    if match is None:
+        raise ValueError('section {} is not a top level hoc section'.format(
+            name))
+    return match.group(1), None if match.group(3) is None \
+        else int(match.group(3))
+
+
+def _section(name):
+    array, index = _array_name(name)
+    return getattr(h, array) if index is None else getattr(h, array)[index]
+
+
+class MorphologyData(object):
+    '''
+    Arrays describing the sections created by a hoc morphology file, see the
+    module docstring.
+    '''
+    def __init__(self, nseg_rules=None, **fields):
+        for name in FIELDS:
+            setattr(self, name, fields[name])
+        self.offsets = np.r_[0, np.cumsum(self.n3d)]
+        # nseg of each section for a rule, by hash of the rule and the
+        # section properties it depends on
+        self.nseg_rules = {} if nseg_rules is None else nseg_rules
+        # morphology_key of the file and .npz file, set by load_morphology
+        self.key = None
+        self.path = None
+        self._points = None
+
+    def points(self):
+        '''
+        the 3D points after define_shape, (xyz, arc) by section name
+        '''
+        if self._points is None:
+            self._points = {
+                name: (self.xyz[self.offsets[i]:self.offsets[i + 1]],
+                       self.arc[self.offsets[i]:self.offsets[i + 1]])
+                for i, name in enumerate(self.names)}
+        return self._points
+
+    @classmethod
+    def from_hoc(cls, filename):
+        '''
+        Load a hoc morphology file in NEURON, after deleting all sections,
+        and convert the sections it creates.
+        '''
+        h('forall delete_section()')
+        h.load_file(1, filename)
+        sections = list(h.allsec())
+        names = [sec.name() for sec in sections]
+        position = {name: i for i, name in enumerate(names)}
+        parent = np.full(len(sections), -1)
+        parent_x = np.zeros(len(sections))
+        for i, sec in enumerate(sections):
+            _array_name(names[i])
+            pseg = sec.parentseg()
+            if pseg is not None:
+                parent[i] = position[pseg.sec.name()]
+                parent_x[i] = pseg.x
+        n3d = np.array([sec.n3d() for sec in sections], dtype=int)
+        pt3d = np.array([[sec.x3d(i), sec.y3d(i), sec.z3d(i), sec.diam3d(i)]
+                         for sec in sections for i in range(sec.n3d())])
+        ## pt3dstyle: 1 and the logical connection point, which define_shape
+        ## uses to translate the children
+        style = np.zeros((len(sections), 4))
+        for i, sec in enumerate(sections):
+            x, y, z = h.ref(0.), h.ref(0.), h.ref(0.)
+            if h.pt3dstyle(1, x, y, z, sec=sec):
+                style[i] = 1., x[0], y[0], z[0]
+        ## the 3D points after define_shape, from which the segment
+        ## coordinates are computed
+        h.define_shape()
+        xyz = np.array([[sec.x3d(i), sec.y3d(i), sec.z3d(i), sec.arc3d(i)]
+                        for sec in sections for i in range(sec.n3d())])
+        xyz = xyz.reshape(-1, 4)
+
+        ## SectionLists assigned to objrefs declared in the file
+        with open(filename) as f:
+            declared = re.findall(r'objref\s+([\w\s,]+)', f.read())
+        list_names, list_members = [], []
+        for name in sorted(set(n.strip() for d in declared
+                               for n in d.split(',') if n.strip())):
+            obj = getattr(h, name, None)
+            if obj is not None and obj.hname().startswith('SectionList'):
+                list_names.append(name)
+                list_members.append(np.array([position[sec.name()]
+                                              for sec in obj], dtype=int))
+        return cls(names=np.array(names), parent=parent, parent_x=parent_x,
+                   child_x=np.array([sec.orientation() for sec in sections]),
+                   n3d=n3d, pt3d=pt3d.reshape(-1, 4),
+                   xyz=xyz[:, :3], arc=xyz[:, 3], style=style,
+                   nseg=np.array([sec.nseg for sec in sections]),
+                   Ra=np.array([sec.Ra for sec in sections]),
+                   cm=np.array([sec.cm for sec in sections]),
+                   L=np.array([sec.L for sec in sections]),
+                   diam=np.array([sec.diam for sec in sections]),
+                   list_names=np.array(list_names, dtype=str),
+                   list_members=list_members,
+                   accessed=h.cas().name())
+
+    def save(self, filename):
+        '''
+        save the morphology to a .npz file
+        '''
+        fields = {name: getattr(self, name) for name in FIELDS
+                  if name != 'list_members'}
+        for i, members in enumerate(self.list_members):
+            fields['list_members_{}'.format(i)] = members
+        for rule, nseg in self.nseg_rules.items():
+            fields['nseg_rule_{}'.format(rule)] = nseg
+        np.savez(filename, **fields)
+
+    @classmethod
+    def load(cls, filename):
+        '''
+        load a morphology saved with save()
+        '''
+        with np.load(filename) as f:
+            fields = {name: f[name] for name in FIELDS
+                      if name != 'list_members'}
+            fields['list_members'] = [f['list_members_{}'.format(i)]
+                                      for i in range(len(f['list_names']))]
+            fields['nseg_rules'] = {name[len('nseg_rule_'):]: f[name]
+                                    for name in f.files
+                                    if name.startswith('nseg_rule_')}
+        fields['accessed'] = str(fields['accessed'])
+        return cls(**fields)
+
+    def instantiate(self):
+        '''
+        Delete all sections and create the hoc sections of the morphology.
+        '''
+        h('forall delete_section()')
+        arrays = {}
+        for name in self.names:
+            array, index = _array_name(name)
+            arrays[array] = max(arrays.get(array, 0),
+                                0 if index is None else index + 1)
+        h('create ' + ', '.join(array if size == 0 else
+                                '{}[{}]'.format(array, size)
+                                for array, size in arrays.items()))
+        sections = [_section(name) for name in self.names]
+        for i, sec in enumerate(sections):
+            if self.parent[i] >= 0:
+                sec.connect(sections[self.parent[i]](self.parent_x[i]),
+                            self.child_x[i])
+        for i, sec in enumerate(sections):
+            sec.Ra = self.Ra[i]
+            sec.cm = self.cm[i]
+            if self.n3d[i]:
+                pt3d = self.pt3d[self.offsets[i]:self.offsets[i + 1]]
+                h.pt3dadd(*[h.Vector(pt3d[:, j]) for j in range(4)], sec=sec)
+                if self.style[i, 0]:
+                    h.pt3dstyle(*self.style[i], sec=sec)
+            else:
+                sec.L = self.L[i]
+                sec.diam = self.diam[i]
+            sec.nseg = self.nseg[i]
+        for name, members in zip(self.list_names, self.list_members):
+            h('objref {}'.format(name))
+            h('{} = new SectionList()'.format(name))
+            section_list = getattr(h, name)
+            for i in members:
+                section_list.append(sec=sections[i])
+        h('access {}'.format(self.accessed))
+        return sections
+
+
+def morphology_key(filename):
+    '''
+    hash of the content of a morphology file and the NEURON version
+    '''
+    sha = hashlib.sha1(neuron.__version__.encode())
+    with open(filename, 'rb') as f:
+        sha.update(f.read())
+    return sha.hexdigest()
+
+
+def load_morphology(filename, cache_dir=None):
+    '''
+    Return the MorphologyData of a hoc morphology file, converted on first
+    use and cached in memory and in cache_dir (None: DEFAULT_CACHE_DIR).
+    '''
+    cache_dir = DEFAULT_CACHE_DIR if cache_dir is None else cache_dir
+    key = morphology_key(filename)
+    if key not in _morphology_cache:
+        path = os.path.join(cache_dir, key + '.npz')
+        if os.path.isfile(path):
+            _morphology_cache[key] = MorphologyData.load(path)
+        else:
+            _morphology_cache[key] = MorphologyData.from_hoc(filename)
+            os.makedirs(cache_dir, exist_ok=True)
+            _morphology_cache[key].save(path)
+        _morphology_cache[key].key = key
+        _morphology_cache[key].path = path
+    return _morphology_cache[key]
+
+
+def _nseg_rule(cell, nsegs_method, lambda_f, d_lambda, max_nsegs_length):
+    '''
+    Set nseg of all sections as the nseg rules of LFPy.Cell, with the
+    result cached in the MorphologyData of the cell (and its .npz file) by
+    rule and by the name, length, diameter, Ra and cm of every section.
+    '''
+    if nsegs_method not in ('lambda100', 'lambda_f', 'fixed_length'):
+        return
+    if nsegs_method == 'lambda100':
+        nsegs_method, lambda_f = 'lambda_f', 100
+    sections = list(cell.allseclist)
+    data = cell.morphology_data
+    rule = hashlib.sha1(repr((
+        nsegs_method, lambda_f, d_lambda, max_nsegs_length,
+        [(sec.name(), sec.L, sec.diam, sec.Ra, sec.cm) for sec in sections]
+    )).encode()).hexdigest()
+    if rule not in data.nseg_rules:
+        if nsegs_method == 'lambda_f':
+            nseg = [int((sec.L / (d_lambda * h.lambda_f(lambda_f, sec=sec))
+                         + .9) / 2) * 2 + 1 for sec in sections]
+        else:
+            nseg = [int(sec.L / max_nsegs_length) + 1 for sec in sections]
+        data.nseg_rules[rule] = np.array(nseg, dtype=int)
+        if data.path is not None:
+            data.save(data.path)
+    for sec, nseg in zip(sections, data.nseg_rules[rule]):
+        sec.nseg = int(nseg)
+
+
+class CachedCell(LFPy.Cell):
+    '''
+    LFPy.Cell built from the cached morphology of a .hoc file, see the
+    module docstring. morphology_cache_dir is the cache directory (None:
+    DEFAULT_CACHE_DIR), all other arguments are passed to LFPy.Cell.
+    The sections of previous cells are always deleted, delete_sections=False
+    raises a ValueError.
+    '''
+    def __init__(self, morphology, morphology_cache_dir=None,
+                 nsegs_method='lambda100', lambda_f=100, d_lambda=0.1,
+                 max_nsegs_length=None, custom_fun=None,
+                 custom_fun_args=None, **kwargs):
+        if not kwargs.get('delete_sections', True):
+            raise ValueError('CachedCell deletes all existing sections, '
+                             'delete_sections=False is not supported')
+        self.morphology_data = load_morphology(morphology,
+                                               morphology_cache_dir)
+        ## the nseg rule runs as the last custom function, which is where
+        ## LFPy.Cell applies it
+        custom_fun = list(custom_fun or [])
+        custom_fun_args = list(custom_fun_args or [{}] * len(custom_fun))
+        custom_fun.append(_nseg_rule)
+        custom_fun_args.append({'nsegs_method': nsegs_method,
+                                'lambda_f': lambda_f, 'd_lambda': d_lambda,
+                                'max_nsegs_length': max_nsegs_length})
+        super(CachedCell, self).__init__(
+            morphology, nsegs_method=None, custom_fun=custom_fun,
+            custom_fun_args=custom_fun_args, **kwargs)
+
+    ## private methods of LFPy.Cell (2.3), called by LFPy.Cell.__init__
+    def _load_geometry(self):
+        self.morphology_data.instantiate()
+        h.define_shape()
+        self._create_sectionlists()
+
+    def _collect_geometry(self):
+        data = self.morphology_data
+        sections = list(self.allseclist)
+        index = MorphologyIndex.from_sections(
+            sections, key=(data.key, tuple((sec.name(), sec.nseg, sec.L,
+                                            sec.diam) for sec in sections)),
+            coordinates=True, points=data.points())
+        ## copies, LFPy.Cell moves and rotates them in place
+        self.x = index.x_ends.copy()
+        self.y = index.y_ends.copy()
+        self.z = index.z_ends.copy()
+        self.area = index.area.copy()
+        self.d = index.diam.copy()
+        self.length = index.length.copy()
+
+        self.somaidx = self.get_idx(section='soma')
+        if self.somaidx.size == 0:
+            self.somaidx = np.array([0])
+        self.somapos = np.array([self.x[self.somaidx].mean(),
+                                 self.y[self.somaidx].mean(),
+                                 self.z[self.somaidx].mean()])
+
+
+if __name__ == '__main__':
+    import shutil
+    import tempfile
+
+    filename = sys.argv[1]
+    cell_parameters = {'morphology': filename, 'passive': True,
+                       'nsegs_method': 'lambda_f', 'lambda_f': 100,
+                       'dt': 2**-4, 'tstart': -100, 'tstop': 100}
+    h.load_file('stdlib.hoc')
+    h.load_file('import3d.hoc')
+    h.load_file('stdrun.hoc')
+
+    times = []
+    for i in range(5):
+        t0 = time.time()
+        reference = LFPy.Cell(**cell_parameters)
+        times.append(time.time() - t0)
+    t_lfpy = min(times)
+    geometry = [reference.x, reference.y, reference.z, reference.area,
+                reference.d, reference.length]
+    reference.strip_hoc_objects()
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        t0 = time.time()
+        CachedCell(morphology_cache_dir=cache_dir, **cell_parameters)
+        t_first = time.time() - t0
+        _morphology_cache.clear()
+        times = []
+        for i in range(5):
+            t0 = time.time()
+            cell = CachedCell(morphology_cache_dir=cache_dir,
+                              **cell_parameters)
+            times.append(time.time() - t0)
+        t_cached = min(times)
+    finally:
+        shutil.rmtree(cache_dir)
+    err = max(np.abs(a - b).max() for a, b in zip(
+        geometry, [cell.x, cell.y, cell.z, cell.area, cell.d, cell.length]))
+    print('{}: {} segments, LFPy.Cell {:.3f} s, CachedCell first use {:.3f} s,'
+          ' cached {:.3f} s, max geometry difference {:.1e}'.format(
+              filename, cell.totnsegs, t_lfpy, t_first, t_cached, err))
@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+'''
+Hot-path profiler for fixed step NEURON simulations.
+
+profile() wraps a function that runs a simulation (h.continuerun, pc.psolve
+or a Python loop over h.fadvance as in example_6.py) and reports where the
+time goes:
+
+    wall            wall time of the run (s)
+    integration     time spent integrating inside NEURON, measured with
+                    pc.step_time() by replaying the simulation with
+                    pc.psolve (replay=False: the wall time)
+    python          wall - integration, i.e. the Python loop, callbacks and
+                    Python-side recording of the run
+    mechanisms      integration time per mechanism type (density mechanisms
+                    with their ions, and point processes)
+    linear_solve    matrix setup, Hines solve and voltage update
+    events          NetCon event delivery
+    section_types   integration time per section type (soma, dend, ...)
+    steps, steps_per_second, events_count, events_per_second
+
+NEURON only times whole steps, so the split of the integration time is
+sampled: the cost per segment and step of a bare segment, of each mechanism
+type and of a NetCon event is measured once in a separate NEURON process
+that loads the same mechanism libraries, the costs are multiplied by the
+number of segments (instances, events) and steps of the run, and scaled so
+that they add up to the measured integration time (the scale factor is
+reported as 'sampling_scale'). NetCon events are counted with additional
+NetCons on the same sources, which does not change the simulation.
+Example usage:
+
+    from neuron_tools.profiler import profile
+    result = profile(lambda: h.continuerun(tstop), init=h.stdinit)
+    print(result.report())
+    result.save('profile.json')   # for regression tracking
+
+The replay re-initializes and re-runs the model, so it is only
+meaningful if run() does not change the model from Python during the run.
+It leaves the model at the end of the replay and calls pc.set_maxstep(10),
+which NEURON cannot read back to restore; this only matters for later
+pc.psolve runs, which should call pc.set_maxstep themselves.
+Run this file to profile the model of example_6.py, with an optional JSON
+output file as argument.
+'''
+import os
+import sys
+import json
+import time
+import subprocess
+import neuron
+if __name__ == '__main__':
+    # run as a script: the repository root, for neuron_tools
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+        __file__))))
+from neuron_tools.morphology import section_type
+h = neuron.h
+
+_cost_cache = {}
+
+# run in a separate process: cost per segment (or instance) and step of a
+# bare segment, of each mechanism and of a NetCon event
+_COST_SCRIPT = r'''
+import sys, json, time
+import neuron
+h = neuron.h
+args = json.loads(sys.argv[1])
+sys.path.insert(0, args['root'])
+from neuron_tools.mechanisms import load_mechanisms
+for path in args['dlls']:
+    load_mechanisms(path)
+n, steps = args['n'], args['steps']
+h.dt = 0.025
+
+def timed(run_steps=steps):
+    h.finitialize(-65)
+    best = float('inf')
+    for repeat in range(3):
+        t0 = time.time()
+        for i in range(run_steps):
+            h.fadvance()
+        best = min(best, time.time() - t0)
+    return best
+
+def section():
+    sec = h.Section(name='bench')
+    sec.nseg = n
+    sec.L, sec.diam = 10. * n, 1.
+    return sec
+
+sec = section()
+bare = timed()
+costs = {'segment': bare / (n * steps)}
+for name in args['density']:
+    sec.insert(name)
+    costs[name] = max(timed() - bare, 0.) / (n * steps)
+    sec.uninsert(name)
+for name in args['point']:
+    pps = [getattr(h, name)(seg) for seg in sec]
+    costs[name] = max(timed() - bare, 0.) / (n * steps)
+    del pps
+syn = h.ExpSyn(sec(0.5))
+stims = [h.NetStim() for i in range(n)]
+netcons = [h.NetCon(stim, syn) for stim in stims]
+for stim in stims:
+    stim.interval, stim.number, stim.start = h.dt, steps, 0.
+with_events = timed()
+for stim in stims:
+    stim.number = 0
+costs['event'] = max(with_events - timed(), 0.) / (n * steps)
+print(json.dumps(costs))
+'''
+
+
+def mechanism_costs(density, point, n=1000, steps=200):
+    '''
+    Cost (s) per segment and step of a bare segment ('segment'), of each
+    density mechanism and point process type, and per NetCon event
+    ('event'), measured in a separate NEURON process with the mechanism
+    libraries loaded in this one (loaded there with load_mechanisms, which
+    finds the builds of neuron_tools.load_mechanisms in the build cache).
+    Cached per process.
+    '''
+    dlls = list(getattr(neuron, 'nrn_dll_loaded', []))
+    key = (tuple(dlls), tuple(sorted(density)), tuple(sorted(point)), n,
+           steps)
+    if key not in _cost_cache:
+        output = subprocess.run(
+            [sys.executable, '-c', _COST_SCRIPT,
+             json.dumps({'root': os.path.dirname(os.path.dirname(
+                             os.path.abspath(__file__))),
+                         'dlls': dlls, 'density': sorted(density),
+                         'point': sorted(point), 'n': n, 'steps': steps})],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True,
+            cwd=os.getcwd(), universal_newlines=True).stdout
+        _cost_cache[key] = json.loads(output.strip().splitlines()[-1])
+    return _cost_cache[key]
+
+
+def model_counts():
+    '''
+    Number of segments per section type, and of segments (instances) per
+    mechanism type and section type, of the instantiated model.
+    '''
+    segments, counts = {}, {}
+    for sec in h.allsec():
+        sec_type = section_type(sec.name())
+        segments[sec_type] = segments.get(sec_type, 0) + sec.nseg
+        for seg in sec:
+            names = [mech.name() for mech in seg
+                     if not mech.name().endswith('_ion')]
+            names += [pp.hname().split('[')[0]
+                      for pp in seg.point_processes()]
+            for name in names:
+                count = counts.setdefault(name, {})
+                count[sec_type] = count.get(sec_type, 0) + 1
+    return segments, counts
+
+
+class _EventCounter(object):
+    '''
+    Counts the NetCon events delivered during a run, from the spikes of
+    each source and the number of NetCons with a target on that source.
+    '''
+    def __init__(self):
+        sources = {}
+        for nc in h.List('NetCon'):
+            if nc.syn() is None or not nc.active():
+                continue
+            pre = nc.pre()
+            if pre is not None:
+                key = pre.hname()
+                source = (pre, None)
+            elif nc.preseg() is not None:
+                seg = nc.preseg()
+                key = '{}({})'.format(seg.sec.name(), seg.x)
+                source = (seg, nc.threshold)
+            else:
+                continue
+            sources.setdefault(key, [source, 0])[1] += 1
+        self.counters = []
+        for (source, threshold), n_targets in sources.values():
+            if threshold is None:
+                counter = h.NetCon(source, None)
+            else:
+                counter = h.NetCon(source._ref_v, None, sec=source.sec)
+                counter.threshold = threshold
+            spikes = h.Vector()
+            counter.record(spikes)
+            self.counters.append((counter, spikes, n_targets))
+
+    def count(self):
+        return int(sum(spikes.size() * n_targets
+                       for counter, spikes, n_targets in self.counters))
+
+
+class Profile(object):
+    '''
+    Result of profile(): the fields of the module docstring as attributes,
+    as_dict() for JSON export.
+    '''
+    FIELDS = ['wall', 'integration', 'python', 'steps', 'steps_per_second',
+              'events_count', 'events_per_second', 'linear_solve', 'events',
+              'mechanisms', 'section_types', 'sampling_scale', 'tstop', 'dt',
+              'nsegs', 'neuron_version']
+
+    def __init__(self, **fields):
+        for name in self.FIELDS:
+            setattr(self, name, fields[name])
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.FIELDS}
+
+    def save(self, filename):
+        '''
+        write the profile to a JSON file
+        '''
+        with open(filename, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2, sort_keys=True)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename) as f:
+            return cls(**json.load(f))
+
+    def report(self):
+        '''
+        the profile as text
+        '''
+        lines = ['wall {:.3f} s: integration {:.3f} s, python {:.3f} s; {} '
+                 'steps ({:.0f} steps/s), {} events ({:.0f} events/s)'.format(
+                     self.wall, self.integration, self.python, self.steps,
+                     self.steps_per_second, self.events_count,
+                     self.events_per_second),
+                 '  linear solve {:.3f} s, events {:.3f} s'.format(
+                     self.linear_solve, self.events)]
+        for title, times in [('mechanisms', self.mechanisms),
+                             ('section types', self.section_types)]:
+            lines.append('  {}: '.format(title) + ', '.join(
+                '{} {:.3f} s'.format(name, value) for name, value in
+                sorted(times.items(), key=lambda item: -item[1])))
+        return '\n'.join(lines)
+
+
+def profile(run, init=None, replay=True, v_init=-65., n=1000, steps=200):
+    '''
+    Profile one run of the instantiated model.
+
+    Parameters
+    ----------
+    run : callable, runs the simulation (from t = 0 after init)
+    init : callable or None, initializes the model before run (None: run
+        initializes itself)
+    replay : bool, measure the integration time by replaying the run with
+        pc.psolve, otherwise the integration time is the wall time
+    v_init : float, initial membrane potential (mV) of the replay if init
+        is None
+    n, steps : int, segments and steps of the cost measurements
+
+    Returns
+    -------
+    result : Profile
+    '''
+    events = _EventCounter()
+    if init is not None:
+        init()
+    t0 = time.time()
+    run()
+    wall = time.time() - t0
+    tstop, dt = h.t, h.dt
+    n_steps = int(round(tstop / dt))
+    n_events = events.count()
+
+    integration = wall
+    if replay:
+        pc = h.ParallelContext()
+        pc.set_maxstep(10)
+        step_time = pc.step_time()
+        if init is not None:
+            init()
+        else:
+            h.finitialize(v_init)
+        pc.psolve(tstop)
+        integration = min(pc.step_time() - step_time, wall)
+    del events
+
+    segments, counts = model_counts()
+    point = set(counts) & _point_processes()
+    costs = mechanism_costs(set(counts) - point, point, n, steps)
+    estimate = {'linear_solve': costs['segment'] * sum(segments.values())
+                * n_steps,
+                'events': costs['event'] * n_events}
+    mechanisms = {name: costs[name] * sum(count.values()) * n_steps
+                  for name, count in counts.items()}
+    section_types = {sec_type: costs['segment'] * nseg * n_steps
+                     for sec_type, nseg in segments.items()}
+    for name, count in counts.items():
+        for sec_type, number in count.items():
+            section_types[sec_type] += costs[name] * number * n_steps
+    total = sum(estimate.values()) + sum(mechanisms.values())
+    scale = integration / total if total > 0 else 0.
+    return Profile(
+        wall=wall, integration=integration, python=wall - integration,
+        steps=n_steps, steps_per_second=n_steps / wall,
+        events_count=n_events, events_per_second=n_events / wall,
+        linear_solve=estimate['linear_solve'] * scale,
+        events=estimate['events'] * scale,
+        mechanisms={name: value * scale for name, value in mechanisms.items()},
+        section_types={name: value * scale
+                       for name, value in section_types.items()},
+        sampling_scale=scale, tstop=tstop, dt=dt,
+        nsegs=int(sum(segments.values())), neuron_version=neuron.__version__)
+
+
+def _point_processes():
+    mt = h.MechanismType(1)
+    name = h.ref('')
+    names = set()
+    for i in range(int(mt.count())):
+        mt.select(i)
+        mt.selected(name)
+        names.add(name[0])
+    return names
+
+
+if __name__ == '__main__':
+    h.load_file('stdrun.hoc')
+    ## the model and the Python integration loop of example_6.py
+    soma, apic, dend, axon = [h.Section(name=name) for name in
+                              ['soma', 'apic', 'dend', 'axon']]
+    apic.connect(soma(1), 0)
+    dend.connect(soma(0), 0)
+    axon.connect(soma(0), 0)
+    for sec, L, diam, nseg in zip([soma, apic, dend, axon],
+                                  [30., 600., 200., 1000.],
+                                  [30., 1., 2., 1.], [1, 25, 5, 35]):
+        sec.L, sec.diam, sec.nseg, sec.Ra, sec.cm = L, diam, nseg, 100., 1.
+    for sec in [apic, dend]:
+        sec.insert('pas')
+        sec.g_pas, sec.e_pas = 0.0002, -65.
+    for sec in [soma, axon]:
+        sec.insert('hh')
+    syn = h.ExpSyn(apic(0.5))
+    syn.e, syn.tau = 0., 2.
+    stim = h.NetStim()
+    stim.noise, stim.start, stim.number, stim.interval = 1., 0., 1000, 10.
+    netcon = h.NetCon(stim, syn)
+    netcon.weight[0] = 2.
+    t, v = h.Vector().record(h._ref_t), h.Vector().record(soma(0.5)._ref_v)
+    h.dt = 0.1
+    tstop = 500.
+
+    def integrate():
+        while h.t < tstop:
+            h.fadvance()
+
+    result = profile(integrate, init=lambda: h.finitialize(-65))
+    print(result.report())
+    if len(sys.argv) > 1:
+        result.save(sys.argv[1])
+        print('saved to {}'.format(sys.argv[1]))
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+'''
+Cache of equilibrated NEURON model states.
+
+Many simulations start with a long settling period (e.g. LFPy's negative
+tstart, or an IClamp delay of several hundred ms) only to let the model reach
+its resting state. StateCache runs this settling period once, stores the final
+state with NEURON's SaveState on disk, and restores it on later runs of the
+same model with the same parameters. Example usage:
+
+    from neuron_tools import StateCache
+    cache = StateCache()
+    cell = Mymodel(gna, gkdr, gahp, gcat, gcal, ghbar)
+    cache.equilibrate(v_init=-80, t_settle=500)
+    # t is now 0, the model is at steady state and recordings start here
+    while h.t < tstop:
+        h.fadvance()
+
+The cache key is computed from the model structure (sections, geometry,
+inserted mechanisms and their parameters, point processes), the
+temperature, dt, v_init, the settling duration and optional user parameters,
+so any change to the model gives a new entry.
+'''
+import os
+import hashlib
+import neuron
+h = neuron.h
+
+_parameter_cache = {}
+
+
+def _mechanism_parameters(name):
+    '''
+    return the names of the PARAMETER range variables of a mechanism
+    '''
+    if name not in _parameter_cache:
+        names = []
+        try:
+            ms = h.MechanismStandard(name, 1)
+        except (RuntimeError, LookupError):
+            ms = None
+        if ms is not None:
+            strdef = h.ref('')
+            for i in range(int(ms.count())):
+                ms.name(strdef, i)
+                names.append(strdef[0])
+        _parameter_cache[name] = names
+    return _parameter_cache[name]
+
+
+def model_description():
+    '''
+    Return a nested tuple describing the structure and parameters of all
+    sections currently instantiated in NEURON. State variables are not
+    included, so the description is the same before and after a run.
+    '''
+    description = []
+    for sec in h.allsec():
+        parent = sec.parentseg()
+        sec_desc = [sec.name(), sec.nseg, sec.L, sec.Ra,
+                    None if parent is None else (parent.sec.name(), parent.x),
+                    sec.orientation()]
+        for seg in sec:
+            seg_desc = [seg.x, seg.diam, seg.cm]
+            for mech in seg:
+                params = []
+                for name in _mechanism_parameters(mech.name()):
+                    try:
+                        params.append((name, getattr(seg, name)))
+                    except (AttributeError, LookupError, TypeError):
+                        # array parameters and parameters without a segment
+                        # value are skipped
+                        pass
+                seg_desc.append((mech.name(), tuple(params)))
+            for pp in seg.point_processes():
+                pp_name = pp.hname().split('[')[0]
+                pp_params = []
+                for name in _mechanism_parameters(pp_name):
+                    try:
+                        pp_params.append((name, getattr(pp, name)))
+                    except (AttributeError, LookupError, TypeError):
+                        pass
+                seg_desc.append((pp_name, tuple(pp_params)))
+            sec_desc.append(tuple(seg_desc))
+        description.append(tuple(sec_desc))
+    return tuple(description)
+
+
+class StateCache(object):
+    '''
+    Disk cache of equilibrated model states stored with NEURON's SaveState.
+    '''
+    def __init__(self, cache_dir='.state_cache', verbose=False):
+        '''
+        Parameters
+        ----------
+        cache_dir : str, directory where states are stored
+        verbose : bool, print whether states are restored or computed
+        '''
+        self.cache_dir = cache_dir
+        self.verbose = verbose
+        # SaveState objects must outlive the restore
+        self.savestate = None
+
+    def key(self, v_init, t_settle, params=None):
+        '''
+        Return the cache key of the current model for the given
+        initialization and user parameters.
+        '''
+        # dt is only relevant to fixed step integration, CVode changes it
+        cvode = h.CVode().active()
+        description = (model_description(), h.celsius,
+                       None if cvode else h.dt, float(v_init),
+                       float(t_settle), cvode,
+                       None if params is None else sorted(params.items()))
+        return hashlib.sha1(repr(description).encode()).hexdigest()
+
+    def path(self, key):
+        '''
+        Return the file name of a cache entry
+        '''
+        return os.path.join(self.cache_dir, key + '.dat')
+
+    def equilibrate(self, v_init=-65., t_settle=500., params=None):
+        '''
+        Bring the model to the state reached after simulating t_settle ms from
+        finitialize(v_init), with time set to 0 afterwards. The state is read
+        from the cache if available, otherwise it is simulated and stored.
+
+        Parameters
+        ----------
+        v_init : float, initial membrane potential
+        t_settle : float, duration of the settling period in ms
+        params : dict or None, additional parameters that affect the steady
+            state but are not part of the model structure (e.g. global
+            variables of mechanisms)
+
+        Returns
+        -------
+        restored : bool, True if the state was restored from the cache
+        '''
+        key = self.key(v_init, t_settle, params)
+        path = self.path(key)
+
+        # finitialize must always be called, it sets up the data structures
+        # SaveState.restore expects
+        h.finitialize(v_init)
+        self.savestate = h.SaveState()
+
+        if os.path.isfile(path):
+            f = h.File()
+            f.ropen(path)
+            self.savestate.fread(f)
+            f.close()
+            self.savestate.restore(1)
+            restored = True
+        else:
+            # settle from t = -t_settle to t = 0, so that stimuli and event
+            # times are not shifted by the settling period
+            h.t = -t_settle
+            if h.CVode().active():
+                h.CVode().re_init()
+                h.CVode().solve(0.)
+            else:
+                for i in range(int(round(t_settle / h.dt))):
+                    h.fadvance()
+            self.savestate.save()
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            f = h.File()
+            f.wopen(path)
+            self.savestate.fwrite(f)
+            f.close()
+            restored = False
+
+        h.t = 0.
+        if h.CVode().active():
+            h.CVode().re_init()
+        else:
+            h.fcurrent()
+        # restart Vector recordings from the equilibrated state at t = 0
+        h.frecord_init()
+        if self.verbose:
+            print('{} state {}'.format('restored' if restored else 'computed',
+                                       key))
+        return restored
+
+    def clear(self):
+        '''
+        Remove all cached states
+        '''
+        if os.path.isdir(self.cache_dir):
+            for fname in os.listdir(self.cache_dir):
+                if fname.endswith('.dat'):
+                    os.remove(os.path.join(self.cache_dir, fname))